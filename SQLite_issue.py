@@ -1,18 +1,130 @@
-from sqlite3 import connect
+from itertools import islice
+import re
+from sqlite3 import Connection, connect
+from typing import Iterable, Iterator
+import os
 
-conn = connect('library.db')
-cursor = conn.cursor()
+# Путь к базе данных библиотеки и размер пачки для массовых операций задаются переменными окружения.
+## Соединение открывается при первом обращении, поэтому импорт модуля не создает файл базы данных
+DB_PATH = os.getenv('LIBRARY_DB', 'library.db')
+BATCH_SIZE = int(os.getenv('LIBRARY_BATCH_SIZE', 10000))
 
-cursor.execute(
+conn = None
+
+
+def get_connection() -> Connection:
+    '''
+    Возвращает соединение с базой данных, при первом обращении открывает его и создает таблицу,
+    индекс по году и полнотекстовый индекс
+    :return: sqlite3.Connection
+    '''
+    global conn
+    if conn is None:
+        conn = connect(DB_PATH)
+        conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS books(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                author TEXT NOT NULL,
+                year INTEGER NOT NULL
+            );
+            '''
+        )
+        create_search_index(conn)
+    return conn
+
+
+def create_search_index(connection: Connection):
+    '''
+    Создает индекс по году для выборок по диапазону и полнотекстовый индекс FTS5 по названию и автору.
+    FTS5-таблица хранит только индекс (content='books'), триггеры обновляют его при изменении books.
+    Если полнотекстового индекса еще не было, он строится по уже имеющимся книгам
+    :param connection: sqlite3.Connection
+    :return:
+    '''
+    connection.execute('CREATE INDEX IF NOT EXISTS books_year ON books(year);')
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts';"
+    ).fetchone()
+    connection.execute(
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            title, author, content='books', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        );
+        '''
+    )
+    connection.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+        END;
+        '''
+    )
+    connection.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+        END;
+        '''
+    )
+    connection.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author ON books
+        WHEN old.title IS NOT new.title OR old.author IS NOT new.author BEGIN
+            INSERT INTO books_fts(books_fts, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+            INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+        END;
+        '''
+    )
+    if not exists:
+        connection.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild');")
+    connection.commit()
+
+
+def close():
     '''
-    CREATE TABLE IF NOT EXISTS books(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        author TEXT NOT NULL,
-        year INTEGER NOT NULL
-    );
+    Закрывает соединение с базой данных
+    :return:
+    '''
+    global conn
+    if conn is not None:
+        conn.close()
+        conn = None
+
+
+def batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    '''
+    Делит последовательность на списки не длиннее batch_size, не загружая ее в память целиком
+    :param items: Iterable
+    :param batch_size: int
+    :return: Iterator[list]
+    '''
+    items = iter(items)
+    while batch := list(islice(items, batch_size)):
+        yield batch
+
+
+def execute_batches(sql: str, rows: Iterable[tuple], batch_size: int) -> int:
+    '''
+    Выполняет запрос для всех строк пачками через executemany в одной транзакции,
+    возвращает число измененных строк. При ошибке вся операция откатывается
+    :param sql: str
+    :param rows: Iterable[tuple]
+    :param batch_size: int
+    :return: int
     '''
-)
+    connection = get_connection()
+    # rowcount executemany - строки самого запроса, без строк, измененных триггерами индекса FTS5
+    changed = 0
+    try:
+        for batch in batches(rows, batch_size):
+            changed += connection.executemany(sql, batch).rowcount
+    except BaseException:
+        connection.rollback()
+        raise
+    connection.commit()
+    return changed
 
 
 def add_book(title: str, author: str, year: int):
@@ -23,27 +135,140 @@ def add_book(title: str, author: str, year: int):
     :param year: int
     :return:
     '''
-    cursor.execute(
+    connection = get_connection()
+    connection.execute(
         '''
         INSERT INTO books(title, author, year)
         VALUES (?,?,?);
         ''',
         (title, author, year)
     )
-    conn.commit()
+    connection.commit()
+
+
+def add_books(books: Iterable[tuple], batch_size: int = BATCH_SIZE) -> int:
+    '''
+    Добавляет книги (title, author, year) одной транзакцией, пачками по batch_size.
+    books может быть генератором: в памяти держится только текущая пачка
+    :param books: Iterable[tuple]
+    :param batch_size: int
+    :return: int
+    '''
+    return execute_batches(
+        '''
+        INSERT INTO books(title, author, year)
+        VALUES (?,?,?);
+        ''',
+        books,
+        batch_size
+    )
 
 
 def get_all_books() -> list:
     '''
-    Возвращает список всех книг в базе данных
+    Возвращает список всех книг в базе данных. Для больших каталогов используйте iter_books
     :return: list
     '''
-    books = cursor.execute(
+    return get_connection().execute(
         '''
         SELECT * FROM books;
         '''
     ).fetchall()
-    return list(books)
+
+
+def get_books_page(after_id: int = 0, limit: int = 100) -> list:
+    '''
+    Возвращает до limit книг с идентификатором больше after_id в порядке идентификаторов.
+    Следующая страница запрашивается с after_id последней книги страницы
+    :param after_id: int
+    :param limit: int
+    :return: list
+    '''
+    return get_connection().execute(
+        '''
+        SELECT * FROM books
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?;
+        ''',
+        (after_id, limit)
+    ).fetchall()
+
+
+def iter_books(batch_size: int = BATCH_SIZE) -> Iterator[tuple]:
+    '''
+    Перебирает все книги страницами по batch_size: в памяти держится только текущая страница
+    :param batch_size: int
+    :return: Iterator[tuple]
+    '''
+    after_id = 0
+    while page := get_books_page(after_id, batch_size):
+        yield from page
+        after_id = page[-1][0]
+
+
+def match_query(text: str, column: str = None) -> str:
+    '''
+    Переводит текст запроса в выражение FTS5: каждое слово ищется как начало слова (префикс),
+    все слова должны встретиться. Служебные символы FTS5 в тексте не действуют
+    :param text: str
+    :param column: str
+    :return: str
+    '''
+    terms = ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+    if not terms:
+        return ''
+    return f'{column} : ({terms})' if column else terms
+
+
+def search_books(text: str = None, title: str = None, author: str = None, year_from: int = None,
+                 year_to: int = None, limit: int = 20, offset: int = 0) -> list:
+    '''
+    Ищет книги: text - по названию и автору, title и author - по своему полю, year_from и year_to -
+    диапазон лет (включительно). С текстом результаты упорядочены по релевантности (bm25),
+    без него - по году. Страницы задаются limit и offset
+    :param text: str
+    :param title: str
+    :param author: str
+    :param year_from: int
+    :param year_to: int
+    :param limit: int
+    :param offset: int
+    :return: list
+    '''
+    conditions, params = [], []
+    if year_from is not None:
+        conditions.append('b.year >= ?')
+        params.append(year_from)
+    if year_to is not None:
+        conditions.append('b.year <= ?')
+        params.append(year_to)
+    terms = [query for query in (match_query(text or ''), match_query(title or '', 'title'),
+                                 match_query(author or '', 'author')) if query]
+
+    if terms:
+        return get_connection().execute(
+            f'''
+            SELECT b.* FROM books_fts
+            JOIN books AS b ON b.id = books_fts.rowid
+            WHERE books_fts MATCH ? {''.join(' AND ' + condition for condition in conditions)}
+            ORDER BY books_fts.rank
+            LIMIT ? OFFSET ?;
+            ''',
+            (' AND '.join(terms), *params, limit, offset)
+        ).fetchall()
+    if text or title or author:
+        # В запросе не оказалось ни одного слова
+        return []
+    return get_connection().execute(
+        f'''
+        SELECT * FROM books AS b
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY b.year, b.id
+        LIMIT ? OFFSET ?;
+        ''',
+        (*params, limit, offset)
+    ).fetchall()
 
 
 def update_info(id: int, title: str, author: str, year: int):
@@ -55,7 +280,8 @@ def update_info(id: int, title: str, author: str, year: int):
     :param year: int
     :return:
     '''
-    cursor.execute(
+    connection = get_connection()
+    connection.execute(
         '''
         UPDATE books
         SET title = ?, author = ?, year = ?
@@ -63,7 +289,26 @@ def update_info(id: int, title: str, author: str, year: int):
         ''',
         (title, author, year, id)
     )
-    conn.commit()
+    connection.commit()
+
+
+def update_books(books: Iterable[tuple], batch_size: int = BATCH_SIZE) -> int:
+    '''
+    Обновляет книги (id, title, author, year) одной транзакцией, пачками по batch_size.
+    Возвращает число обновленных книг
+    :param books: Iterable[tuple]
+    :param batch_size: int
+    :return: int
+    '''
+    return execute_batches(
+        '''
+        UPDATE books
+        SET title = ?, author = ?, year = ?
+        WHERE id = ?
+        ''',
+        ((title, author, year, id) for id, title, author, year in books),
+        batch_size
+    )
 
 
 def delete_book(id: int):
@@ -72,28 +317,57 @@ def delete_book(id: int):
     :param id: int
     :return:
     '''
-    cursor.execute(
-        f'''
+    connection = get_connection()
+    connection.execute(
+        '''
         DELETE FROM books
-        WHERE id = {id}
+        WHERE id = ?
+        ''',
+        (id,)
+    )
+    connection.commit()
+
+
+def delete_books(ids: Iterable[int], batch_size: int = BATCH_SIZE) -> int:
+    '''
+    Удаляет книги по идентификаторам одной транзакцией, пачками по batch_size.
+    Возвращает число удаленных книг
+    :param ids: Iterable[int]
+    :param batch_size: int
+    :return: int
+    '''
+    return execute_batches(
         '''
+        DELETE FROM books
+        WHERE id = ?
+        ''',
+        ((id,) for id in ids),
+        batch_size
     )
-    conn.commit()
 
 
-# Создание экземпляров
-add_book('okokok', 'pisatel', 1932)
-add_book('lalala', 'avtor', 2015)
-print(get_all_books())
+if __name__ == '__main__':
+    # Создание экземпляров
+    add_book('okokok', 'pisatel', 1932)
+    add_book('lalala', 'avtor', 2015)
+    print(get_all_books())
+
+    # Обновление информации
+    update_info(2, 'lalala', 'avtorKA', 2025)
+    print(get_all_books())
 
-# Обновление информации
-update_info(2, 'lalala', 'avtorKA', 2025)
-print(get_all_books())
+    # Удаление экземпляра
+    delete_book(1)
+    print(get_all_books())
 
-# Удаление экземпляра
-delete_book(1)
-print(get_all_books())
+    # Массовые операции
+    add_books((f'title{i}', f'author{i % 100}', 1900 + i % 125) for i in range(1000))
+    update_books((book[0], book[1], book[2].upper(), book[3]) for book in iter_books() if book[3] == 2000)
+    delete_books(book[0] for book in iter_books() if book[3] < 1910)
+    print(sum(1 for _ in iter_books()))
 
+    # Поиск
+    print(search_books('title12', year_from=1900, year_to=2000, limit=5))
+    print(search_books(author='author7 '))
 
-cursor.close()
-conn.close()
\ No newline at end of file
+    close()
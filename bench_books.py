@@ -0,0 +1,116 @@
+"""
+Поиск по каталогу книг SQLite_issue: полнотекстовый индекс FTS5 и индекс по году против прежнего
+способа - выборки всех книг (get_all_books) и фильтрации в Python. Каталог синтетический:
+названия и авторы собираются из псевдослов с фиксированным seed.
+
+Выводит JSON: время заполнения каталога и для каждого запроса - среднее время (мс) обоими способами,
+ускорение и число найденных книг. Результаты поиска сверяются с полным перебором.
+
+Запуск: python bench_books.py [число книг] [повторов запроса]
+"""
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+SYLLABLES = ('ка', 'ро', 'ми', 'ла', 'то', 'вер', 'ан', 'ско', 'ни', 'бе', 'да', 'лин', 'ор', 'су', 'ге')
+QUERIES = {
+    'title': {'title': 'кар'},
+    'author': {'author': 'верни'},
+    'title_author': {'text': 'ро ла'},
+    'year_range': {'year_from': 1950, 'year_to': 1952},
+    'title_year': {'title': 'кар', 'year_from': 1900, 'year_to': 1999},
+}
+
+
+def make_catalog(count: int, seed: int = 1):
+    """
+    Генерирует книги (title, author, year): 2-4 слова в названии, имя и фамилия автора
+
+    :param count: int
+    :param seed: int
+    :return: Iterator[tuple]
+    """
+    rnd = random.Random(seed)
+    words = [''.join(rnd.choices(SYLLABLES, k=rnd.randint(2, 4))) for _ in range(5000)]
+    names = [word.capitalize() for word in words[:300]]
+    for _ in range(count):
+        title = ' '.join(rnd.choices(words, k=rnd.randint(2, 4))).capitalize()
+        author = f'{rnd.choice(names)} {rnd.choice(words).capitalize()}'
+        yield title, author, rnd.randint(1800, 2025)
+
+
+def matches(book: tuple, text: str = None, title: str = None, author: str = None,
+            year_from: int = None, year_to: int = None) -> bool:
+    """
+    Прежний способ: проверка книги в Python. Каждое слово запроса должно быть началом слова поля
+
+    :param book: tuple
+    :return: bool
+    """
+    def found(query: str, value: str) -> bool:
+        value_words = re.findall(r'\w+', value.lower())
+        return all(any(word.startswith(part) for word in value_words) for part in re.findall(r'\w+', query.lower()))
+
+    _, book_title, book_author, year = book
+    return ((year_from is None or year >= year_from) and (year_to is None or year <= year_to)
+            and (text is None or found(text, f'{book_title} {book_author}'))
+            and (title is None or found(title, book_title))
+            and (author is None or found(author, book_author)))
+
+
+def timed(function, repeat: int) -> tuple:
+    """
+    Среднее время вызова (мс) и результат последнего вызова
+
+    :param function: Callable
+    :param repeat: int
+    :return: tuple
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - started)
+    return round(statistics.fmean(times) * 1000, 3), result
+
+
+def run(count: int, repeat: int) -> dict:
+    """
+    Заполняет каталог и замеряет запросы
+
+    :param count: int
+    :param repeat: int
+    :return: dict
+    """
+    ## Модуль читает путь к базе данных при импорте
+    import SQLite_issue as library
+
+    started = time.perf_counter()
+    library.add_books(make_catalog(count))
+    results = {'books': count, 'fill_seconds': round(time.perf_counter() - started, 3), 'queries': {}}
+
+    for name, query in QUERIES.items():
+        scan_ms, expected = timed(lambda: [book for book in library.get_all_books() if matches(book, **query)],
+                                  max(1, repeat // 10))
+        page_ms, _ = timed(lambda: library.search_books(**query, limit=20), repeat)
+        everything = library.search_books(**query, limit=-1)
+        if sorted(everything) != sorted(expected):
+            raise AssertionError(f'{name}: поиск нашел {len(everything)} книг, перебор - {len(expected)}')
+        results['queries'][name] = {'scan_ms': scan_ms, 'search_ms': page_ms,
+                                    'speedup': round(scan_ms / page_ms, 1), 'found': len(expected)}
+    library.close()
+    return results
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['LIBRARY_DB'] = os.path.join(directory, 'library.db')
+        result = run(count, repeat)
+    print(json.dumps(result, ensure_ascii=False))
@@ -0,0 +1,34 @@
+"""
+Микробенчмарк: стоимость клавиатуры в одном ответе - сборка ReplyKeyboardMarkup и сериализация
+в JSON на каждое сообщение против готовой клавиатуры из реестра tgbot_keyboards.
+
+Запуск: python bench_keyboards.py [число повторов]
+"""
+import sys
+import timeit
+
+from telebot import apihelper, types
+
+from tgbot_keyboards import KEYBOARDS
+
+
+def build_per_message() -> str:
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(types.KeyboardButton('О командах'))
+    return apihelper._convert_markup(markup)
+
+
+def from_registry() -> str:
+    return apihelper._convert_markup(KEYBOARDS['about'])
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    assert build_per_message() == from_registry()
+    results = {}
+    for name, func in (('per_message', build_per_message), ('registry', from_registry)):
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        results[name] = best / number * 1e6
+        print(f'{name:12} {results[name]:8.3f} мкс на ответ')
+    print(f'экономия     {results["per_message"] - results["registry"]:8.3f} мкс на ответ '
+          f'({results["per_message"] / results["registry"]:.1f}x)')
@@ -0,0 +1,232 @@
+"""
+Нагрузочный тест обработчиков tgbot_final: синтетический поток обновлений для множества чатов
+(/start -> /sleep -> /wake -> /quality -> /notes -> "Моя статистика" -> выбор даты) прогоняется
+через настоящие обработчики в одном процессе. Сетевые запросы telebot подменяются ответами
+без обращения к Telegram и подсчитываются.
+
+Выводит JSON: перцентили задержки обработки обновления, обновлений в секунду, SQL-запросов
+на обновление, рост RSS и число исходящих вызовов по методам API. Если передан файл с прошлым
+результатом, сравнивает с ним и завершается с кодом 1 при регрессии больше BENCH_TOLERANCE.
+
+Запуск: python bench_load.py [число чатов] [baseline.json]
+Хранилище выбирается переменной STORAGE (sqlite или memory), число потоков обработки - BENCH_THREADS
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('TOKEN', '0:bench')
+## Лимиты отправки снимаются, чтобы измерять только обработку обновлений
+os.environ.update(SENDER_GLOBAL_RATE='1e9', SENDER_CHAT_RATE='1e9', SENDER_CHAT_BURST='1000000', SENDER_LINGER='0')
+## Число потоков обработки: обновления одного шага сценария (разные чаты) обрабатываются параллельно,
+## как в пуле потоков вебхука; 1 - по очереди в одном потоке
+THREADS = int(os.getenv('BENCH_THREADS', 1))
+## Допустимое ухудшение относительно прошлого результата (доля)
+TOLERANCE = float(os.getenv('BENCH_TOLERANCE', 0.2))
+
+from bench_shards import fake_request, make_update
+
+# Исходящие вызовы API по методам
+outbound = Counter()
+outbound_lock = threading.Lock()
+
+
+def recording_request(method, url, **kwargs):
+    """
+    Подсчитывает исходящий вызов API и отвечает без обращения к сети
+
+    :param method: str
+    :param url: str
+    :return: FakeResponse
+    """
+    with outbound_lock:
+        outbound[url.rsplit('/', 1)[-1]] += 1
+    return fake_request(method, url, **kwargs)
+
+
+def make_callback(update_id: int, chat_id: int, data: str) -> dict:
+    """
+    Собирает JSON обновления с нажатием inline-кнопки
+
+    :param update_id: int
+    :param chat_id: int
+    :param data: str
+    :return: dict
+    """
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}
+    message = {'message_id': update_id, 'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private'}, 'text': 'Выбери дату для статистики:'}
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': str(chat_id),
+                               'message': message, 'data': data}}
+
+
+def make_traffic(chats: int, today: str) -> list:
+    """
+    Генерирует поток обновлений в виде JSON-строк (как их присылает Telegram): каждый шаг сценария
+    выполняется всеми чатами по очереди, поэтому соседние обновления относятся к разным пользователям
+
+    :param chats: int
+    :param today: str
+    :return: list
+    """
+    steps = ('/start', '/sleep', '/wake', '/quality 7', '/notes спалось хорошо', 'Моя статистика', f'stat_{today}')
+    updates = []
+    for step in steps:
+        for chat_id in range(1, chats + 1):
+            if step.startswith('stat_'):
+                update = make_callback(len(updates) + 1, chat_id, step)
+            else:
+                update = make_update(len(updates) + 1, chat_id, step)
+            updates.append(json.dumps(update, ensure_ascii=False))
+    return updates
+
+
+def rss_kb() -> int:
+    """
+    Текущий размер резидентной памяти процесса (КБ); без /proc - пиковый размер
+
+    :return: int
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values: list, share: float) -> float:
+    """
+    Перцентиль по отсортированному списку (ближайший ранг)
+
+    :param values: list
+    :param share: float
+    :return: float
+    """
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def process(bot, raw: str) -> float:
+    """
+    Обрабатывает одно обновление, возвращает время обработки (сек.)
+
+    :param bot: telebot.TeleBot
+    :param raw: str
+    :return: float
+    """
+    from telebot import types
+    started = time.perf_counter()
+    bot.process_new_updates([types.Update.de_json(raw)])
+    return time.perf_counter() - started
+
+
+def run(chats: int) -> dict:
+    """
+    Прогоняет поток обновлений через обработчики на чистой базе данных и собирает метрики
+
+    :param chats: int
+    :return: dict
+    """
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = recording_request
+
+    ## Модули бота читают настройки при импорте, поэтому импортируются после подготовки окружения
+    import tgbot_db
+    # Запросы считаются на всех соединениях, включая соединение потока-писателя (DB_DURABILITY)
+    statements = count()
+    open_connection = tgbot_db.open_connection
+
+    def traced_connection(path: str = None):
+        conn = open_connection(path)
+        conn.set_trace_callback(lambda sql: next(statements))
+        return conn
+
+    tgbot_db.open_connection = traced_connection
+    import tgbot_final
+    import tgbot_func
+    from tgbot_func import get_date
+
+    bot = tgbot_final.bootstrap()
+    storage = tgbot_func.get_storage()
+    bot.threaded = False
+    traffic = make_traffic(chats, get_date())
+    rss_start = rss_kb()
+    statements_start = next(statements)
+    started = time.perf_counter()
+    if THREADS > 1:
+        # Шаги сценария идут по порядку, внутри шага обновления разных чатов обрабатываются параллельно
+        with ThreadPoolExecutor(THREADS) as executor:
+            latencies = []
+            for step in range(0, len(traffic), chats):
+                latencies += executor.map(lambda raw: process(bot, raw), traffic[step:step + chats])
+    else:
+        latencies = [process(bot, raw) for raw in traffic]
+    elapsed = time.perf_counter() - started
+    tgbot_final.sessions.flush()
+    tgbot_final.reminders.close()
+    storage.close()
+    tgbot_final.sender.join(60)
+    rss_end = rss_kb()
+    executed = next(statements) - statements_start - 1
+    tgbot_db.close_all()
+
+    latencies.sort()
+    return {
+        'storage': storage.__class__.__name__,
+        'chats': chats,
+        'threads': THREADS,
+        'updates': len(traffic),
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(len(traffic) / elapsed, 1),
+        'latency_ms': {name: round(percentile(latencies, share) * 1000, 3)
+                       for name, share in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'sql_per_update': round(executed / len(traffic), 2),
+        'rss_start_kb': rss_start,
+        'rss_growth_kb': rss_end - rss_start,
+        'outbound': dict(outbound),
+        'failed_sends': tgbot_final.sender.failed
+    }
+
+
+def regressions(result: dict, baseline: dict) -> list:
+    """
+    Сравнивает результат с прошлым: меньше обновлений в секунду, больше задержка p95 или SQL-запросов
+
+    :param result: dict
+    :param baseline: dict
+    :return: list
+    """
+    found = []
+    if result['updates_per_second'] < baseline['updates_per_second'] * (1 - TOLERANCE):
+        found.append(f'updates_per_second: {baseline["updates_per_second"]} -> {result["updates_per_second"]}')
+    if result['latency_ms']['p95'] > baseline['latency_ms']['p95'] * (1 + TOLERANCE):
+        found.append(f'latency_ms.p95: {baseline["latency_ms"]["p95"]} -> {result["latency_ms"]["p95"]}')
+    if result['sql_per_update'] > baseline['sql_per_update'] * (1 + TOLERANCE):
+        found.append(f'sql_per_update: {baseline["sql_per_update"]} -> {result["sql_per_update"]}')
+    return found
+
+
+if __name__ == '__main__':
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DB_PATH'] = os.path.join(directory, 'bench.db')
+        result = run(chats)
+    print(json.dumps(result, ensure_ascii=False))
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as file:
+            found = regressions(result, json.load(file))
+        for line in found:
+            print(f'Регрессия: {line}', file=sys.stderr)
+        sys.exit(1 if found else 0)
@@ -0,0 +1,162 @@
+"""
+Нагрузочный тест обслуживания базы данных (tgbot_maintenance): в чистую базу записывается история сна
+пользователей за несколько лет, затем обслуживание (отдельным процессом, как из cron) переносит записи
+старше года в архив, возвращает свободные страницы и выполняет ANALYZE. Одновременно поток-зонд,
+как обработчик бота, делает короткие транзакции записи и замеряет их время вместе с ожиданием блокировки.
+
+Выводит JSON: отчет обслуживания, размер базы данных до и после, время транзакций зонда (медиана,
+99-й процентиль, максимум) и проверки: суммы статистики не изменились, пересчет сумм с учетом архива
+дает те же значения, выгрузка возвращает все записи.
+
+Запуск: python bench_maintenance.py [число пользователей] [дней истории]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+
+def fill(conn, users: int, days: int):
+    """
+    Записывает пользователей и по записи на каждый день истории, заканчивающейся вчера
+
+    :param conn: sqlite3.Connection
+    :param users: int
+    :param days: int
+    :return:
+    """
+    first = date.today() - timedelta(days=days)
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO users (id, name, sleep_status) VALUES (?, ?, 0)',
+                     [(chat_id, f'user{chat_id}') for chat_id in range(1, users + 1)])
+    for day in range(days):
+        sleep_date = first + timedelta(days=day)
+        rows = []
+        for chat_id in range(1, users + 1):
+            minutes = 22 * 60 + (chat_id * 7 + day * 13) % 150
+            duration = 6 + (chat_id + day * 3) % 30 / 10
+            sleep_ts = int(time.mktime(sleep_date.timetuple())) + minutes * 60
+            wake_ts = sleep_ts + int(duration * 3600)
+            rows.append((chat_id, sleep_date.isoformat(), f'{minutes // 60 % 24:02d}:{minutes % 60:02d}',
+                         time.strftime('%H:%M', time.localtime(wake_ts)), duration, (chat_id + day) % 5 + 1,
+                         'заметка' if day % 10 == 0 else None, sleep_ts, wake_ts))
+        conn.executemany(
+            '''
+            INSERT INTO sleep_records (user_id, sleep_date, sleep_time, wake_time, duration, sleep_quality, note,
+                                       sleep_ts, wake_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            rows
+        )
+    conn.execute('COMMIT')
+
+
+def rollups(conn) -> dict:
+    """
+    Возвращает все суммы sleep_rollups, округленные для сравнения сумм с плавающей точкой
+
+    :param conn: sqlite3.Connection
+    :return: dict
+    """
+    return {row[:2]: tuple(round(value, 6) for value in row[2:])
+            for row in conn.execute('SELECT * FROM sleep_rollups')}
+
+
+def database_size(conn) -> int:
+    """
+    Размер базы данных в байтах по числу страниц
+
+    :param conn: sqlite3.Connection
+    :return: int
+    """
+    return conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+
+def probe(stop: threading.Event, users: int, times: list):
+    """
+    Поток-зонд: короткие транзакции записи, как у обработчиков бота, каждые 2 мс
+
+    :param stop: threading.Event
+    :param users: int
+    :param times: list
+    :return:
+    """
+    from tgbot_db import transaction
+    chat_id = 0
+    while not stop.is_set():
+        chat_id = chat_id % users + 1
+        started = time.perf_counter()
+        with transaction() as conn:
+            conn.execute('UPDATE users SET name = name WHERE id = ?', (chat_id,))
+        times.append((time.perf_counter() - started) * 1000)
+        time.sleep(0.002)
+
+
+def run(users: int, days: int) -> dict:
+    """
+    Заполняет базу данных, выполняет обслуживание под нагрузкой зонда и проверяет результат
+
+    :param users: int
+    :param days: int
+    :return: dict
+    """
+    ## Модули читают настройки при импорте, поэтому импортируются после подготовки окружения
+    import tgbot_db
+    import tgbot_export
+    from tgbot_migrations import migrate
+    from tgbot_stats import rebuild_rollups
+
+    conn = tgbot_db.get_connection()
+    migrate(conn)
+    started = time.perf_counter()
+    fill(conn, users, days)
+    with tgbot_db.transaction():
+        rebuild_rollups(conn)
+    filled = time.perf_counter() - started
+    records = users * days
+    before, size = rollups(conn), database_size(conn)
+
+    stop, times = threading.Event(), []
+    thread = threading.Thread(target=probe, args=(stop, users, times))
+    thread.start()
+    maintenance = subprocess.run([sys.executable, 'tgbot_maintenance.py'], capture_output=True, text=True,
+                                 check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    stop.set()
+    thread.join()
+
+    after = rollups(conn)
+    exported = sum(len(rows) for pages in (tgbot_export.iter_pages(), tgbot_export.iter_archive_pages())
+                   for rows in pages)
+    with tgbot_db.transaction():
+        rebuild_rollups(conn)
+    rebuilt = rollups(conn)
+    times.sort()
+    result = {
+        'users': users,
+        'records': records,
+        'fill_seconds': round(filled, 3),
+        'maintenance': json.loads(maintenance.stdout),
+        'size_before_mb': round(size / 2 ** 20, 1),
+        'size_after_mb': round(database_size(conn) / 2 ** 20, 1),
+        'archive_mb': round(conn.execute('SELECT SUM(length(data)) FROM sleep_archive').fetchone()[0] / 2 ** 20, 1),
+        'probe': {'writes': len(times), 'median_ms': round(statistics.median(times), 3),
+                  'p99_ms': round(times[int(len(times) * 0.99)], 3), 'max_ms': round(times[-1], 3)},
+        'checked': {'rollups_unchanged': after == before, 'rebuild_matches': rebuilt == before,
+                    'exported_all': exported == records}
+    }
+    tgbot_db.close_all()
+    return result
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 730
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DB_PATH'] = os.path.join(directory, 'bench.db')
+        result = run(users, days)
+    print(json.dumps(result, ensure_ascii=False))
@@ -0,0 +1,116 @@
+"""
+Нагрузочный тест планировщика напоминаний tgbot_final: в чистую базу данных записываются пользователи,
+у которых проверки напоминаний уже наступили - поровну напоминаний о /wake (цикл начат 13 ч назад),
+заброшенных циклов (начат больше суток назад) и напоминаний о сне на текущую минуту.
+Сетевые запросы telebot подменяются ответами без обращения к Telegram, лимиты отправки сняты.
+
+Выводит JSON: время построения кучи из базы данных, время обработки всех проверок, проверок в минуту,
+отправленных сообщений и проверку результата в базе данных.
+
+Запуск: python bench_reminders.py [число пользователей]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('TOKEN', '0:bench')
+## Лимиты отправки снимаются, чтобы измерять только планировщик
+os.environ.update(SENDER_GLOBAL_RATE='1e9', SENDER_CHAT_RATE='1e9', SENDER_CHAT_BURST='1000000', SENDER_LINGER='0')
+
+from bench_load import recording_request, outbound
+
+
+def fill(conn, users: int, now: int, bedtime: int) -> dict:
+    """
+    Записывает пользователей с наступившими проверками, возвращает их chat_id по видам
+
+    :param conn: sqlite3.Connection
+    :param users: int
+    :param now: int
+    :param bedtime: int
+    :return: dict
+    """
+    from tgbot_func import get_time
+    minute = now - time.localtime(now).tm_sec
+    kinds = {'wake': [], 'stale': [], 'bedtime': []}
+    for chat_id in range(1, users + 1):
+        kinds[('wake', 'stale', 'bedtime')[chat_id % 3]].append(chat_id)
+
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO users (id, name, sleep_status, bedtime, remind_at) VALUES (?, ?, ?, ?, ?)',
+                     [(chat_id, f'user{chat_id}', 0, bedtime, minute) for chat_id in kinds['bedtime']]
+                     + [(chat_id, f'user{chat_id}', 1, None, now - 60) for kind in ('wake', 'stale')
+                        for chat_id in kinds[kind]])
+    started = {'wake': now - 13 * 3600, 'stale': now - 25 * 3600}
+    conn.executemany(
+        '''
+        INSERT INTO sleep_records (user_id, sleep_date, sleep_time, sleep_ts)
+        VALUES (?, ?, ?, ?)
+        ''',
+        [(chat_id, time.strftime('%Y-%m-%d', time.localtime(started[kind])), get_time(started[kind]), started[kind])
+         for kind in started for chat_id in kinds[kind]]
+    )
+    conn.execute('COMMIT')
+    return kinds
+
+
+def run(users: int) -> dict:
+    """
+    Заполняет базу данных, запускает планировщик и ждет обработки всех проверок
+
+    :param users: int
+    :return: dict
+    """
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = recording_request
+
+    ## Модули бота читают настройки при импорте, поэтому импортируются после подготовки окружения
+    import tgbot_db
+    import tgbot_final
+    import tgbot_func
+
+    tgbot_final.bootstrap()
+    now = int(time.time())
+    # Напоминание о сне на текущую минуту
+    bedtime = time.localtime(now).tm_hour * 60 + time.localtime(now).tm_min
+    kinds = fill(tgbot_db.get_connection(), users, now, bedtime)
+
+    started = time.perf_counter()
+    tgbot_final.reminders.start()
+    loaded = time.perf_counter() - started
+    while tgbot_final.reminders.stats()['fired'] < users:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    tgbot_final.sender.join(60)
+
+    tgbot_final.reminders.close()
+    tgbot_final.sessions.flush()
+    tgbot_func.get_storage().close()
+    # Ожидаемый результат: напомнившим о /wake назначено закрытие цикла через сутки после его начала,
+    ## заброшенные циклы закрыты без новых проверок, напоминание о сне назначено на завтра
+    conn = tgbot_db.get_connection()
+    expected = {'wake': (1, now - 13 * 3600 + tgbot_final.STALE_CYCLE), 'stale': (0, None),
+                'bedtime': (0, tgbot_func.next_time_of_day(bedtime, now))}
+    states = {row[0]: row[1:] for row in conn.execute('SELECT id, sleep_status, remind_at FROM users')}
+    checked = {kind: sum(1 for chat_id in kinds[kind] if states[chat_id] == expected[kind]) for kind in kinds}
+    tgbot_db.close_all()
+    return {
+        'users': users,
+        'kinds': {kind: len(chat_ids) for kind, chat_ids in kinds.items()},
+        'load_ms': round(loaded * 1000, 1),
+        'seconds': round(elapsed, 3),
+        'reminders_per_minute': round(users / elapsed * 60),
+        'sent': tgbot_final.sender.sent,
+        'outbound': dict(outbound),
+        'checked': checked
+    }
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DB_PATH'] = os.path.join(directory, 'bench.db')
+        result = run(users)
+    print(json.dumps(result, ensure_ascii=False))
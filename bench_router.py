@@ -0,0 +1,67 @@
+"""
+Микробенчмарк выбора обработчика: фильтры telebot (func=lambda message: message.text == ... для каждой кнопки
+и content_types=['text'] для остального), которые проверяются по очереди, против таблиц tgbot_router.
+Число кнопок растет; для каждого замеряется обработка сообщения с текстом первой кнопки, последней кнопки
+и текстом без кнопки (обработчик по умолчанию). Обработчики пустые, поэтому замеряется только выбор.
+
+Запуск: python bench_router.py [число повторов]
+"""
+import sys
+import timeit
+
+import telebot
+from telebot import types
+
+from tgbot_router import Router
+
+BUTTONS = (5, 50, 500)
+
+
+def handler(message):
+    pass
+
+
+def make_message(text: str) -> types.Message:
+    return types.Message.de_json({'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                                  'from': {'id': 1, 'is_bot': False, 'first_name': 'user'}, 'text': text})
+
+
+def filter_bot(texts: list) -> telebot.TeleBot:
+    """
+    Бот с фильтром на каждую кнопку, как регистрировались обработчики кнопок раньше
+
+    :param texts: list
+    :return: telebot.TeleBot
+    """
+    bot = telebot.TeleBot('0:bench', threaded=False, use_class_middlewares=True, validate_token=False)
+    for text in texts:
+        bot.register_message_handler(handler, func=lambda message, text=text: message.text == text)
+    bot.register_message_handler(handler, content_types=['text'])
+    return bot
+
+
+def router_bot(texts: list) -> telebot.TeleBot:
+    """
+    Бот с маршрутизатором: все кнопки в одной таблице
+
+    :param texts: list
+    :return: telebot.TeleBot
+    """
+    bot = telebot.TeleBot('0:bench', threaded=False, use_class_middlewares=True, validate_token=False)
+    router = Router(bot)
+    router.text(*texts)(handler)
+    router.default('text')(handler)
+    return bot
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f'{"кнопок":>7} {"сообщение":>10} {"фильтры, мкс":>13} {"таблицы, мкс":>13} {"ускорение":>10}')
+    for buttons in BUTTONS:
+        texts = [f'Кнопка {index}' for index in range(buttons)]
+        bots = filter_bot(texts), router_bot(texts)
+        for name, text in (('первая', texts[0]), ('последняя', texts[-1]), ('без кнопки', 'привет')):
+            messages = [make_message(text)]
+            filters, table = (min(timeit.repeat(lambda: bot.process_new_messages(messages), number=number, repeat=5))
+                              / number * 1e6 for bot in bots)
+            print(f'{buttons:>7} {name:>10} {filters:>13.2f} {table:>13.2f} {filters / table:>9.1f}x')
@@ -0,0 +1,113 @@
+"""
+Нагрузочный тест режима с несколькими процессами: синтетические обновления (/sleep, /wake, /quality, /notes)
+для множества чатов распределяются Supervisor по рабочим процессам без обращений к Telegram.
+Показывает, как пропускная способность растет с числом процессов.
+
+Запуск: python bench_shards.py [число чатов] [числа процессов через запятую]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('TOKEN', '0:bench')
+## Лимиты отправки снимаются, чтобы измерять только обработку обновлений
+os.environ.update(SENDER_GLOBAL_RATE='1e9', SENDER_CHAT_RATE='1e9', SENDER_CHAT_BURST='1000000', SENDER_LINGER='0')
+
+from tgbot_supervisor import Supervisor
+
+
+class FakeResponse:
+    status_code = 200
+    reason = 'OK'
+
+    def __init__(self, result: dict):
+        self.text = json.dumps({'ok': True, 'result': result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_request(method, url, **kwargs):
+    params = kwargs.get('params') or {}
+    return FakeResponse({'message_id': 1, 'date': 0, 'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}})
+
+
+def fake_transport():
+    """
+    Подменяет HTTP-запросы telebot ответами без обращения к сети (вызывается в рабочих процессах)
+
+    :return:
+    """
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = fake_request
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    """
+    Собирает JSON обновления с текстовым сообщением
+
+    :param update_id: int
+    :param chat_id: int
+    :param text: str
+    :return: dict
+    """
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private', 'first_name': f'user{chat_id}'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_traffic(chats: int) -> list:
+    """
+    Генерирует поток обновлений: каждый чат проходит /sleep, /wake, /quality и /notes
+
+    :param chats: int
+    :return: list
+    """
+    updates = []
+    for step in ('/sleep', '/wake', '/quality 7', '/notes спалось хорошо'):
+        for chat_id in range(1, chats + 1):
+            updates.append(make_update(len(updates) + 1, chat_id, step))
+    return updates
+
+
+def run(workers: int, updates: list) -> float:
+    """
+    Прогоняет обновления через Supervisor с workers процессами на чистой базе данных, возвращает время (сек.)
+
+    :param workers: int
+    :param updates: list
+    :return: float
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DB_PATH'] = os.path.join(directory, 'bench.db')
+        supervisor = Supervisor(workers, setup='bench_shards:fake_transport')
+        supervisor.start()
+        started = time.perf_counter()
+        for update in updates:
+            supervisor.route(update)
+        supervisor.stop()
+        return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    counts = [int(n) for n in sys.argv[2].split(',')] if len(sys.argv) > 2 else [1, 2, 4]
+    traffic = make_traffic(chats)
+    results = []
+    for workers in counts:
+        elapsed = run(workers, traffic)
+        results.append({'workers': workers, 'updates': len(traffic), 'seconds': round(elapsed, 3),
+                        'updates_per_second': round(len(traffic) / elapsed, 1)})
+        print(json.dumps(results[-1]))
+    base = results[0]['updates_per_second']
+    for result in results[1:]:
+        print(f'{result["workers"]} процессов: ускорение {result["updates_per_second"] / base:.2f}x')
@@ -0,0 +1,78 @@
+"""
+Время холодного запуска: каждый замер - новый процесс Python. Сценарии:
+helpers - импорт tgbot_func (инструменты и миграции без бота),
+first_start - импорт tgbot_final и bootstrap() на пустой базе данных (создание схемы),
+restart - то же на базе с актуальной схемой (обычный перезапуск).
+
+Выводит JSON: общее время процесса и время импорта с подготовкой бота (мс) - минимум, медиана, среднее.
+
+Запуск: python bench_startup.py [число запусков]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCENARIOS = {
+    'helpers': 'import tgbot_func',
+    'first_start': 'import tgbot_final; tgbot_final.bootstrap()',
+    'restart': 'import tgbot_final; tgbot_final.bootstrap()',
+}
+CHILD = 'import time; started = time.perf_counter(); {code}; print(time.perf_counter() - started)'
+
+
+def start(code: str, env: dict) -> tuple:
+    """
+    Запускает процесс с кодом запуска, возвращает (время процесса, время внутри процесса) в сек.
+
+    :param code: str
+    :param env: dict
+    :return: tuple
+    """
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD.format(code=code)], env=env, check=True,
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return time.perf_counter() - started, float(output.split()[-1])
+
+
+def summary(values: list) -> dict:
+    """
+    Минимум, медиана и среднее в миллисекундах
+
+    :param values: list
+    :return: dict
+    """
+    return {'min': round(min(values) * 1000, 1), 'median': round(statistics.median(values) * 1000, 1),
+            'mean': round(statistics.fmean(values) * 1000, 1)}
+
+
+def run(runs: int) -> dict:
+    """
+    Замеряет все сценарии, каждый runs раз
+
+    :param runs: int
+    :return: dict
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, TOKEN=os.getenv('TOKEN', '0:bench'))
+        # Перезапуски идут на базе, схема которой уже создана
+        start(SCENARIOS['first_start'], dict(env, DB_PATH=os.path.join(directory, 'bench.db')))
+        for name, code in SCENARIOS.items():
+            totals, inside = [], []
+            for index in range(runs):
+                # Первый запуск каждый раз на новой базе, перезапуск - на одной и той же
+                env['DB_PATH'] = os.path.join(directory, f'{name}-{index}.db' if name == 'first_start' else 'bench.db')
+                total, measured = start(code, env)
+                totals.append(total)
+                inside.append(measured)
+            results[name] = {'process_ms': summary(totals), 'import_ms': summary(inside)}
+    return results
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print(json.dumps(dict(runs=runs, **run(runs))))
@@ -0,0 +1,24 @@
+import time
+
+from tgbot_cache import SessionCache
+
+
+class User:
+    """
+    Пользователь кэша без базы данных
+    """
+
+    def is_dirty(self) -> bool:
+        return False
+
+    def memory_size(self) -> int:
+        return 100
+
+
+def test_idle_sessions_expire_without_traffic():
+    sessions = SessionCache(lambda chat_id: User(), lambda chat_id, user: None, ttl=0.05)
+    for chat_id in range(3):
+        sessions.get(chat_id)
+    sessions.start_expiry(0.02)
+    time.sleep(0.2)
+    assert sessions.stats()['users'] == 0
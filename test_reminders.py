@@ -0,0 +1,34 @@
+import time
+
+from tgbot_reminders import ReminderScheduler
+
+
+def run_batch(fire) -> ReminderScheduler:
+    """
+    Запускает планировщик с одной наступившей проверкой чата 1 и ждет, пока fire(планировщик, due, now)
+    ее обработает
+    """
+    scheduler = ReminderScheduler(lambda shard, shards: [(1, int(time.time()) - 1)],
+                                  lambda due, now: fire(scheduler, due, now), lambda changes: None)
+    scheduler.start()
+    deadline = time.monotonic() + 5
+    while scheduler.stats()['fired'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scheduler.close()
+    assert scheduler.stats()['fired'] == 1
+    return scheduler
+
+
+def test_planned_time_is_scheduled():
+    scheduler = run_batch(lambda scheduler, due, now: [(1, now + 3600)])
+    assert scheduler.stats()['scheduled'] == 1
+
+
+def test_cancel_during_batch_wins():
+    def fire(scheduler, due, now):
+        # Обработчик отменяет проверку, пока пачка в обработке
+        scheduler.schedule(1, None)
+        return [(1, now + 3600)]
+
+    scheduler = run_batch(fire)
+    assert scheduler.stats()['scheduled'] == 0
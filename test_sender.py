@@ -0,0 +1,75 @@
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import tgbot_sender
+from tgbot_sender import MessageSender
+
+
+class RecordingBot:
+    """
+    Бот без сети: запоминает время каждой отправки
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, time.monotonic()))
+
+
+def test_chat_rate_holds_after_queue_drains(monkeypatch):
+    # 20 сообщений в секунду с запасом 2: десятое сообщение уходит не раньше чем через 8 / 20 сек. после первого
+    monkeypatch.setattr(tgbot_sender, 'SENDER_CHAT_RATE', 20.0)
+    monkeypatch.setattr(tgbot_sender, 'SENDER_CHAT_BURST', 2)
+    monkeypatch.setattr(tgbot_sender, 'SENDER_GLOBAL_RATE', 1e6)
+    monkeypatch.setattr(tgbot_sender, 'SENDER_LINGER', 0)
+    bot = RecordingBot()
+    sender = MessageSender(bot, workers=2)
+    for index in range(10):
+        sender.send(1, f'сообщение {index}')
+        # Очередь чата опустевает перед каждым следующим сообщением
+        assert sender.join(5)
+    times = [sent for _, sent in bot.sent]
+    assert len(times) == 10
+    for index, sent in enumerate(times):
+        assert sent - times[0] >= (index - 1) / 20 - 0.01
+
+
+def test_idle_chat_buckets_are_evicted(monkeypatch):
+    monkeypatch.setattr(tgbot_sender, 'SENDER_CHAT_RATE', 100.0)
+    monkeypatch.setattr(tgbot_sender, 'SENDER_CHAT_BURST', 1)
+    monkeypatch.setattr(tgbot_sender, 'SENDER_LINGER', 0)
+    sender = MessageSender(RecordingBot(), workers=1)
+    for chat_id in range(50):
+        sender.send(chat_id, 'привет')
+    assert sender.join(5)
+    # Ведра наполняются за 1 / 100 сек., после этого новый чат вытесняет их
+    time.sleep(0.05)
+    sender.send(100, 'привет')
+    assert sender.join(5)
+    assert list(sender._buckets) == [100]
+
+
+def test_chat_limit_pauses_only_that_chat(monkeypatch):
+    monkeypatch.setattr(tgbot_sender, 'SENDER_LINGER', 0)
+
+    class LimitedBot(RecordingBot):
+        def send_message(self, chat_id, text, **kwargs):
+            if chat_id == 1 and not hasattr(self, 'limited'):
+                self.limited = True
+                raise ApiTelegramException('sendMessage', None, {
+                    'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 1}})
+            super().send_message(chat_id, text, **kwargs)
+
+    bot = LimitedBot()
+    sender = MessageSender(bot, workers=2)
+    started = time.monotonic()
+    sender.send(1, 'в группу')
+    time.sleep(0.05)
+    sender.send(2, 'в личный чат')
+    assert sender.join(5)
+    sent = {chat_id: moment - started for chat_id, moment in bot.sent}
+    # Чат 2 не ждет паузы чата 1
+    assert sent[2] < 0.5
+    assert sent[1] >= 1
@@ -0,0 +1,79 @@
+import pytest
+
+import tgbot_db
+import tgbot_maintenance
+import tgbot_storage
+from tgbot_storage import MemoryStorage, SQLiteStorage, Storage
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def storage(request, tmp_path, monkeypatch):
+    if request.param == 'memory':
+        yield MemoryStorage()
+        return
+    monkeypatch.setattr(tgbot_db, 'DB_PATH', str(tmp_path / 'test.db'))
+    storage = SQLiteStorage()
+    yield storage
+    storage.close()
+    tgbot_db.close_all()
+
+
+def test_reminders_follow_supervisor_shards(storage):
+    # Отрицательные chat_id - группы и супергруппы
+    chat_ids = [-1001234567891, -7, -2, 3, 8]
+    for chat_id in chat_ids:
+        storage.add_user(chat_id, f'chat{chat_id}', 0)
+    storage.set_reminders([(chat_id, 1000 + index) for index, chat_id in enumerate(chat_ids)])
+    if getattr(storage, 'writer', None):
+        # Напоминания читаются по всем пользователям, поэтому в режиме async сначала ждем фиксации
+        storage.writer.flush()
+    for shards in (1, 2, 3):
+        loaded = {}
+        for shard in range(shards):
+            for chat_id, _ in storage.get_reminders(shard, shards):
+                # Supervisor.route отдает чат процессу chat_id % workers
+                assert chat_id % shards == shard
+                loaded[chat_id] = shard
+        assert sorted(loaded) == sorted(chat_ids)
+
+
+def test_incomplete_storage_is_rejected():
+    class PartialStorage(Storage):
+        def get_user(self, chat_id: int):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialStorage()
+
+
+def test_archived_months_stay_browsable(storage, monkeypatch):
+    monkeypatch.setattr(tgbot_maintenance, 'MAINTENANCE_PAUSE', 0)
+    chat_id = 1
+    storage.add_user(chat_id, 'user', 0)
+    dates = ['2020-01-05', '2020-01-20', '2020-02-03', '2020-03-10']
+    storage.save(chat_id, [(cycle_date, ('23:00', '07:00', 8.0, 4, cycle_date, None, None)) for cycle_date in dates])
+    if isinstance(storage, SQLiteStorage):
+        storage.reader(chat_id)
+        report = {'archived': 0, 'duplicates': 0, 'transactions': 0, 'max_transaction_ms': 0}
+        tgbot_maintenance.archive_old_records('2020-03-01', report)
+        assert report['archived'] == 3
+    assert storage.get_dates(chat_id, '2020-01-01', '2020-02-01') == ['2020-01-20', '2020-01-05']
+    assert storage.get_date_before(chat_id) == '2020-03-10'
+    assert storage.get_date_before(chat_id, '2020-03-01') == '2020-02-03'
+    assert storage.get_date_before(chat_id, '2020-02-01') == '2020-01-20'
+    assert storage.get_date_from(chat_id, '2020-01-06') == '2020-01-20'
+    assert storage.get_date_from(chat_id, '2020-02-04') == '2020-03-10'
+    assert storage.get_cycle(chat_id, '2020-01-20').notes == '2020-01-20'
+    assert storage.get_cycle(chat_id, '2020-01-21') is None
+
+
+def test_constructor_errors_are_not_unknown_kind(monkeypatch):
+    class BrokenStorage(MemoryStorage):
+        def __init__(self):
+            raise KeyError('setting')
+
+    monkeypatch.setitem(tgbot_storage.STORAGES, 'broken', BrokenStorage)
+    with pytest.raises(KeyError):
+        tgbot_storage.create_storage('broken')
+    with pytest.raises(ValueError):
+        tgbot_storage.create_storage('unknown')
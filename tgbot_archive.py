@@ -0,0 +1,127 @@
+import json
+import zlib
+from sqlite3 import Connection
+
+# Архив старых записей sleep_records (таблица sleep_archive, переносит tgbot_maintenance): одна строка
+## на пользователя и месяц, записи месяца хранятся сжатым zlib JSON-массивом в порядке дат.
+## Накопительные суммы sleep_rollups при переносе не меняются, сводка статистики учитывает архив.
+ARCHIVE_COLUMNS = ('sleep_date', 'sleep_time', 'wake_time', 'duration', 'sleep_quality', 'note',
+                   'sleep_ts', 'wake_ts')
+
+
+def pack(records: list) -> bytes:
+    """
+    Сжимает записи [(значения ARCHIVE_COLUMNS)] для sleep_archive
+
+    :param records: list
+    :return: bytes
+    """
+    return zlib.compress(json.dumps(records, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(data: bytes) -> list:
+    """
+    Распаковывает записи месяца из sleep_archive
+
+    :param data: bytes
+    :return: list
+    """
+    return [tuple(record) for record in json.loads(zlib.decompress(data))]
+
+
+def merge(old: list, new: list) -> list:
+    """
+    Объединяет записи по дате: из записей за одну дату остается запись из new. Возвращает записи в порядке дат
+
+    :param old: list
+    :param new: list
+    :return: list
+    """
+    records = {record[0]: tuple(record) for record in old}
+    records.update((record[0], tuple(record)) for record in new)
+    return [records[sleep_date] for sleep_date in sorted(records)]
+
+
+def archived_records(conn: Connection, user_id: int) -> list:
+    """
+    Возвращает все архивные записи пользователя в порядке дат
+
+    :param conn: sqlite3.Connection
+    :param user_id: int
+    :return: list
+    """
+    records = []
+    for (data,) in conn.execute('SELECT data FROM sleep_archive WHERE user_id = ? ORDER BY month', (user_id,)):
+        records += unpack(data)
+    return records
+
+
+def archived_dates(conn: Connection, user_id: int, start: str, end: str) -> list:
+    """
+    Возвращает даты архивных записей пользователя в интервале [start, end). Распаковываются
+    только месяцы интервала
+
+    :param conn: sqlite3.Connection
+    :param user_id: int
+    :param start: str
+    :param end: str
+    :return: list
+    """
+    dates = []
+    for (data,) in conn.execute('SELECT data FROM sleep_archive WHERE user_id = ? AND month >= ? AND month <= ?',
+                                (user_id, start[:7], end[:7])):
+        dates += [record[0] for record in unpack(data) if start <= record[0] < end]
+    return dates
+
+
+def archived_date_before(conn: Connection, user_id: int, before: str):
+    """
+    Возвращает последнюю дату архивной записи раньше before или None. Достаточно двух месяцев архива:
+    в месяце before все записи могут быть не раньше before, а любая запись предыдущего месяца подходит
+
+    :param conn: sqlite3.Connection
+    :param user_id: int
+    :param before: str
+    :return: str | None
+    """
+    for (data,) in conn.execute('SELECT data FROM sleep_archive WHERE user_id = ? AND month <= ? '
+                                'ORDER BY month DESC LIMIT 2', (user_id, before[:7])):
+        dates = [record[0] for record in unpack(data) if record[0] < before]
+        if dates:
+            return max(dates)
+    return None
+
+
+def archived_date_from(conn: Connection, user_id: int, start: str):
+    """
+    Возвращает первую дату архивной записи не раньше start или None
+
+    :param conn: sqlite3.Connection
+    :param user_id: int
+    :param start: str
+    :return: str | None
+    """
+    for (data,) in conn.execute('SELECT data FROM sleep_archive WHERE user_id = ? AND month >= ? '
+                                'ORDER BY month LIMIT 2', (user_id, start[:7])):
+        dates = [record[0] for record in unpack(data) if record[0] >= start]
+        if dates:
+            return min(dates)
+    return None
+
+
+def archived_record(conn: Connection, user_id: int, sleep_date: str):
+    """
+    Возвращает архивную запись пользователя за дату (значения ARCHIVE_COLUMNS) или None
+
+    :param conn: sqlite3.Connection
+    :param user_id: int
+    :param sleep_date: str
+    :return: tuple | None
+    """
+    row = conn.execute('SELECT data FROM sleep_archive WHERE user_id = ? AND month = ?',
+                       (user_id, sleep_date[:7])).fetchone()
+    if row:
+        for record in unpack(row[0]):
+            if record[0] == sleep_date:
+                return record
+    return None
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import logging
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger('tgbot_cache')
+
+
+class SessionCache:
+    """
+    Ограниченный кэш данных пользователей (LRU + время простоя + бюджет памяти).
+    При промахе пользователь загружается через loader, при вытеснении несохраненные
+    изменения записываются через saver, а неизмененные записи просто удаляются.
+    Объекты пользователей должны иметь методы is_dirty() и memory_size().
+    Изменения одного пользователя из разных потоков выполняются под блокировкой чата (lock)
+    """
+
+    def __init__(self, loader: Callable[[int], object], saver: Callable[[int, object], None],
+                 max_users: int = 10000, ttl: float = 3600, max_bytes: int = 64 * 1024 * 1024,
+                 chat_locks: int = 256):
+        self.loader = loader
+        self.saver = saver
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        # chat_id -> [данные пользователя, время последнего обращения, оценка размера]
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # Блокировки чатов: общие для chat_id с одинаковым остатком, их число не растет с числом пользователей
+        self._chat_locks = [threading.RLock() for _ in range(chat_locks)]
+
+    def lock(self, chat_id: int) -> threading.RLock:
+        """
+        Возвращает блокировку чата: чтение, изменение и сохранение пользователя под ней не пересекаются
+        с изменениями того же пользователя в других потоках (обработчики, поток напоминаний)
+
+        :param chat_id: int
+        :return: threading.RLock
+        """
+        return self._chat_locks[chat_id % len(self._chat_locks)]
+
+    def get(self, chat_id: int):
+        """
+        Возвращает данные пользователя из кэша, при отсутствии загружает их.
+        Загрузка выполняется без блокировки кэша, чтобы пользователи разных чатов загружались параллельно
+
+        :param chat_id: int
+        :return: объект пользователя
+        """
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and now - entry[1] > self.ttl:
+                evicted.append(self._evict(chat_id))
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                entry[1] = now
+                self._entries.move_to_end(chat_id)
+                return entry[0]
+            self.misses += 1
+        self._write_back(evicted)
+
+        user = self.loader(chat_id)
+        size = user.memory_size()
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None:
+                # Пользователя параллельно загрузил другой поток - используем его копию
+                user = entry[0]
+            else:
+                self._entries[chat_id] = [user, now, size]
+                self.total_bytes += size
+            evicted = self._shrink(now)
+        self._write_back(evicted)
+        return user
+
+    def save(self, chat_id: int, user):
+        """
+        Сохраняет изменения пользователя и обновляет оценку занимаемой им памяти
+
+        :param chat_id: int
+        :param user: объект пользователя
+        :return:
+        """
+        self.saver(chat_id, user)
+        size = user.memory_size()
+        evicted = []
+        with self._lock:
+            entry = self._entries.get(chat_id)
+            if entry is not None and entry[0] is user:
+                self.total_bytes += size - entry[2]
+                entry[2] = size
+                evicted = self._shrink(time.monotonic())
+        self._write_back(evicted)
+
+    def expire(self):
+        """
+        Вытесняет записи, к которым не обращались дольше ttl
+
+        :return:
+        """
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._shrink(now)
+            # _shrink оставляет последнюю запись для только что загрузившего ее потока, здесь такого нет
+            if len(self._entries) == 1:
+                chat_id, entry = next(iter(self._entries.items()))
+                if now - entry[1] > self.ttl:
+                    evicted.append(self._evict(chat_id))
+        self._write_back(evicted)
+
+    def start_expiry(self, interval: float = 60):
+        """
+        Запускает поток, который раз в interval сек. вызывает expire: без обращений к кэшу
+        простаивающие записи иначе оставались бы в памяти
+
+        :param interval: float
+        :return:
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire()
+                except Exception:
+                    logger.exception('Ошибка вытеснения записей кэша')
+
+        threading.Thread(target=run, name='session-expiry', daemon=True).start()
+
+    def flush(self):
+        """
+        Записывает несохраненные изменения всех пользователей в кэше
+
+        :return:
+        """
+        with self._lock:
+            entries = [(chat_id, entry[0]) for chat_id, entry in self._entries.items()]
+        self._write_back(entries)
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики кэша
+
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'users': len(self._entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def _shrink(self, now: float) -> list:
+        # Самые давние обращения находятся в начале OrderedDict, последнюю добавленную запись не трогаем
+        evicted = []
+        while len(self._entries) > 1:
+            chat_id, entry = next(iter(self._entries.items()))
+            if (len(self._entries) <= self.max_users and self.total_bytes <= self.max_bytes
+                    and now - entry[1] <= self.ttl):
+                break
+            evicted.append(self._evict(chat_id))
+        return evicted
+
+    def _evict(self, chat_id: int) -> tuple:
+        user, _, size = self._entries.pop(chat_id)
+        self.total_bytes -= size
+        self.evictions += 1
+        return chat_id, user
+
+    def _write_back(self, entries: list):
+        # Запись в базу данных выполняется вне блокировки кэша
+        for chat_id, user in entries:
+            if user.is_dirty():
+                self.saver(chat_id, user)
@@ -0,0 +1,302 @@
+from contextlib import contextmanager
+from sqlite3 import Connection, connect
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from tgbot_metrics import connection_factory
+
+# Путь к базе данных и время ожидания блокировки (мс) задаются переменными окружения
+DB_PATH = os.getenv('DB_PATH', 'tgbot_users')
+BUSY_TIMEOUT = int(os.getenv('DB_BUSY_TIMEOUT', 5000))
+# Надежность записи: sync - транзакция в потоке обработчика; batched - изменения разных чатов фиксируются
+# одной транзакцией в потоке-писателе, обработчик ждет фиксации; async - обработчик не ждет, изменения
+# фиксируются в течение DB_WRITE_DELAY мс (при аварийной остановке процесса последние изменения теряются)
+DURABILITY = os.getenv('DB_DURABILITY', 'batched')
+WRITE_BATCH = int(os.getenv('DB_WRITE_BATCH', 500))
+WRITE_DELAY = float(os.getenv('DB_WRITE_DELAY', 5)) / 1000
+WRITE_QUEUE = int(os.getenv('DB_WRITE_QUEUE', 10000))
+
+logger = logging.getLogger('tgbot_db')
+## Сигнал потоку-писателю зафиксировать накопленную пачку без ожидания
+WAKE = object()
+
+## Каждый поток обработчиков получает собственное соединение: sqlite3 не позволяет
+## использовать соединение из другого потока, а WAL дает читать параллельно с записью.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+
+def open_connection(path: str = None) -> Connection:
+    """
+    Открывает и настраивает новое соединение: WAL, busy_timeout, внешние ключи, ручное управление транзакциями.
+    Новая база данных создается с auto_vacuum = INCREMENTAL, чтобы tgbot_maintenance возвращал
+    освободившиеся страницы по частям (у существующей базы режим меняет только полный VACUUM)
+
+    :param path: str
+    :return: sqlite3.Connection
+    """
+    conn = connect(path or DB_PATH, timeout=BUSY_TIMEOUT / 1000, isolation_level=None, check_same_thread=False,
+                   factory=connection_factory())
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT}')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def get_connection() -> Connection:
+    """
+    Возвращает соединение текущего потока, при первом обращении создает его
+
+    :return: sqlite3.Connection
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = open_connection()
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+@contextmanager
+def transaction():
+    """
+    Короткая явная транзакция на соединении текущего потока. BEGIN IMMEDIATE сразу берет
+    блокировку записи, поэтому транзакция не упадет посередине из-за конкурирующей записи.
+    Вложенный вызов продолжает уже открытую транзакцию
+
+    :return: sqlite3.Connection
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+class GroupCommitWriter:
+    """
+    Отложенная запись (write-behind): изменения из потоков обработчиков ставятся в очередь, один
+    поток-писатель выполняет накопившиеся изменения пачкой до batch штук в одной транзакции (group commit).
+    В режиме wait_commit вызывающий поток ждет фиксации транзакции со своим изменением, иначе
+    писатель дожидается новых изменений до delay сек., чтобы пачки были крупнее.
+    Каждое изменение выполняется в SAVEPOINT, поэтому ошибка одного не отменяет остальные
+    """
+
+    def __init__(self, wait_commit: bool = True, batch: int = WRITE_BATCH, delay: float = WRITE_DELAY,
+                 max_queue: int = WRITE_QUEUE):
+        self.wait_commit = wait_commit
+        self.batch = batch
+        self.delay = delay
+        self.batches = 0
+        self.writes = 0
+        self.closed = False
+        self._queue = queue.Queue(max_queue)
+        # ключ (chat_id) -> число изменений в очереди; по нему чтение ждет своих записей
+        self._pending = {}
+        self._cond = threading.Condition()
+        # Проверка closed и постановка в очередь атомарны: изменение не попадает в очередь после сигнала остановки.
+        ## Отдельная блокировка, а не _cond: put ждет места в очереди, а писателю для ее разбора нужен _cond
+        self._submit_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, key, function, *args, wait: bool = None):
+        """
+        Ставит изменение function(conn, *args) в очередь. В режиме wait_commit (или с wait=True)
+        возвращается после фиксации и пробрасывает исключение изменения; wait=False ставит
+        в очередь без ожидания в любом режиме. После close выполняет изменение сразу
+
+        :param key: ключ для упорядочивания чтения (chat_id)
+        :param function: Callable
+        :param wait: bool
+        :return:
+        """
+        wait = self.wait_commit if wait is None else wait
+        # [ключ, функция, аргументы, событие фиксации, исключение]
+        item = [key, function, args, threading.Event() if wait else None, None]
+        with self._submit_lock:
+            queued = not self.closed
+            if queued:
+                with self._cond:
+                    self._pending[key] = self._pending.get(key, 0) + 1
+                self._queue.put(item)
+        if not queued:
+            with transaction() as conn:
+                function(conn, *args)
+            return
+        if item[3] is not None:
+            item[3].wait()
+            if item[4] is not None:
+                raise item[4]
+
+    def wait(self, key):
+        """
+        Ждет фиксации изменений ключа, чтобы чтение видело собственные записи
+
+        :param key: ключ (chat_id)
+        :return:
+        """
+        if key not in self._pending:
+            return
+        self._queue.put(WAKE)
+        with self._cond:
+            while key in self._pending:
+                self._cond.wait()
+
+    def flush(self):
+        """
+        Ждет фиксации всех поставленных в очередь изменений
+
+        :return:
+        """
+        self._queue.put(WAKE)
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+
+    def close(self, timeout: float = 30):
+        """
+        Дописывает очередь и останавливает поток-писатель
+
+        :param timeout: float
+        :return:
+        """
+        with self._submit_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning('Поток-писатель не завершился за %s сек.', timeout)
+            return
+        # Оставшиеся в очереди изменения (если они есть) выполняются здесь, и их ожидающие потоки освобождаются
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and item is not WAKE:
+                self._commit([item])
+
+    def _run(self):
+        while True:
+            items = []
+            stop = self._collect(items)
+            if items:
+                self._commit(items)
+            if stop:
+                return
+
+    def _collect(self, items: list) -> bool:
+        # Первое изменение пачки ждем без ограничения, следующие - до delay сек. (только без wait_commit:
+        # изменения ждущих потоков не задерживаем, в пачку идет то, что уже накопилось).
+        # Возвращает True, если получен сигнал остановки
+        deadline = None
+        while len(items) < self.batch:
+            try:
+                if deadline is None:
+                    item = self._queue.get()
+                    deadline = time.monotonic() + self.delay
+                else:
+                    timeout = deadline - time.monotonic()
+                    if self.wait_commit or timeout <= 0:
+                        item = self._queue.get_nowait()
+                    else:
+                        item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return False
+            if item is None:
+                return True
+            if item is WAKE:
+                # Кто-то ждет фиксации - пачку больше не копим
+                if items:
+                    return False
+                deadline = None
+                continue
+            items.append(item)
+        return False
+
+    def _commit(self, items: list):
+        try:
+            with transaction() as conn:
+                if len(items) == 1:
+                    items[0][1](conn, *items[0][2])
+                else:
+                    self._apply(conn, items)
+        except Exception as error:
+            if any(item[3] is None for item in items):
+                # Изменения без ожидания (режим async, wait=False): ошибку некому передать
+                logger.exception('Ошибка фиксации пачки из %d изменений', len(items))
+            for item in items:
+                item[4] = item[4] or error
+        self.batches += 1
+        self.writes += len(items)
+        with self._cond:
+            for item in items:
+                count = self._pending[item[0]] - 1
+                if count:
+                    self._pending[item[0]] = count
+                else:
+                    del self._pending[item[0]]
+            self._cond.notify_all()
+        for item in items:
+            if item[3] is not None:
+                item[3].set()
+
+    @staticmethod
+    def _apply(conn, items: list):
+        # Каждое изменение пачки - в своей точке сохранения: ошибка откатывает только его
+        for item in items:
+            conn.execute('SAVEPOINT write')
+            try:
+                item[1](conn, *item[2])
+            except Exception as error:
+                conn.execute('ROLLBACK TO write')
+                item[4] = error
+                if item[3] is None:
+                    logger.exception('Ошибка отложенной записи для %s', item[0])
+            conn.execute('RELEASE write')
+
+
+def create_writer(durability: str = DURABILITY):
+    """
+    Создает поток-писатель для режима надежности или None для sync
+
+    :param durability: str
+    :return: GroupCommitWriter | None
+    """
+    if durability == 'sync':
+        return None
+    if durability not in ('batched', 'async'):
+        raise ValueError(f"Неизвестный режим записи '{durability}'. Доступны: sync, batched, async")
+    return GroupCommitWriter(wait_commit=durability == 'batched')
+
+
+def close_all():
+    """
+    Закрывает все открытые соединения
+
+    :return:
+    """
+    with _connections_lock:
+        while _connections:
+            _connections.pop().close()
+    _local.__dict__.pop('conn', None)
+
+
+atexit.register(close_all)
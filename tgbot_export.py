@@ -0,0 +1,292 @@
+import csv
+import json
+import os
+import sys
+from itertools import chain, islice
+
+from tgbot_archive import unpack
+from tgbot_db import get_connection, transaction
+from tgbot_migrations import migrate
+from tgbot_stats import rebuild_rollups
+
+# Выгрузка и загрузка истории сна: CSV, JSON Lines и колоночный Parquet (нужен пакет pyarrow).
+## Записи читаются страницами по id и пишутся по мере чтения, загрузка идет пачками через executemany,
+## поэтому память не растет с размером истории.
+##
+## Запуск: python tgbot_export.py export history.csv [chat_id]
+##         python tgbot_export.py import history.jsonl
+## Формат определяется по расширению файла: .csv, .jsonl, .parquet
+COLUMNS = ('user_id', 'sleep_date', 'sleep_time', 'wake_time', 'duration', 'sleep_quality', 'note',
+           'sleep_ts', 'wake_ts')
+TYPES = (int, str, str, str, float, int, str, int, int)
+
+# Размер страницы выгрузки и пачки загрузки (записей) задаются переменными окружения
+EXPORT_PAGE = int(os.getenv('EXPORT_PAGE', 10000))
+IMPORT_BATCH = int(os.getenv('IMPORT_BATCH', 50000))
+## Пересчет статистики после загрузки - по столько пользователей в транзакции
+ROLLUP_USERS = 500
+
+UPSERT_RECORD = '''
+    INSERT INTO sleep_records ({columns})
+    VALUES ({placeholders})
+    ON CONFLICT (user_id, sleep_date) DO UPDATE SET {updates}
+'''.format(
+    columns=', '.join(COLUMNS),
+    placeholders=', '.join('?' for _ in COLUMNS),
+    updates=', '.join(f'{column} = excluded.{column}' for column in COLUMNS[2:])
+)
+
+
+def iter_pages(chat_id: int = None, page: int = EXPORT_PAGE):
+    """
+    Возвращает записи sleep_records страницами по page строк: все записи в порядке id или записи
+    одного пользователя в порядке дат (по индексу). Каждая страница читается отдельным коротким запросом
+    с продолжением от последнего ключа, поэтому выгрузка не держит транзакцию чтения
+    и не мешает контрольным точкам WAL
+
+    :param chat_id: int
+    :param page: int
+    :return: Iterator[list]
+    """
+    conn = get_connection()
+    if chat_id is None:
+        key, last, condition, params = 'id', 0, '', ()
+    else:
+        key, last, condition, params = 'sleep_date', '', 'user_id = ? AND', (chat_id,)
+    while True:
+        rows = conn.execute(
+            f'''
+            SELECT {key}, {', '.join(COLUMNS)}
+            FROM sleep_records
+            WHERE {condition} {key} > ?
+            ORDER BY {key}
+            LIMIT ?
+            ''',
+            params + (last, page)
+        ).fetchall()
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+def iter_archive_pages(chat_id: int = None, page: int = EXPORT_PAGE):
+    """
+    Возвращает записи архива sleep_archive (tgbot_maintenance) страницами примерно по page строк:
+    в строке архива записи пользователя за месяц, поэтому страница - page // 31 месяцев.
+    Продолжение - от последнего ключа (user_id, month), как в iter_pages
+
+    :param chat_id: int
+    :param page: int
+    :return: Iterator[list]
+    """
+    conn = get_connection()
+    condition, params = ('user_id = ? AND', (chat_id,)) if chat_id is not None else ('', ())
+    last = (-2 ** 63, '')
+    while True:
+        rows = conn.execute(
+            f'''
+            SELECT user_id, month, data
+            FROM sleep_archive
+            WHERE {condition} (user_id, month) > (?, ?)
+            ORDER BY user_id, month
+            LIMIT ?
+            ''',
+            params + last + (max(1, page // 31),)
+        ).fetchall()
+        if not rows:
+            return
+        last = rows[-1][:2]
+        yield [(user_id,) + record for user_id, _, data in rows for record in unpack(data)]
+
+
+def write_csv(path: str, pages) -> int:
+    """
+    Записывает страницы записей в CSV с заголовком
+
+    :param path: str
+    :param pages: Iterator[list]
+    :return: int
+    """
+    total = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        for rows in pages:
+            writer.writerows(rows)
+            total += len(rows)
+    return total
+
+
+def write_jsonl(path: str, pages) -> int:
+    """
+    Записывает страницы записей в JSON Lines: по объекту на строку
+
+    :param path: str
+    :param pages: Iterator[list]
+    :return: int
+    """
+    total = 0
+    with open(path, 'w', encoding='utf-8') as file:
+        for rows in pages:
+            file.writelines(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows)
+            total += len(rows)
+    return total
+
+
+def arrow():
+    """
+    Импортирует pyarrow для формата Parquet
+
+    :return: tuple
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError('Для формата Parquet нужен пакет pyarrow: pip install pyarrow') from None
+    return pyarrow, pyarrow.parquet
+
+
+def write_parquet(path: str, pages) -> int:
+    """
+    Записывает страницы записей в Parquet: каждая страница - отдельная группа строк
+
+    :param path: str
+    :param pages: Iterator[list]
+    :return: int
+    """
+    pa, pq = arrow()
+    kinds = {int: pa.int64(), float: pa.float64(), str: pa.string()}
+    schema = pa.schema([(name, kinds[kind]) for name, kind in zip(COLUMNS, TYPES)])
+    total = 0
+    writer = pq.ParquetWriter(path, schema)
+    try:
+        for rows in pages:
+            columns = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            total += len(rows)
+    finally:
+        writer.close()
+    return total
+
+
+def read_csv(path: str):
+    """
+    Читает записи из CSV; пустые значения становятся NULL
+
+    :param path: str
+    :return: Iterator[tuple]
+    """
+    with open(path, newline='', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        header = tuple(next(reader, ()))
+        if header != COLUMNS:
+            raise ValueError(f'Ожидались колонки {", ".join(COLUMNS)}')
+        for row in reader:
+            yield tuple(kind(value) if value != '' else None for kind, value in zip(TYPES, row))
+
+
+def read_jsonl(path: str):
+    """
+    Читает записи из JSON Lines
+
+    :param path: str
+    :return: Iterator[tuple]
+    """
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                yield tuple(record.get(name) for name in COLUMNS)
+
+
+def read_parquet(path: str):
+    """
+    Читает записи из Parquet по группам строк
+
+    :param path: str
+    :return: Iterator[tuple]
+    """
+    _, pq = arrow()
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=EXPORT_PAGE, columns=list(COLUMNS)):
+        data = batch.to_pydict()
+        yield from zip(*(data[name] for name in COLUMNS))
+
+
+FORMATS = {
+    '.csv': (write_csv, read_csv),
+    '.jsonl': (write_jsonl, read_jsonl),
+    '.parquet': (write_parquet, read_parquet),
+}
+
+
+def get_format(path: str) -> tuple:
+    """
+    Возвращает функции записи и чтения по расширению файла
+
+    :param path: str
+    :return: tuple
+    """
+    try:
+        return FORMATS[os.path.splitext(path)[1].lower()]
+    except KeyError:
+        raise ValueError(f"Неизвестный формат файла '{path}'. Доступны: {', '.join(FORMATS)}") from None
+
+
+def export_history(path: str, chat_id: int = None) -> int:
+    """
+    Выгружает историю сна (всю или одного пользователя) в файл, возвращает число записей.
+    Записи из архива выгружаются после записей sleep_records
+
+    :param path: str
+    :param chat_id: int
+    :return: int
+    """
+    write, _ = get_format(path)
+    migrate(get_connection())
+    return write(path, chain(iter_pages(chat_id), iter_archive_pages(chat_id)))
+
+
+def import_history(path: str, batch: int = IMPORT_BATCH) -> int:
+    """
+    Загружает историю сна из файла: записи за ту же дату перезаписываются, недостающие пользователи
+    создаются. Каждая пачка - одна транзакция с executemany; после загрузки статистика
+    пересчитывается только для затронутых пользователей. Возвращает число записей
+
+    :param path: str
+    :param batch: int
+    :return: int
+    """
+    _, read = get_format(path)
+    migrate(get_connection())
+    rows = read(path)
+    users = set()
+    total = 0
+    while True:
+        chunk = list(islice(rows, batch))
+        if not chunk:
+            break
+        new_users = {row[0] for row in chunk} - users
+        with transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO users (id, sleep_status) VALUES (?, 0)',
+                             [(user_id,) for user_id in new_users])
+            conn.executemany(UPSERT_RECORD, chunk)
+        users |= new_users
+        total += len(chunk)
+
+    users = sorted(users)
+    for start in range(0, len(users), ROLLUP_USERS):
+        with transaction() as conn:
+            rebuild_rollups(conn, users[start:start + ROLLUP_USERS])
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('export', 'import'):
+        sys.exit('Использование: python tgbot_export.py export|import <файл.csv|.jsonl|.parquet> [chat_id]')
+    if sys.argv[1] == 'export':
+        count = export_history(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    else:
+        count = import_history(sys.argv[2])
+    print(f'Записей: {count}')
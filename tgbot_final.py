@@ -1,24 +1,130 @@
+import atexit
+from functools import wraps
 import os
 import random
 import time
 
 import telebot
 from telebot import types
+from telebot.handler_backends import BaseMiddleware
+
+from tgbot_cache import SessionCache
+from tgbot_func import (get_date, get_month_dates, get_name, get_summary, get_time, init_storage, load_cycle,
+                        load_open_cycle, load_reminder_states, load_reminders, load_user_data, next_time_of_day,
+                        remember_name, save_bedtime, save_reminders, save_user_data)
+from tgbot_keyboards import KEYBOARDS
+from tgbot_metrics import METRICS_PORT, instrument_bot, register_gauges, start_http_server
+from tgbot_reminders import ReminderScheduler
+from tgbot_router import Router
+from tgbot_sender import MessageSender
+from tgbot_stats import format_summary
+from tgbot_user import Cycle, UserState
 
-from tgbot_func import get_date, get_time, load_user_data, save_user_data
-
-info = {}
 TEXT_ERROR = 'Произошла ошибка. Попробуй другую команду или перезапусти бота.'
 
-
-# Подключение к боту
-MY_TOKEN = os.getenv('TOKEN')
-if not MY_TOKEN:
-    raise ValueError ("Токен бота не найден. Задайте переменную 'TOKEN'")
-bot = telebot.TeleBot(MY_TOKEN)
-
-
-@bot.message_handler(commands=['start'])
+# Через сколько часов после начала незавершенного цикла напомнить о /wake и через сколько закрыть цикл
+## автоматически; напоминания, опоздавшие больше REMIND_LATE сек. (бот был остановлен), не отправляются
+WAKE_REMIND = int(float(os.getenv('REMIND_WAKE_AFTER', 12)) * 3600)
+STALE_CYCLE = int(float(os.getenv('STALE_CYCLE_HOURS', 24)) * 3600)
+REMIND_LATE = 3600
+
+# Единственный экземпляр бота: обработчики регистрируются на нем при импорте, а хранилище,
+## кэш пользователей и очередь отправки создаются в bootstrap() при запуске. Токен проверяется там же,
+## поэтому модуль можно импортировать и без него
+bot = telebot.TeleBot(os.getenv('TOKEN', ''), use_class_middlewares=True, validate_token=False)
+# Обработчики регистрируются в таблицах маршрутизатора: выбор обработчика - поиск в словаре,
+## а не проверка фильтров всех обработчиков по очереди
+router = Router(bot)
+sessions: SessionCache = None
+sender: MessageSender = None
+reminders: ReminderScheduler = None
+
+
+class NameMiddleware(BaseMiddleware):
+    """
+    Обновляет имя пользователя по полю from_user входящих сообщений, чтобы не запрашивать его у Telegram
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        if isinstance(message, types.CallbackQuery):
+            # У нажатий кнопок сообщений, отправленных в inline-режиме, нет сообщения и чата
+            if message.message is None:
+                return
+            chat_id = message.message.chat.id
+        else:
+            chat_id = message.chat.id
+        if message.from_user:
+            remember_name(chat_id, message.from_user.first_name)
+
+    def post_process(self, message, data, exception):
+        pass
+
+
+bot.setup_middleware(NameMiddleware())
+
+
+def bootstrap(token: str = None) -> telebot.TeleBot:
+    """
+    Готовит бота к работе (один раз за процесс): проверяет токен, создает хранилище и проверяет схему
+    базы данных, кэш пользователей и очередь отправки, подключает метрики
+
+    :param token: str
+    :return: telebot.TeleBot
+    """
+    global sessions, sender, reminders
+    if sender is not None:
+        return bot
+    bot.token = token or bot.token
+    if not bot.token:
+        raise ValueError("Токен бота не найден. Задайте переменную 'TOKEN'")
+    telebot.util.validate_token(bot.token)
+    bot.bot_id = telebot.util.extract_bot_id(bot.token)
+
+    init_storage()
+    # Кэш данных пользователей: размер, время простоя (сек.) и бюджет памяти (байт) задаются переменными окружения
+    sessions = SessionCache(load_user_data, save_user_data,
+                            max_users=int(os.getenv('SESSION_MAX_USERS', 10000)),
+                            ttl=float(os.getenv('SESSION_TTL', 3600)),
+                            max_bytes=int(os.getenv('SESSION_MAX_BYTES', 64 * 1024 * 1024)))
+    # Простаивающие записи вытесняются и без обращений к кэшу
+    sessions.start_expiry(min(sessions.ttl, 60))
+    # atexit вызывает функции в обратном порядке: кэш дописывается до остановки хранилища
+    atexit.register(sessions.flush)
+    # Ответы отправляются через очередь с учетом лимитов Telegram; при остановке очередь дочищается
+    sender = MessageSender(bot)
+    atexit.register(sender.join, 10)
+    # Напоминания: куча строится из базы данных при reminders.start(), до этого обработчики только назначают их
+    reminders = ReminderScheduler(load_reminders, send_reminders, save_reminders)
+    atexit.register(reminders.close)
+
+    # Измерения подключаются после регистрации всех обработчиков (если метрики включены)
+    instrument_bot(bot, router)
+    register_gauges('sessions', sessions.stats)
+    register_gauges('sender', lambda: {'sent': sender.sent, 'merged': sender.merged, 'failed': sender.failed})
+    register_gauges('reminders', reminders.stats)
+    return bot
+
+
+def serialized(handler):
+    """
+    Выполняет обработчик, изменяющий данные пользователя, под блокировкой чата (SessionCache.lock),
+    чтобы его изменения не пересекались с автоматическим закрытием цикла в потоке напоминаний
+
+    :param handler: Callable
+    :return: Callable
+    """
+    @wraps(handler)
+    def wrapper(message: telebot.types.Message):
+        with sessions.lock(message.chat.id):
+            return handler(message)
+    return wrapper
+
+
+@router.command('start')
 def start(message: telebot.types.Message):
     """
     Обработчик команды /start
@@ -26,19 +132,17 @@ def start(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    info[message.chat.id] = load_user_data(message.chat.id)
-    current_user = info[message.chat.id]
+    sessions.get(message.chat.id)
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton('О командах'))
-    bot.send_message(message.chat.id,
-                     f'Привет, {current_user["name"]}! Я буду помогать тебе отслеживать сон. '
-                     'Используй команды /sleep, /wake, /quality, /notes '
-                     'и кнопки ниже, чтобы управлять ботом.',
-                     reply_markup=markup)
+    sender.send(message.chat.id,
+                f'Привет, {get_name(message.chat.id)}! Я буду помогать тебе отслеживать сон. '
+                'Используй команды /sleep, /wake, /quality, /notes '
+                'и кнопки ниже, чтобы управлять ботом.',
+                reply_markup=KEYBOARDS['about'])
 
 
-@bot.message_handler(commands=['sleep'])
+@router.command('sleep')
+@serialized
 def sleep(message: telebot.types.Message):
     """
     Обработчик команды /sleep; дополнительно проверяет, может ли пользователь начать цикл
@@ -46,56 +150,46 @@ def sleep(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    current_user = info[message.chat.id]
+    current_user = sessions.get(message.chat.id)
     current_date = get_date()
 
-    if current_user['is_sleeping']:
-        bot.send_message(message.chat.id, 'Похоже, ты пытаешься начать новый цикл сна, не закончив предыдущий. '
-                                              'Воспользуйся командой /wake, чтобы завершить текущий цикл.')
+    if current_user.is_sleeping:
+        sender.send(message.chat.id, 'Похоже, ты пытаешься начать новый цикл сна, не закончив предыдущий. '
+                                         'Воспользуйся командой /wake, чтобы завершить текущий цикл.')
         return
 
-    if current_date in current_user['cycles']:
-        markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-        markup.add(types.KeyboardButton('Да, начать новый цикл'), types.KeyboardButton('Оставить предыдущую запись'))
-        bot.send_message(message.chat.id,
-                         'Сегодня ты уже начинал цикл сна. Начать новый? (Предыдущий будет перезаписан.)',
-                         reply_markup=markup)
+    if current_user.latest_date == current_date:
+        sender.send(message.chat.id,
+                    'Сегодня ты уже начинал цикл сна. Начать новый? (Предыдущий будет перезаписан.)',
+                    reply_markup=KEYBOARDS['new_cycle'])
     else:
         create_new_cycle(current_user, current_date, message)
 
 
-def create_new_cycle(user: dict, date: str, message: telebot.types.Message):
+def create_new_cycle(user: UserState, date: str, message: telebot.types.Message):
     """
     Создает новый цикл, отмечает время старта
 
-    :param user: dict
+    :param user: UserState
     :param date: str
     :param message: telebot.types.Message
     :return:
     """
-    absolute_time = time.time()
-    relative_time = get_time()
-    user['cycles'][date] = {
-        'quality': 0,
-        'notes': None,
-        'sleep_relative_time': relative_time,
-        'sleep_absolute_time': absolute_time,
-        'wake_relative_time': None,
-        'wake_absolute_time': None,
-        'duration': None
-    }
-    user['is_sleeping'] = 1
-
-    bot.send_message(message.chat.id, f'Отмечено время отхода ко сну: {relative_time}')
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton('О командах'))
+    absolute_time = int(time.time())
+    relative_time = get_time(absolute_time)
+    user.set_cycle(date, Cycle(sleep_relative_time=relative_time, sleep_absolute_time=absolute_time))
+    user.is_sleeping = 1
+
+    sender.send(message.chat.id, f'Отмечено время отхода ко сну: {relative_time}')
     options = ['Доброй ночи!', 'Уютных снов!', 'Мягких подушек!', 'Спокойной ночи!', 'Комфортного сна!']
-    bot.send_message(message.chat.id, f'{random.choice(options)} Не забудь сообщить о пробуждении: /wake',
-                     reply_markup=markup)
-    save_user_data(message.chat.id, user)
+    sender.send(message.chat.id, f'{random.choice(options)} Не забудь сообщить о пробуждении: /wake',
+                reply_markup=KEYBOARDS['about'])
+    sessions.save(message.chat.id, user)
+    reminders.schedule(message.chat.id, absolute_time + WAKE_REMIND)
 
 
-@bot.message_handler(commands=['wake'])
+@router.command('wake')
+@serialized
 def wake(message: telebot.types.Message):
     """
     Обработчик команды /wake; дополнительно проверяет, начинал ли пользователь цикл
@@ -103,46 +197,73 @@ def wake(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    current_user = info[message.chat.id]
-    if not current_user['is_sleeping']:
-        bot.send_message(message.chat.id, 'Я не вижу, чтобы ты сообщил о начале сна. '
-                                          'Используй команду /sleep.')
+    current_user = sessions.get(message.chat.id)
+    if not current_user.is_sleeping:
+        sender.send(message.chat.id, 'Я не вижу, чтобы ты сообщил о начале сна. '
+                                     'Используй команду /sleep.')
         return
 
-    current_date = list(current_user['cycles'].keys())[-1]
-    finish_cycle(current_user, current_date, message)
+    open_date = find_open_cycle(message.chat.id, current_user)
+    if open_date is None:
+        # Начало цикла не сохранилось - сбрасываем статус, чтобы можно было начать заново
+        current_user.is_sleeping = 0
+        sessions.save(message.chat.id, current_user)
+        sender.send(message.chat.id, TEXT_ERROR)
+        return
+    finish_cycle(current_user, open_date, message)
+
 
+def find_open_cycle(chat_id: int, user: UserState):
+    """
+    Возвращает дату незавершенного цикла пользователя или None. Если в памяти его нет,
+    загружает цикл из базы данных
 
-def finish_cycle(user: dict, date: str, message: telebot.types.Message):
+    :param chat_id: int
+    :param user: UserState
+    :return: str | None
+    """
+    if user.cycles.open() is None:
+        # Незавершенный цикл старше последнего в памяти нет - ищем его в базе данных
+        open_cycle = load_open_cycle(chat_id)
+        cycle = load_cycle(chat_id, open_cycle[0]) if open_cycle else None
+        if cycle is None:
+            return None
+        user.add_cycle(open_cycle[0], cycle)
+    return user.cycles.open_date
+
+
+def finish_cycle(user: UserState, date: str, message: telebot.types.Message):
     """
     Завершает цикл и рассчитывает продолжительность сна
 
-    :param user: dict
+    :param user: UserState
     :param date: str
     :param message: telebot.types.Message
     :return:
     """
-    absolute_time = time.time()
-    relative_time = get_time()
-    cycle = user['cycles'][date]
-    cycle['wake_relative_time'] = relative_time
-    cycle['wake_absolute_time'] = absolute_time
-    cycle['duration'] = round((absolute_time - cycle['sleep_absolute_time']) / 3600, 2)
-    user['is_sleeping'] = 0
-
-    bot.send_message(message.chat.id, f'Отмечено время пробуждения: {relative_time}')
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton('О командах'))
-    options = ['Доброе утро!', 'Надеюсь, ты хорошо поспал!', 'Вперед, в новый день!']
-    bot.send_message(message.chat.id,
-                     f'{random.choice(options)} '
-                     f'Продолжительность твоего сна составила примерно {cycle["duration"]} часов. '
-                     'Оцени качество сна: /quality, добавь заметки: /notes',
-                     reply_markup=markup)
-    save_user_data(message.chat.id, user)
-
+    absolute_time = int(time.time())
+    relative_time = get_time(absolute_time)
+    cycle = user.cycles[date]
+    cycle.wake_relative_time = relative_time
+    cycle.wake_absolute_time = absolute_time
+    cycle.duration = round((absolute_time - cycle.sleep_absolute_time) / 3600, 2)
+    user.is_sleeping = 0
+    user.mark_changed(date)
 
-@bot.message_handler(commands=['quality'])
+    sender.send(message.chat.id, f'Отмечено время пробуждения: {relative_time}')
+    options = ['Доброе утро!', 'Надеюсь, ты хорошо поспал!', 'Вперед, в новый день!']
+    sender.send(message.chat.id,
+                f'{random.choice(options)} '
+                f'Продолжительность твоего сна составила примерно {cycle.duration} часов. '
+                'Оцени качество сна: /quality, добавь заметки: /notes',
+                reply_markup=KEYBOARDS['about'])
+    sessions.save(message.chat.id, user)
+    # Напоминание о /wake больше не нужно: проверка сейчас назначит следующее напоминание о сне
+    reminders.schedule(message.chat.id, absolute_time)
+
+
+@router.command('quality')
+@serialized
 def quality(message: telebot.types.Message):
     """
     Обработчик команды /quality
@@ -153,7 +274,7 @@ def quality(message: telebot.types.Message):
     if check_possibility_quality(message):
         add_quality(message)
     else:
-        bot.send_message(message.chat.id, 'Сначала заверши цикл сна: /sleep и /wake.')
+        sender.send(message.chat.id, 'Сначала заверши цикл сна: /sleep и /wake.')
 
 
 def check_possibility_quality(message: telebot.types.Message) -> bool:
@@ -163,8 +284,8 @@ def check_possibility_quality(message: telebot.types.Message) -> bool:
     :param message: telebot.types.Message
     :return: bool
     """
-    current_user = info[message.chat.id]
-    if not current_user['cycles'] or current_user['is_sleeping']:
+    current_user = sessions.get(message.chat.id)
+    if current_user.latest_date is None or current_user.is_sleeping:
         return False
     return True
 
@@ -180,29 +301,31 @@ def add_quality(message: telebot.types.Message):
     try:
         quality_value = int(quality_list[1])
     except (IndexError, ValueError):
-        bot.send_message(message.chat.id, 'Введи число от 1 до 10 после команды (пример: /quality 8).')
+        sender.send(message.chat.id, 'Введи число от 1 до 10 после команды (пример: /quality 8).')
         return
 
     if quality_value not in range(1, 11):
-        bot.send_message(message.chat.id, 'Оценка должна быть от 1 до 10.')
+        sender.send(message.chat.id, 'Оценка должна быть от 1 до 10.')
         return
 
-    current_date = list(info[message.chat.id]['cycles'].keys())[-1]
-    cycle = info[message.chat.id]['cycles'][current_date]
-    cycle['quality'] = quality_value
+    current_user = sessions.get(message.chat.id)
+    cycle = current_user.latest()
+    cycle.quality = quality_value
+    current_user.mark_changed(current_user.latest_date)
 
     if quality_value <= 5:
-        bot.reply_to(message, 'Что-то беспокоило? Напиши об этом в /notes.')
+        sender.reply_to(message, 'Что-то беспокоило? Напиши об этом в /notes.')
     elif quality_value == 10:
-        bot.reply_to(message, 'Супер! Надеюсь, таких ночей будет больше!')
+        sender.reply_to(message, 'Супер! Надеюсь, таких ночей будет больше!')
     else:
-        bot.reply_to(message, 'Здорово, что ты хорошо отдохнул!')
-    bot.send_message(message.chat.id, 'Добавь заметки: /notes '
-                                '(пример: /notes спалось хорошо, снился странный сон про кабачки).')
-    save_user_data(message.chat.id, info[message.chat.id])
+        sender.reply_to(message, 'Здорово, что ты хорошо отдохнул!')
+    sender.send(message.chat.id, 'Добавь заметки: /notes '
+                           '(пример: /notes спалось хорошо, снился странный сон про кабачки).')
+    sessions.save(message.chat.id, current_user)
 
 
-@bot.message_handler(commands=['notes'])
+@router.command('notes')
+@serialized
 def notes(message: telebot.types.Message):
     """
     Обработчик команды /notes
@@ -213,7 +336,7 @@ def notes(message: telebot.types.Message):
     if check_possibility_notes(message):
         add_notes(message)
     else:
-        bot.send_message(message.chat.id, 'Оцени качество сна перед добавлением заметок: /quality.')
+        sender.send(message.chat.id, 'Оцени качество сна перед добавлением заметок: /quality.')
 
 
 def check_possibility_notes(message: telebot.types.Message) -> bool:
@@ -223,12 +346,11 @@ def check_possibility_notes(message: telebot.types.Message) -> bool:
     :param message: telebot.types.Message
     :return: bool
     """
-    current_user = info[message.chat.id]
-    if not current_user['cycles'] or current_user['is_sleeping']:
+    current_user = sessions.get(message.chat.id)
+    if current_user.latest_date is None or current_user.is_sleeping:
         return False
-    current_date = list(current_user['cycles'].keys())[-1]
-    cycle = current_user['cycles'].get(current_date)
-    if cycle and cycle.get('quality') != 0:
+    cycle = current_user.latest()
+    if cycle and cycle.quality != 0:
         return True
     return True
 
@@ -242,22 +364,121 @@ def add_notes(message: telebot.types.Message):
     """
     notes_list = message.text.split()
     if len(notes_list) <= 1:
-        bot.send_message(message.chat.id, 'Напиши заметку после команды '
-                                    '(пример: /notes спала нормально, снился странный сон про яблоки).')
+        sender.send(message.chat.id, 'Напиши заметку после команды '
+                               '(пример: /notes спала нормально, снился странный сон про яблоки).')
         return
 
     notes_list.pop(0)
     notes_str = ' '.join(notes_list)
-    current_date = list(info[message.chat.id]['cycles'].keys())[-1]
-    info[message.chat.id]['cycles'][current_date]['notes'] = notes_str
+    current_user = sessions.get(message.chat.id)
+    current_user.latest().notes = notes_str
+    current_user.mark_changed(current_user.latest_date)
 
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    markup.add(types.KeyboardButton('Моя статистика'))
-    bot.send_message(message.chat.id, 'Заметки сохранены! Посмотри статистику.', reply_markup=markup)
-    save_user_data(message.chat.id, info[message.chat.id])
+    sender.send(message.chat.id, 'Заметки сохранены! Посмотри статистику.', reply_markup=KEYBOARDS['stats'])
+    sessions.save(message.chat.id, current_user)
 
 
-@bot.message_handler(func=lambda message: message.text == 'О командах')
+@router.command('remind')
+def remind(message: telebot.types.Message):
+    """
+    Обработчик команды /remind: /remind 23:30 включает ежедневное напоминание о сне, /remind off - отключает
+
+    :param message: telebot.types.Message
+    :return:
+    """
+    parameters = message.text.split()
+    if len(parameters) == 2 and parameters[1].lower() == 'off':
+        bedtime = None
+    else:
+        try:
+            hours, minutes = map(int, parameters[1].split(':'))
+        except (IndexError, ValueError):
+            hours = minutes = -1
+        if hours not in range(24) or minutes not in range(60):
+            sender.send(message.chat.id, 'Укажи время после команды (пример: /remind 23:30). '
+                                         'Отключить напоминание: /remind off')
+            return
+        bedtime = hours * 60 + minutes
+
+    # Новый пользователь создается при загрузке, чтобы время напоминания было куда записать
+    sessions.get(message.chat.id)
+    save_bedtime(message.chat.id, bedtime)
+    reminders.schedule(message.chat.id, int(time.time()))
+    if bedtime is None:
+        sender.send(message.chat.id, 'Напоминание о сне отключено.')
+    else:
+        sender.send(message.chat.id, f'Буду напоминать о сне каждый день в {hours:02d}:{minutes:02d}. '
+                                     'Отключить: /remind off')
+
+
+def send_reminders(due: list, now: int) -> list:
+    """
+    Обрабатывает наступившие проверки напоминаний [(chat_id, время проверки)] по текущему состоянию
+    пользователей (одним запросом на пачку): напоминает о /wake, закрывает заброшенные циклы,
+    напоминает о сне. Возвращает [(chat_id, время следующей проверки или None)]
+
+    :param due: list
+    :param now: int
+    :return: list
+    """
+    states = load_reminder_states([chat_id for chat_id, _ in due])
+    planned = []
+    for chat_id, remind_at in due:
+        if chat_id not in states:
+            planned.append((chat_id, None))
+            continue
+        status, bedtime, sleep_ts = states[chat_id]
+        late = now - remind_at > REMIND_LATE
+        if status and sleep_ts is not None and now < sleep_ts + STALE_CYCLE:
+            if now < sleep_ts + WAKE_REMIND:
+                planned.append((chat_id, sleep_ts + WAKE_REMIND))
+                continue
+            if not late:
+                sender.send(chat_id, 'Кажется, ты забыл отметить пробуждение. Если уже не спишь, используй /wake.')
+            planned.append((chat_id, sleep_ts + STALE_CYCLE))
+            continue
+        if status and sleep_ts is not None:
+            close_stale_cycle(chat_id, now)
+        elif bedtime is not None and not late and remind_at == next_time_of_day(bedtime, remind_at - 1):
+            # Проверка назначена ровно на время напоминания о сне (а не после /wake или /remind)
+            sender.send(chat_id, 'Пора готовиться ко сну! Не забудь отметить отход ко сну: /sleep')
+        planned.append((chat_id, next_time_of_day(bedtime, now) if bedtime is not None else None))
+    return planned
+
+
+def close_stale_cycle(chat_id: int, now: int):
+    """
+    Закрывает незавершенный цикл старше STALE_CYCLE: время пробуждения неизвестно, поэтому
+    ни оно, ни продолжительность не записываются (wake_ts отмечает закрытие) и не учитываются в статистике
+
+    :param chat_id: int
+    :param now: int
+    :return:
+    """
+    # Та же блокировка чата, что у обработчиков: /sleep или /wake не может выполниться между проверкой и записью
+    with sessions.lock(chat_id):
+        user = sessions.get(chat_id)
+        if not user.is_sleeping:
+            return
+        open_date = find_open_cycle(chat_id, user)
+        if open_date is not None:
+            cycle = user.cycles[open_date]
+            if cycle.sleep_absolute_time + STALE_CYCLE > now:
+                # Пока шла проверка, пользователь начал новый цикл
+                return
+            cycle.wake_absolute_time = cycle.sleep_absolute_time
+            cycle.wake_relative_time = None
+            cycle.duration = None
+            user.mark_changed(open_date)
+        user.is_sleeping = 0
+        sessions.save(chat_id, user)
+    if open_date is not None:
+        sender.send(chat_id, f'Цикл сна за {open_date} закрыт автоматически: пробуждение не было отмечено '
+                             f'за {STALE_CYCLE // 3600} ч. Продолжительность не учтена в статистике. '
+                             'Начни новый цикл: /sleep')
+
+
+@router.text('О командах')
 def about_commands(message: telebot.types.Message):
     """
     Обработчик "О командах"
@@ -265,14 +486,16 @@ def about_commands(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    bot.send_message(message.chat.id,
-                     'Сообщи о сне: /sleep, о пробуждении: /wake\n'
-                     'Оцени качество по 10-балльной шкале: /quality (пример: /quality 8)\n'
-                     'Добавь заметки: /notes '
-                     '(пример: /notes спала отлично, снился странный сон про арбузы)')
+    sender.send(message.chat.id,
+                'Сообщи о сне: /sleep, о пробуждении: /wake\n'
+                'Оцени качество по 10-балльной шкале: /quality (пример: /quality 8)\n'
+                'Добавь заметки: /notes '
+                '(пример: /notes спала отлично, снился странный сон про арбузы)\n'
+                'Напоминание о сне каждый день: /remind (пример: /remind 23:30, отключить: /remind off)')
 
 
-@bot.message_handler(func=lambda message: message.text == 'Да, начать новый цикл')
+@router.text('Да, начать новый цикл')
+@serialized
 def new_cycle(message: telebot.types.Message):
     """
     Обработчик "Да, начать новый цикл": перезаписывает цикл для текущей даты
@@ -281,11 +504,11 @@ def new_cycle(message: telebot.types.Message):
     :return:
     """
     current_date = get_date()
-    current_user = info[message.chat.id]
+    current_user = sessions.get(message.chat.id)
     create_new_cycle(current_user, current_date, message)
 
 
-@bot.message_handler(func=lambda message: message.text == 'Оставить предыдущую запись')
+@router.text('Оставить предыдущую запись')
 def cycle_cancellation(message: telebot.types.Message):
     """
     Обработчик "Оставить предыдущую запись"
@@ -293,10 +516,10 @@ def cycle_cancellation(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    bot.send_message(message.chat.id, f'Статистика за {get_date()} не изменена.')
+    sender.send(message.chat.id, f'Статистика за {get_date()} не изменена.')
 
 
-@bot.message_handler(func=lambda message: message.text == 'Моя статистика')
+@router.text('Моя статистика')
 def print_stat(message: telebot.types.Message):
     """
     Обработчик "Моя статистика"; дополнительно проверяет, есть ли у пользователя доступ к статистике
@@ -304,10 +527,11 @@ def print_stat(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    current_user = info[message.chat.id]
-    if not current_user['cycles']:
-        bot.send_message(message.chat.id, 'Внеси запись о сне для статистики.')
+    current_user = sessions.get(message.chat.id)
+    if current_user.latest_date is None:
+        sender.send(message.chat.id, 'Внеси запись о сне для статистики.')
         return
+    sender.send(message.chat.id, format_summary(get_summary(message.chat.id)))
     select_date(message)
 
 
@@ -318,15 +542,50 @@ def select_date(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    current_user = info[message.chat.id]
-    markup = types.InlineKeyboardMarkup()
-    for date in current_user['cycles'].keys():
-        markup.add(types.InlineKeyboardButton(date, callback_data=f'stat_{date}'))
-    bot.send_message(message.chat.id, 'Выбери дату для статистики:', reply_markup=markup)
+    page = get_month_dates(message.chat.id)
+    sender.send(message.chat.id, 'Выбери дату для статистики:', reply_markup=date_picker(page))
+
+
+def date_picker(page: dict) -> types.InlineKeyboardMarkup:
+    """
+    Собирает клавиатуру выбора даты за один месяц с переходами к соседним месяцам
+
+    :param page: dict
+    :return: telebot.types.InlineKeyboardMarkup
+    """
+    markup = types.InlineKeyboardMarkup(row_width=4)
+    markup.add(*(types.InlineKeyboardButton(date[5:], callback_data=f'stat_{date}') for date in page['dates']))
+    navigation = []
+    if page['older']:
+        navigation.append(types.InlineKeyboardButton(f'« {page["older"]}', callback_data=f'month_{page["older"]}'))
+    if page['newer']:
+        navigation.append(types.InlineKeyboardButton(f'{page["newer"]} »', callback_data=f'month_{page["newer"]}'))
+    if navigation:
+        markup.row(*navigation)
+    return markup
+
+
+@router.callback('month_')
+def callback_month(call: telebot.types.CallbackQuery):
+    """
+    Переключает клавиатуру выбора даты на указанный месяц
+
+    :param call: telebot.types.CallbackQuery
+    :return:
+    """
+    try:
+        month = time.strftime('%Y-%m', time.strptime(call.data[len('month_'):], '%Y-%m'))
+    except ValueError:
+        sender.answer_callback(call, 'Неизвестный месяц.')
+        return
+    page = get_month_dates(call.message.chat.id, month)
+    sender.answer_callback(call)
+    sender.edit(call.message.chat.id, call.message.message_id, f'Выбери дату для статистики ({page["month"]}):',
+                reply_markup=date_picker(page))
 
 
 # Обработчик статистики
-@bot.callback_query_handler(func=lambda call: call.data.startswith('stat_'))
+@router.callback('stat_')
 def callback_stat(call: telebot.types.CallbackQuery):
     """
     Проверяет доступность выбранной даты для отображения статистики, отправляет статистику пользователю
@@ -334,26 +593,27 @@ def callback_stat(call: telebot.types.CallbackQuery):
     :param call: telebot.types.CallbackQuery
     :return:
     """
-    current_user = info.get(call.message.chat.id)
-    if not current_user or not current_user['cycles']:
-        bot.send_message(call.message.chat.id, 'Нет данных для статистики.')
+    current_user = sessions.get(call.message.chat.id)
+    if current_user.latest_date is None:
+        sender.send(call.message.chat.id, 'Нет данных для статистики.')
         return
     date = call.data.split('_')[1]
-    cycle = current_user['cycles'].get(date)
+    # История не хранится в памяти: прошлые даты читаются из базы данных по одной
+    cycle = current_user.cycles.get(date) or load_cycle(call.message.chat.id, date)
     if not cycle:
-        bot.send_message(call.message.chat.id, f'Нет данных за {date}.')
+        sender.send(call.message.chat.id, f'Нет данных за {date}.')
         return
-    bot.send_message(call.message.chat.id,
-                     f'Статистика за {date}:\n'
-                     f'Отход ко сну: {cycle.get("sleep_relative_time", "Не указано")}\n'
-                     f'Пробуждение: {cycle.get("wake_relative_time", "Не указано")}\n'
-                     f'Длительность: {cycle.get("duration", 0)} ч\n'
-                     f'Качество: {cycle.get("quality", 0)}\n'
-                     f'Заметки: {cycle.get("notes", "Нет")}')
-    bot.send_message(call.message.chat.id, 'Собираешься спать? Используй /sleep!')
+    sender.send(call.message.chat.id,
+                f'Статистика за {date}:\n'
+                f'Отход ко сну: {cycle.sleep_relative_time}\n'
+                f'Пробуждение: {cycle.wake_relative_time}\n'
+                f'Длительность: {cycle.duration} ч\n'
+                f'Качество: {cycle.quality}\n'
+                f'Заметки: {cycle.notes}')
+    sender.send(call.message.chat.id, 'Собираешься спать? Используй /sleep!')
 
 
-@bot.message_handler(content_types=['text'])
+@router.default('text')
 def other_text(message: telebot.types.Message):
     """
     Обработчик остальных сообщений
@@ -361,8 +621,17 @@ def other_text(message: telebot.types.Message):
     :param message: telebot.types.Message
     :return:
     """
-    bot.reply_to(message, 'Я не смог распознать команду. Попробуй еще раз.')
+    sender.reply_to(message, 'Я не смог распознать команду. Попробуй еще раз.')
 
 
-# Запуск бота
-bot.polling(none_stop=True)
\ No newline at end of file
+# Запуск бота: MODE=webhook включает вебхук (WEBHOOK_URL - внешний адрес для Telegram), иначе long polling
+if __name__ == '__main__':
+    bootstrap()
+    reminders.start()
+    if os.getenv('MODE') == 'webhook':
+        from tgbot_webhook import run_webhook
+        run_webhook(bot, os.getenv('WEBHOOK_URL'))
+    else:
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT)
+        bot.polling(none_stop=True)
@@ -1,51 +1,54 @@
+from collections import OrderedDict
 from datetime import date
-from sqlite3 import connect
-import time
-import telebot
 import atexit
-import os
-
-# Подключение к боту
-MY_TOKEN = os.getenv('TOKEN')
-if not MY_TOKEN:
-    raise ValueError ("Токен бота не найден. Задайте переменную 'TOKEN'")
-bot = telebot.TeleBot(MY_TOKEN)
-
-# Подготовка базы данных
-conn = connect('tgbot_users')
-cursor = conn.cursor()
-cursor.execute('PRAGMA foreign_keys = ON')
-atexit.register(conn.close)
-
-## Таблица users хранит информацию о пользователях, включая их уникальные Telegram ID и имена.
-cursor.execute(
-    '''
-    CREATE TABLE IF NOT EXISTS users(
-        id INTEGER PRIMARY KEY,
-        name TEXT,
-        sleep_status INTEGER
-    );
-    '''
-)
-
-## Таблица sleep_record хранит информацию о ежедневных записях о сне пользователей,
-## включая время начала и окончания сна, заметки, а также оценку качества сна.
-cursor.execute(
-    '''
-    CREATE TABLE IF NOT EXISTS sleep_records(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        sleep_date TEXT NOT NULL,
-        sleep_time TEXT,
-        wake_time TEXT,
-        duration REAL,
-        sleep_quality INTEGER,
-        note TEXT,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    );
-    '''
-)
-conn.commit()
+import threading
+import time
+
+from tgbot_stats import build_summary, periods, summarize
+from tgbot_storage import Storage, create_storage
+from tgbot_user import Cycle, UserState
+
+# Хранилище создается один раз за процесс: явно через init_storage при запуске бота или при первом
+## обращении. Импорт модуля не открывает базу данных и не меняет ее схему
+storage = None
+storage_lock = threading.Lock()
+
+# Кэш имен пользователей: chat_id -> (имя, время последней сверки с базой данных)
+NAME_TTL = 24 * 3600
+NAMES_MAX = 100000
+names = OrderedDict()
+names_lock = threading.Lock()
+
+# Сколько последних недель и месяцев с записями показывает динамика в сводке
+TREND_WEEKS = 4
+TREND_MONTHS = 6
+
+
+def init_storage(instance: Storage = None) -> Storage:
+    """
+    Создает хранилище (вид задается переменной STORAGE) и проверяет схему базы данных.
+    Повторный вызов возвращает уже созданное хранилище
+
+    :param instance: Storage
+    :return: Storage
+    """
+    global storage
+    with storage_lock:
+        if storage is None:
+            storage = instance or create_storage()
+            # Отложенные изменения дописываются при остановке, до закрытия соединений
+            atexit.register(storage.close)
+    return storage
+
+
+def get_storage() -> Storage:
+    """
+    Возвращает хранилище, при первом обращении создает его
+
+    :return: Storage
+    """
+    return storage or init_storage()
+
 
 def get_date() -> str:
     """
@@ -56,30 +59,62 @@ def get_date() -> str:
     return date.today().strftime('%Y-%m-%d')
 
 
-def get_time() -> str:
+def get_time(timestamp: float = None) -> str:
     """
-    Возвращает текущее время в текстовом формате
+    Возвращает время в текстовом формате: текущее или для переданного Unix time
 
+    :param timestamp: float
     :return: str
     """
-    return time.strftime('%X')
+    return time.strftime('%X', time.localtime(timestamp))
 
 
-def load_new_user(chat_id: int):
+def load_new_user(chat_id: int, name: str = None):
     """
     Загружает нового пользователя в базу данных
 
     :param chat_id: int
+    :param name: str
+    :return:
+    """
+    get_storage().add_user(chat_id, name, int(time.time()))
+
+
+def remember_name(chat_id: int, name: str):
+    """
+    Запоминает имя пользователя из входящего сообщения. В базу данных имя записывается в фоне
+    (обработчик не ждет записи), только если оно изменилось или давно не сверялось (NAME_TTL)
+
+    :param chat_id: int
+    :param name: str
     :return:
     """
-    cursor.execute(
-        """
-        INSERT INTO users (id, name, sleep_status) 
-        VALUES (?, ?, ?);
-        """,
-        (chat_id, bot.get_chat(chat_id).first_name, 0)
-    )
-    conn.commit()
+    now = time.time()
+    with names_lock:
+        cached = names.get(chat_id)
+        if cached and cached[0] == name and now - cached[1] < NAME_TTL:
+            names.move_to_end(chat_id)
+            return
+        names[chat_id] = (name, now)
+        names.move_to_end(chat_id)
+        if len(names) > NAMES_MAX:
+            names.popitem(last=False)
+
+    get_storage().update_name(chat_id, name, int(now), int(now - NAME_TTL))
+
+
+def get_name(chat_id: int) -> str:
+    """
+    Возвращает имя пользователя из кэша или из базы данных, без запросов к Telegram
+
+    :param chat_id: int
+    :return: str
+    """
+    with names_lock:
+        cached = names.get(chat_id)
+    if cached:
+        return cached[0]
+    return get_storage().get_name(chat_id)
 
 
 def check_existing(chat_id: int):
@@ -89,14 +124,7 @@ def check_existing(chat_id: int):
     :param chat_id: int
     :return: int
     """
-    cursor.execute(
-        '''
-        SELECT EXISTS (SELECT 1 FROM users WHERE id = ?)
-        ''',
-        (chat_id,)
-    )
-    result = cursor.fetchone()
-    return result[0] if result else 0
+    return int(get_storage().get_sleep_status(chat_id) is not None)
 
 
 def is_sleeping(chat_id: int):
@@ -106,91 +134,217 @@ def is_sleeping(chat_id: int):
     :param chat_id: int
     :return: int
     """
-    cursor.execute(
-        '''
-        SELECT sleep_status 
-        FROM users
-        WHERE id = ?
-        ''',
-        (chat_id,)
-    )
-    result = cursor.fetchone()
-    return result[0] if result else 0
+    return get_storage().get_sleep_status(chat_id) or 0
 
 
-def load_user_data(chat_id: int) -> dict:
+def load_user_data(chat_id: int) -> UserState:
     """
-    Возвращает данные о пользователе. Если пользователь новый, создает и возвращает новую запись
+    Возвращает состояние пользователя с последним циклом (одним запросом к хранилищу).
+    Если пользователь новый, создает и возвращает новую запись
 
     :param chat_id: int
-    :return: dict
+    :return: UserState
     """
-    if check_existing(chat_id):
-        cursor.execute(
-            '''
-            SELECT sleep_date, sleep_time, wake_time, duration, sleep_quality, note
-            FROM sleep_records
-            WHERE user_id = ?
-            ORDER BY sleep_date DESC
-            ''',
-            (chat_id,)
-        )
-        rows = cursor.fetchall()
-        user = {
-            'name': bot.get_chat(chat_id).first_name,
-            'cycles': {},
-            'is_sleeping': is_sleeping(chat_id)
-        }
-        if rows:
-            for row in rows:
-                user['cycles'][row[0]] = {
-                    'sleep_relative_time': row[1],
-                    'wake_relative_time': row[2],
-                    'duration': row[3],
-                    'quality': row[4],
-                    'notes': row[5]
-                }
+    profile = get_storage().get_user(chat_id)
+    if profile:
+        name, status, latest_date, latest = profile
+        user = UserState(get_name(chat_id) or name, status)
+        if latest_date is not None:
+            user.add_cycle(latest_date, latest)
         return user
     else:
-        new_user = {
-            'name': bot.get_chat(chat_id).first_name,
-            'cycles': {},
-            'is_sleeping': 0
-        }
-        load_new_user(chat_id)
+        new_user = UserState(get_name(chat_id))
+        load_new_user(chat_id, new_user.name)
         return new_user
 
 
-def save_user_data(chat_id: int, data: dict):
+def load_cycle(chat_id: int, cycle_date: str):
+    """
+    Возвращает цикл пользователя за дату или None
+
+    :param chat_id: int
+    :param cycle_date: str
+    :return: Cycle | None
+    """
+    return get_storage().get_cycle(chat_id, cycle_date)
+
+
+def load_open_cycle(chat_id: int):
+    """
+    Возвращает дату и время начала (Unix time) незавершенного цикла пользователя или None.
+    Один запрос к хранилищу, без загрузки истории
+
+    :param chat_id: int
+    :return: tuple | None
+    """
+    return get_storage().get_open_cycle(chat_id)
+
+
+def cycle_row(cycle: Cycle) -> tuple:
+    """
+    Возвращает значения цикла для записи: (sleep_time, wake_time, duration, quality, notes, sleep_ts, wake_ts).
+    Текстовое время выводится из Unix time, если оно известно. У автоматически закрытого цикла
+    (без времени пробуждения и продолжительности) wake_ts отмечает только закрытие, и wake_time остается NULL
+
+    :param cycle: Cycle
+    :return: tuple
+    """
+    sleep_ts = int(cycle.sleep_absolute_time) if cycle.sleep_absolute_time is not None else None
+    wake_ts = int(cycle.wake_absolute_time) if cycle.wake_absolute_time is not None else None
+    sleep_time = get_time(sleep_ts) if sleep_ts is not None else cycle.sleep_relative_time
+    if wake_ts is not None and (cycle.wake_relative_time is not None or cycle.duration is not None):
+        wake_time = get_time(wake_ts)
+    else:
+        wake_time = cycle.wake_relative_time
+    return sleep_time, wake_time, cycle.duration, cycle.quality, cycle.notes, sleep_ts, wake_ts
+
+
+def save_user_data(chat_id: int, user: UserState):
+    """
+    Сохраняет в базу данных только изменения: отмеченные через mark_changed циклы
+    и статус сна, если он отличается от сохраненного
+
+    :param chat_id: int
+    :param user: UserState
+    :return:
+    """
+    status = user.is_sleeping
+    status_changed = status != user.saved_status
+    if not user.changed and not status_changed:
+        return
+
+    dates = list(user.changed)
+    cycles = [(cycle_date, cycle_row(user.cycles[cycle_date])) for cycle_date in dates if cycle_date in user.cycles]
+    get_storage().save(chat_id, cycles, status if status_changed else None)
+
+    user.changed.difference_update(dates)
+    user.saved_status = status
+
+
+def month_bounds(month: str) -> tuple:
+    """
+    Возвращает первую дату месяца и первую дату следующего месяца для месяца в формате 'YYYY-MM'
+
+    :param month: str
+    :return: tuple
+    """
+    year, number = map(int, month.split('-'))
+    return f'{year:04d}-{number:02d}-01', f'{year + number // 12:04d}-{number % 12 + 1:02d}-01'
+
+
+def get_month_dates(chat_id: int, month: str = None) -> dict:
+    """
+    Возвращает страницу выбора даты: даты записей за месяц (по умолчанию - последний месяц с записями)
+    и соседние месяцы с записями. Все запросы - выборки по диапазону дат, поэтому стоимость
+    страницы не зависит от длины истории
+
+    :param chat_id: int
+    :param month: str
+    :return: dict
+    """
+    if month is None:
+        latest = get_storage().get_date_before(chat_id)
+        if latest is None:
+            return {'month': None, 'dates': [], 'older': None, 'newer': None}
+        month = latest[:7]
+
+    start, end = month_bounds(month)
+    dates = get_storage().get_dates(chat_id, start, end)
+    older = get_storage().get_date_before(chat_id, start)
+    newer = get_storage().get_date_from(chat_id, end)
+    return {
+        'month': month,
+        'dates': dates,
+        'older': older[:7] if older else None,
+        'newer': newer[:7] if newer else None
+    }
+
+
+def get_summary(chat_id: int, today: str = None) -> dict:
+    """
+    Возвращает сводку сна пользователя: за текущую неделю, текущий месяц и все время, серии дней
+    и динамику средних по последним неделям и месяцам. Читает не больше трех строк накопительных сумм
+    для сводки, TREND_WEEKS + TREND_MONTHS строк для динамики и одну строку пользователя
+
+    :param chat_id: int
+    :param today: str
+    :return: dict
+    """
+    today = today or get_date()
+    rollups = get_storage().get_rollups(chat_id, periods(today))
+    summary = build_summary(rollups, get_storage().get_streak(chat_id), today)
+    summary['weeks'] = get_trend(chat_id, 'W', TREND_WEEKS)
+    summary['months'] = get_trend(chat_id, 'M', TREND_MONTHS)
+    return summary
+
+
+def get_trend(chat_id: int, kind: str = 'M', limit: int = 6) -> list:
+    """
+    Возвращает средние по последним limit месяцам ('M') или неделям ('W') с записями, от последнего периода
+
+    :param chat_id: int
+    :param kind: str
+    :param limit: int
+    :return: list
+    """
+    return [dict(summarize(sums), period=period[1:]) for period, sums in get_storage().get_trend(chat_id, kind, limit)]
+
+
+def next_time_of_day(minutes: int, after: float) -> int:
+    """
+    Возвращает ближайший после after момент (Unix time), когда местное время равно minutes минут от полуночи
+
+    :param minutes: int
+    :param after: float
+    :return: int
+    """
+    local = time.localtime(after)
+    # mktime сам переносит день за конец месяца и учитывает переход на летнее время
+    for day in (local.tm_mday, local.tm_mday + 1):
+        moment = int(time.mktime((local.tm_year, local.tm_mon, day, minutes // 60, minutes % 60, 0, 0, 0, -1)))
+        if moment > after:
+            return moment
+    return moment
+
+
+def load_reminders(shard: int = 0, shards: int = 1) -> list:
+    """
+    Возвращает назначенные проверки напоминаний [(chat_id, время)] для своей части пользователей
+
+    :param shard: int
+    :param shards: int
+    :return: list
+    """
+    return get_storage().get_reminders(shard, shards)
+
+
+def load_reminder_states(chat_ids: list) -> dict:
+    """
+    Возвращает {chat_id: (статус сна, время напоминания о сне, время начала незавершенного цикла)}
+    для пачки пользователей
+
+    :param chat_ids: list
+    :return: dict
+    """
+    return get_storage().get_reminder_states(chat_ids)
+
+
+def save_reminders(reminders: list):
+    """
+    Записывает время следующей проверки напоминаний [(chat_id, время или None)]
+
+    :param reminders: list
+    :return:
+    """
+    get_storage().set_reminders(reminders)
+
+
+def save_bedtime(chat_id: int, bedtime: int = None):
     """
-    Обновляет данные о пользователе в базе данных
+    Записывает время ежедневного напоминания о сне (минуты от полуночи), None - отключает напоминание
 
     :param chat_id: int
-    :param data: dict
+    :param bedtime: int
     :return:
     """
-    for cycle_date, cycle in data['cycles'].items():
-        cursor.execute(
-            '''
-            INSERT OR REPLACE INTO sleep_records
-            (user_id, sleep_date, sleep_time, wake_time, duration, sleep_quality, note)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''',
-            (chat_id, cycle_date,
-             cycle.get('sleep_relative_time'),
-             cycle.get('wake_relative_time'),
-             cycle.get('duration'),
-             cycle.get('quality'),
-             cycle.get('notes'))
-        )
-
-    cursor.execute(
-        '''
-        UPDATE users
-        SET sleep_status = ?
-        WHERE id = ?
-        ''',
-        (data['is_sleeping'], chat_id)
-    )
-
-    conn.commit()
\ No newline at end of file
+    get_storage().set_bedtime(chat_id, bedtime)
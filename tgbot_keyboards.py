@@ -0,0 +1,45 @@
+from telebot import types
+
+
+class FrozenKeyboard(types.JsonSerializable):
+    """
+    Неизменяемая клавиатура: JSON строится один раз при создании, telebot отправляет готовую строку
+    """
+    __slots__ = ('name', '_json')
+
+    def __init__(self, name: str, markup: types.JsonSerializable):
+        self.name = name
+        self._json = markup.to_json()
+
+    def to_json(self) -> str:
+        return self._json
+
+    def __setattr__(self, key, value):
+        if hasattr(self, '_json'):
+            raise AttributeError('Клавиатура неизменяема')
+        super().__setattr__(key, value)
+
+    def __repr__(self):
+        return f'FrozenKeyboard({self.name!r})'
+
+
+def reply_keyboard(*buttons: str) -> types.ReplyKeyboardMarkup:
+    """
+    Собирает обычную клавиатуру с кнопками в одну строку
+
+    :param buttons: str
+    :return: telebot.types.ReplyKeyboardMarkup
+    """
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(*(types.KeyboardButton(text) for text in buttons))
+    return markup
+
+
+# Реестр клавиатур, используемых в ответах бота; строится один раз при импорте
+KEYBOARDS = {
+    name: FrozenKeyboard(name, markup) for name, markup in {
+        'about': reply_keyboard('О командах'),
+        'stats': reply_keyboard('Моя статистика'),
+        'new_cycle': reply_keyboard('Да, начать новый цикл', 'Оставить предыдущую запись'),
+    }.items()
+}
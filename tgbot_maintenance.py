@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from tgbot_archive import ARCHIVE_COLUMNS, merge, pack, unpack
+from tgbot_db import get_connection, transaction
+from tgbot_func import month_bounds
+from tgbot_migrations import migrate
+
+# Обслуживание базы данных бота без остановки: перенос старых записей sleep_records в сжатый архив
+## sleep_archive (tgbot_archive), возврат свободных страниц (PRAGMA incremental_vacuum) и обновление
+## статистики планировщика запросов (ANALYZE). Работа делится на короткие транзакции с паузами между ними,
+## поэтому обработчики бота ждут блокировку записи не дольше одной такой транзакции (несколько мс).
+##
+## Запуск (например, раз в сутки из cron): python tgbot_maintenance.py [run]
+##         python tgbot_maintenance.py vacuum - однократный полный VACUUM, переводящий базу, созданную
+##                                              без auto_vacuum, в режим INCREMENTAL (блокирует базу
+##                                              на все время перестройки, запускать при остановленном боте)
+
+# Записи старше ARCHIVE_AFTER_DAYS дней переносятся в архив (0 - перенос отключен), в одной транзакции
+## переносится около MAINTENANCE_ROWS записей или освобождается VACUUM_PAGES страниц, между транзакциями -
+## пауза MAINTENANCE_PAUSE мс
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+MAINTENANCE_ROWS = int(os.getenv('MAINTENANCE_ROWS', 100))
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', 500))
+MAINTENANCE_PAUSE = float(os.getenv('MAINTENANCE_PAUSE', 20)) / 1000
+## ANALYZE читает примерно столько строк каждого индекса, а не индексы целиком
+ANALYSIS_LIMIT = 1000
+## Пользователей в одном чтении кандидатов на перенос
+SCAN_USERS = 200
+
+logger = logging.getLogger('tgbot_maintenance')
+
+UPSERT_ARCHIVE = '''
+    INSERT INTO sleep_archive (user_id, month, records, data)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, month) DO UPDATE SET records = excluded.records, data = excluded.data
+'''
+
+
+@contextmanager
+def step(report: dict):
+    """
+    Одна короткая транзакция обслуживания: учитывает в report время удержания блокировки записи,
+    после фиксации переносит изменения из WAL контрольной точкой PASSIVE (она не мешает записи,
+    а автоматическая контрольная точка при фиксации удлиняла бы транзакцию в несколько раз)
+    и делает паузу, чтобы между транзакциями успевали записать обработчики
+
+    :param report: dict
+    :return: sqlite3.Connection
+    """
+    with transaction() as conn:
+        started = time.perf_counter()
+        yield conn
+    held = (time.perf_counter() - started) * 1000
+    report['transactions'] += 1
+    report['max_transaction_ms'] = round(max(report['max_transaction_ms'], held), 2)
+    conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+    time.sleep(MAINTENANCE_PAUSE)
+
+
+def archive_candidates(conn, user_ids: list, before: str) -> list:
+    """
+    Возвращает месяцы с записями для переноса [(user_id, месяц, число записей)]: записи раньше before,
+    кроме последней записи пользователя (она нужна обработчикам и кэшу сессий)
+
+    :param conn: sqlite3.Connection
+    :param user_ids: list
+    :param before: str
+    :return: list
+    """
+    return conn.execute(
+        f'''
+        SELECT r.user_id, substr(r.sleep_date, 1, 7) AS month, COUNT(*)
+        FROM sleep_records AS r
+        WHERE r.user_id IN ({", ".join("?" for _ in user_ids)}) AND r.sleep_date < ?
+          AND r.sleep_date < (SELECT MAX(sleep_date) FROM sleep_records WHERE user_id = r.user_id)
+        GROUP BY r.user_id, month
+        ''',
+        (*user_ids, before)
+    ).fetchall()
+
+
+def archive_months(months: list, before: str, report: dict):
+    """
+    Переносит записи месяцев [(user_id, месяц, ...)] в архив одной транзакцией. Записи перечитываются
+    под блокировкой и объединяются с уже заархивированными за тот же месяц: запись за дату,
+    которая уже есть в архиве, заменяет архивную (дубликаты не накапливаются)
+
+    :param months: list
+    :param before: str
+    :param report: dict
+    :return:
+    """
+    with step(report) as conn:
+        for user_id, month, _ in months:
+            start, end = month_bounds(month)
+            latest = conn.execute('SELECT MAX(sleep_date) FROM sleep_records WHERE user_id = ?',
+                                  (user_id,)).fetchone()[0]
+            end = min(end, before, latest or start)
+            records = conn.execute(
+                f'''
+                SELECT {', '.join(ARCHIVE_COLUMNS)}
+                FROM sleep_records
+                WHERE user_id = ? AND sleep_date >= ? AND sleep_date < ?
+                ''',
+                (user_id, start, end)
+            ).fetchall()
+            if not records:
+                continue
+            row = conn.execute('SELECT data FROM sleep_archive WHERE user_id = ? AND month = ?',
+                               (user_id, month)).fetchone()
+            old = unpack(row[0]) if row else []
+            merged = merge(old, records)
+            conn.execute(UPSERT_ARCHIVE, (user_id, month, len(merged), pack(merged)))
+            conn.execute('DELETE FROM sleep_records WHERE user_id = ? AND sleep_date >= ? AND sleep_date < ?',
+                         (user_id, start, end))
+            report['archived'] += len(records)
+            report['duplicates'] += len(old) + len(records) - len(merged)
+
+
+def archive_old_records(before: str, report: dict):
+    """
+    Переносит в архив записи раньше before. Кандидаты читаются без блокировки записи (WAL) по SCAN_USERS
+    пользователей, перенос идет транзакциями примерно по MAINTENANCE_ROWS записей из целых месяцев,
+    поэтому каждый месяц пользователя сжимается за один проход. Суммы sleep_rollups не меняются
+
+    :param before: str
+    :param report: dict
+    :return:
+    """
+    conn = get_connection()
+    last = -2 ** 63
+    while True:
+        user_ids = [row[0] for row in conn.execute('SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?',
+                                                   (last, SCAN_USERS))]
+        if not user_ids:
+            return
+        last = user_ids[-1]
+        batch, rows = [], 0
+        for month in archive_candidates(conn, user_ids, before):
+            batch.append(month)
+            rows += month[2]
+            if rows >= MAINTENANCE_ROWS:
+                archive_months(batch, before, report)
+                batch, rows = [], 0
+        if batch:
+            archive_months(batch, before, report)
+
+
+def incremental_vacuum(report: dict):
+    """
+    Возвращает свободные страницы файлу базы данных по VACUUM_PAGES страниц за транзакцию
+
+    :param report: dict
+    :return:
+    """
+    conn = get_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        logger.warning('База данных создана без auto_vacuum = INCREMENTAL, свободные страницы не возвращаются. '
+                       'Однократно: python tgbot_maintenance.py vacuum')
+        return
+    while True:
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free:
+            break
+        with step(report) as conn:
+            ## sqlite3 выполняет один шаг PRAGMA incremental_vacuum(N), а каждый шаг освобождает одну страницу
+            for _ in range(min(free, VACUUM_PAGES)):
+                conn.execute('PRAGMA incremental_vacuum(1)').close()
+        report['vacuumed_pages'] += min(free, VACUUM_PAGES)
+
+
+def analyze(report: dict):
+    """
+    Обновляет статистику планировщика запросов по выборке строк (analysis_limit), а не по всем индексам
+
+    :param report: dict
+    :return:
+    """
+    conn = get_connection()
+    conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+    with step(report) as conn:
+        conn.execute('ANALYZE')
+
+
+def run_maintenance(days: int = ARCHIVE_AFTER_DAYS) -> dict:
+    """
+    Выполняет обслуживание: перенос записей старше days дней в архив, возврат свободных страниц, ANALYZE.
+    Возвращает отчет: перенесено записей, заменено дубликатов, освобождено страниц, число транзакций,
+    самая долгая транзакция (мс) и общее время (сек.)
+
+    :param days: int
+    :return: dict
+    """
+    started = time.perf_counter()
+    conn = get_connection()
+    migrate(conn)
+    # Контрольные точки делает step между транзакциями
+    conn.execute('PRAGMA wal_autocheckpoint = 0')
+    report = {'archived': 0, 'duplicates': 0, 'vacuumed_pages': 0, 'transactions': 0, 'max_transaction_ms': 0}
+    try:
+        if days > 0:
+            archive_old_records((date.today() - timedelta(days=days)).isoformat(), report)
+        incremental_vacuum(report)
+        analyze(report)
+    finally:
+        conn.execute('PRAGMA wal_autocheckpoint = 1000')
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    logger.info('Обслуживание базы данных: %s', report)
+    return report
+
+
+def full_vacuum():
+    """
+    Переводит базу данных в режим auto_vacuum = INCREMENTAL полной перестройкой файла (VACUUM)
+
+    :return:
+    """
+    conn = get_connection()
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if command not in ('run', 'vacuum'):
+        sys.exit('Использование: python tgbot_maintenance.py [run|vacuum]')
+    if command == 'vacuum':
+        full_vacuum()
+    else:
+        print(json.dumps(run_maintenance(), ensure_ascii=False))
@@ -0,0 +1,350 @@
+from bisect import bisect_left
+from functools import wraps
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('tgbot_metrics')
+
+## telebot и http.server импортируются, только когда метрики включены, чтобы не замедлять импорт
+## модулей работы с базой данных
+# Метрики включаются переменной METRICS=1, портом METRICS_PORT или порогом журнала медленных обновлений
+# SLOW_UPDATE_MS; без них обработчики, соединения и запросы к API не оборачиваются
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', 0))
+ENABLED = os.getenv('METRICS') == '1' or bool(METRICS_PORT) or bool(SLOW_UPDATE_MS)
+
+## Границы корзин гистограмм (сек.)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HELP = {
+    'tgbot_update_seconds': ('histogram', 'Время обработки обновления (middleware и обработчик)'),
+    'tgbot_handler_seconds': ('histogram', 'Время работы обработчика'),
+    'tgbot_handler_errors_total': ('counter', 'Исключения в обработчиках'),
+    'tgbot_sql_seconds': ('histogram', 'Время выполнения SQL-запроса'),
+    'tgbot_sql_rows_total': ('counter', 'Строки, измененные запросами INSERT/UPDATE/DELETE'),
+    'tgbot_api_seconds': ('histogram', 'Время запроса к Telegram Bot API'),
+    'tgbot_api_errors_total': ('counter', 'Ошибки запросов к Telegram Bot API'),
+    'tgbot_slow_updates_total': ('counter', 'Обновления дольше SLOW_UPDATE_MS'),
+}
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами: число наблюдений в каждой корзине, сумма и количество
+    """
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+## Имя метрики -> {метки: Histogram или число}; метки - кортеж пар (имя, значение)
+_metrics = {name: {} for name in HELP}
+_lock = threading.Lock()
+## Показатели других компонентов (кэш, очередь отправки): имя префикса -> функция, возвращающая dict
+_gauges = {}
+## Счетчики текущего обновления в потоке обработчика - для журнала медленных обновлений
+_current = threading.local()
+
+
+def observe(name: str, labels: tuple, value: float):
+    """
+    Добавляет наблюдение в гистограмму
+
+    :param name: str
+    :param labels: tuple
+    :param value: float
+    :return:
+    """
+    with _lock:
+        histogram = _metrics[name].get(labels)
+        if histogram is None:
+            histogram = _metrics[name][labels] = Histogram()
+        histogram.observe(value)
+
+
+def inc(name: str, labels: tuple, value: float = 1):
+    """
+    Увеличивает счетчик
+
+    :param name: str
+    :param labels: tuple
+    :param value: float
+    :return:
+    """
+    with _lock:
+        _metrics[name][labels] = _metrics[name].get(labels, 0) + value
+
+
+def register_gauges(prefix: str, collect):
+    """
+    Регистрирует функцию, значения которой выводятся как показатели tgbot_<prefix>_<ключ>
+
+    :param prefix: str
+    :param collect: Callable[[], dict]
+    :return:
+    """
+    _gauges[prefix] = collect
+
+
+def format_labels(labels: tuple, extra: tuple = ()) -> str:
+    """
+    Форматирует метки в синтаксисе Prometheus
+
+    :param labels: tuple
+    :param extra: tuple
+    :return: str
+    """
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+def render() -> str:
+    """
+    Возвращает все метрики в текстовом формате Prometheus
+
+    :return: str
+    """
+    lines = []
+    with _lock:
+        for name, values in _metrics.items():
+            kind, description = HELP[name]
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for labels, value in values.items():
+                if kind == 'counter':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), value.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value.sum:.6f}')
+                lines.append(f'{name}_count{format_labels(labels)} {value.count}')
+    for prefix, collect in list(_gauges.items()):
+        for key, value in collect().items():
+            lines += [f'# TYPE tgbot_{prefix}_{key} gauge', f'tgbot_{prefix}_{key} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def reset_current():
+    _current.handler = None
+    _current.sql = 0
+    _current.sql_time = 0.0
+    _current.api = 0
+    _current.api_time = 0.0
+
+
+## Метка SQL-запроса: операция и таблица, например ('op', 'SELECT'), ('table', 'sleep_records')
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+(\w+)', re.IGNORECASE)
+_sql_labels = {}
+
+
+def sql_labels(sql: str) -> tuple:
+    """
+    Метки SQL-запроса по его тексту; тексты запросов постоянны, поэтому результат запоминается
+
+    :param sql: str
+    :return: tuple
+    """
+    labels = _sql_labels.get(sql)
+    if labels is None:
+        words = sql.split(None, 1)
+        table = _SQL_TABLE.search(sql)
+        labels = (('op', words[0].upper() if words else ''), ('table', table.group(1) if table else ''))
+        if len(_sql_labels) < 1000:
+            _sql_labels[sql] = labels
+    return labels
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Соединение, которое измеряет время каждого запроса и COMMIT и считает измененные строки
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return self._observe(sql, super().execute(sql, parameters))
+        finally:
+            self._elapsed(sql, started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return self._observe(sql, super().executemany(sql, parameters))
+        finally:
+            self._elapsed(sql, started)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self._elapsed('COMMIT', started)
+
+    @staticmethod
+    def _observe(sql: str, cursor: sqlite3.Cursor) -> sqlite3.Cursor:
+        if cursor.rowcount > 0:
+            inc('tgbot_sql_rows_total', sql_labels(sql), cursor.rowcount)
+        return cursor
+
+    @staticmethod
+    def _elapsed(sql: str, started: float):
+        elapsed = time.perf_counter() - started
+        observe('tgbot_sql_seconds', sql_labels(sql), elapsed)
+        if getattr(_current, 'handler', False) is not False:
+            _current.sql += 1
+            _current.sql_time += elapsed
+
+
+def connection_factory() -> type:
+    """
+    Класс соединения для sqlite3.connect: с измерениями, только если метрики включены
+
+    :return: type
+    """
+    return TimedConnection if ENABLED else sqlite3.Connection
+
+
+def timed_handler(function):
+    """
+    Оборачивает обработчик: время работы и исключения с меткой по имени обработчика
+
+    :param function: Callable
+    :return: Callable
+    """
+    labels = (('handler', function.__name__),)
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        _current.handler = function.__name__
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            inc('tgbot_handler_errors_total', labels)
+            raise
+        finally:
+            observe('tgbot_handler_seconds', labels, time.perf_counter() - started)
+    return wrapper
+
+
+def timed_update(run):
+    """
+    Оборачивает обработку одного обновления (middleware и обработчики); обновления дольше
+    SLOW_UPDATE_MS записываются в журнал с разбивкой на SQL и запросы к API
+
+    :param run: Callable
+    :return: Callable
+    """
+    @wraps(run)
+    def wrapper(message, *args, update_type=None, **kwargs):
+        reset_current()
+        started = time.perf_counter()
+        try:
+            return run(message, *args, update_type=update_type, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            observe('tgbot_update_seconds', (('type', update_type),), elapsed)
+            if SLOW_UPDATE_MS and elapsed * 1000 >= SLOW_UPDATE_MS:
+                inc('tgbot_slow_updates_total', (('handler', _current.handler or ''),))
+                logger.warning('Медленное обновление %s (%s): %.1f мс; SQL: %d за %.1f мс; API: %d за %.1f мс',
+                               update_type, _current.handler, elapsed * 1000, _current.sql,
+                               _current.sql_time * 1000, _current.api, _current.api_time * 1000)
+            _current.handler = False
+    return wrapper
+
+
+def timed_request(make_request):
+    """
+    Оборачивает запросы к Telegram Bot API: время и ошибки с меткой по методу
+
+    :param make_request: Callable
+    :return: Callable
+    """
+    @wraps(make_request)
+    def wrapper(token, method_name, *args, **kwargs):
+        labels = (('method', method_name),)
+        started = time.perf_counter()
+        try:
+            return make_request(token, method_name, *args, **kwargs)
+        except Exception:
+            inc('tgbot_api_errors_total', labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            observe('tgbot_api_seconds', labels, elapsed)
+            if getattr(_current, 'handler', False) is not False:
+                _current.api += 1
+                _current.api_time += elapsed
+    return wrapper
+
+
+def instrument_bot(bot, router=None):
+    """
+    Подключает измерения к боту после регистрации обработчиков. Если метрики выключены, ничего не делает.
+    Обработчики маршрутизатора (tgbot_router) измеряются по отдельности, его диспетчеры - нет
+
+    :param bot: telebot.TeleBot
+    :param router: tgbot_router.Router
+    :return:
+    """
+    if not ENABLED:
+        return
+    from telebot import apihelper
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            if router is None or getattr(handler['function'], 'router', None) is not router:
+                handler['function'] = timed_handler(handler['function'])
+    if router is not None:
+        router.wrap(timed_handler)
+    bot._run_middlewares_and_handler = timed_update(bot._run_middlewares_and_handler)
+    if not hasattr(apihelper._make_request, '__wrapped__'):
+        apihelper._make_request = timed_request(apihelper._make_request)
+
+
+def start_http_server(port: int = METRICS_PORT, host: str = '0.0.0.0'):
+    """
+    Запускает HTTP-сервер метрик в фоновом потоке (для long polling; вебхук отдает метрики сам)
+
+    :param port: int
+    :param host: str
+    :return: http.server.ThreadingHTTPServer
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != METRICS_PATH:
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Метрики доступны на %s:%s%s', host, port, METRICS_PATH)
+    return server
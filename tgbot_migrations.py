@@ -0,0 +1,267 @@
+from sqlite3 import Connection
+
+from tgbot_stats import ROLLUP_COLUMNS, rebuild_rollups
+
+# Миграции схемы базы данных бота. Номер миграции - ее позиция в списке MIGRATIONS (начиная с 1);
+## номер последней примененной миграции хранится в PRAGMA user_version.
+## Новые изменения схемы добавляются только в конец списка, уже выпущенные миграции не редактируются.
+
+
+def create_base_tables(conn: Connection):
+    """
+    Создает исходные таблицы users и sleep_records (для существующих баз ничего не меняет)
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    ## Таблица users хранит информацию о пользователях, включая их уникальные Telegram ID и имена.
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS users(
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            sleep_status INTEGER
+        );
+        '''
+    )
+    ## Таблица sleep_record хранит информацию о ежедневных записях о сне пользователей,
+    ## включая время начала и окончания сна, заметки, а также оценку качества сна.
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS sleep_records(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            sleep_date TEXT NOT NULL,
+            sleep_time TEXT,
+            wake_time TEXT,
+            duration REAL,
+            sleep_quality INTEGER,
+            note TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+        '''
+    )
+
+
+def unique_sleep_date(conn: Connection):
+    """
+    Удаляет дубликаты записей за одну дату (остается последняя сохраненная) и добавляет
+    уникальный индекс (user_id, sleep_date DESC), который также ускоряет выборку истории пользователя
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    conn.execute(
+        '''
+        DELETE FROM sleep_records
+        WHERE id NOT IN (
+            SELECT MAX(id)
+            FROM sleep_records
+            GROUP BY user_id, sleep_date
+        )
+        '''
+    )
+    conn.execute(
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS sleep_records_user_date
+        ON sleep_records (user_id, sleep_date DESC)
+        '''
+    )
+
+
+def name_updated(conn: Connection):
+    """
+    Добавляет в users время последнего обновления имени пользователя (Unix time)
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    conn.execute('ALTER TABLE users ADD COLUMN name_updated INTEGER')
+
+
+def sleep_rollups(conn: Connection):
+    """
+    Добавляет таблицу накопительных сумм для статистики и серии дней в users, заполняет их по истории
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    columns = ',\n'.join(
+        f'            {column} {"INTEGER" if column.startswith("n_") else "REAL"} NOT NULL DEFAULT 0'
+        for column in ROLLUP_COLUMNS
+    )
+    conn.execute(
+        f'''
+        CREATE TABLE IF NOT EXISTS sleep_rollups(
+            user_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+{columns},
+            PRIMARY KEY (user_id, period)
+        ) WITHOUT ROWID;
+        '''
+    )
+    conn.execute('ALTER TABLE users ADD COLUMN streak_current INTEGER')
+    conn.execute('ALTER TABLE users ADD COLUMN streak_best INTEGER')
+    conn.execute('ALTER TABLE users ADD COLUMN streak_last TEXT')
+    rebuild_rollups(conn)
+
+
+def epoch_times(conn: Connection):
+    """
+    Добавляет время отхода ко сну и пробуждения в Unix time (sleep_ts, wake_ts), заполняет их
+    по текстовым полям и создает частичный индекс незавершенных циклов
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    conn.execute('ALTER TABLE sleep_records ADD COLUMN sleep_ts INTEGER')
+    conn.execute('ALTER TABLE sleep_records ADD COLUMN wake_ts INTEGER')
+    ## Текстовое время записано в местном часовом поясе, модификатор 'utc' переводит его в UTC.
+    conn.execute(
+        '''
+        UPDATE sleep_records
+        SET sleep_ts = CAST(strftime('%s', sleep_date || ' ' || sleep_time, 'utc') AS INTEGER)
+        WHERE sleep_time IS NOT NULL
+        '''
+    )
+    ## Время пробуждения восстанавливается по продолжительности, а без нее - по тексту
+    ## (пробуждение раньше отхода ко сну означает следующий день).
+    conn.execute(
+        '''
+        UPDATE sleep_records
+        SET wake_ts = CASE
+            WHEN duration IS NOT NULL THEN sleep_ts + CAST(ROUND(duration * 3600) AS INTEGER)
+            ELSE CAST(strftime('%s', sleep_date || ' ' || wake_time, 'utc') AS INTEGER)
+                 + CASE WHEN wake_time < sleep_time THEN 86400 ELSE 0 END
+        END
+        WHERE wake_time IS NOT NULL AND sleep_ts IS NOT NULL
+        '''
+    )
+    conn.execute(
+        '''
+        CREATE INDEX IF NOT EXISTS sleep_records_open
+        ON sleep_records (user_id, sleep_ts)
+        WHERE wake_ts IS NULL AND sleep_ts IS NOT NULL
+        '''
+    )
+
+
+def reminders(conn: Connection):
+    """
+    Добавляет в users время ежедневного напоминания о сне (минуты от полуночи) и время следующей проверки
+    напоминаний (Unix time) с частичным индексом по нему. Пользователям с незавершенным циклом
+    проверка назначается на время его начала, чтобы планировщик напомнил о пробуждении или закрыл цикл
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    conn.execute('ALTER TABLE users ADD COLUMN bedtime INTEGER')
+    conn.execute('ALTER TABLE users ADD COLUMN remind_at INTEGER')
+    conn.execute(
+        '''
+        UPDATE users
+        SET remind_at = (
+            SELECT MAX(sleep_ts)
+            FROM sleep_records
+            WHERE user_id = users.id AND wake_ts IS NULL AND sleep_ts IS NOT NULL
+        )
+        WHERE sleep_status = 1
+        '''
+    )
+    conn.execute(
+        '''
+        CREATE INDEX IF NOT EXISTS users_remind_at
+        ON users (remind_at)
+        WHERE remind_at IS NOT NULL
+        '''
+    )
+
+
+def sleep_archive(conn: Connection):
+    """
+    Создает архив старых записей: записи пользователя за месяц сжаты в одну строку (tgbot_archive)
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    conn.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS sleep_archive(
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            records INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (user_id, month),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        );
+        '''
+    )
+
+
+def stale_wake_time(conn: Connection):
+    """
+    Убирает время пробуждения у автоматически закрытых циклов: оно выводилось из времени закрытия
+    (wake_ts = sleep_ts) и совпадало со временем отхода ко сну
+
+    :param conn: sqlite3.Connection
+    :return:
+    """
+    conn.execute(
+        '''
+        UPDATE sleep_records
+        SET wake_time = NULL
+        WHERE wake_ts = sleep_ts AND duration IS NULL AND wake_time IS NOT NULL
+        '''
+    )
+
+
+MIGRATIONS = [
+    create_base_tables,
+    unique_sleep_date,
+    name_updated,
+    sleep_rollups,
+    epoch_times,
+    reminders,
+    sleep_archive,
+    stale_wake_time,
+]
+
+
+def get_version(conn: Connection) -> int:
+    """
+    Возвращает номер текущей версии схемы
+
+    :param conn: sqlite3.Connection
+    :return: int
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn: Connection) -> int:
+    """
+    Применяет недостающие миграции, каждую в отдельной транзакции вместе с обновлением user_version.
+    Версия читается уже под блокировкой записи, поэтому несколько процессов могут запускать
+    миграции одновременно. Повторный вызов на актуальной базе ничего не делает
+
+    :param conn: sqlite3.Connection
+    :return: int
+    """
+    # Актуальная схема проверяется одним чтением без блокировки записи (частый случай при перезапуске)
+    if get_version(conn) == len(MIGRATIONS):
+        return len(MIGRATIONS)
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = get_version(conn)
+            if version > len(MIGRATIONS):
+                raise RuntimeError(f'Версия схемы базы данных ({version}) новее, '
+                                   f'чем поддерживает бот ({len(MIGRATIONS)}).')
+            if version == len(MIGRATIONS):
+                conn.commit()
+                return version
+            MIGRATIONS[version](conn)
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
@@ -0,0 +1,171 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger('tgbot_reminders')
+
+# Сколько проверок обрабатывается за один проход и как часто (сек.) новые времена проверок
+## записываются в базу данных
+REMINDER_BATCH = int(os.getenv('REMINDER_BATCH', 1000))
+REMINDER_FLUSH = float(os.getenv('REMINDER_FLUSH', 1))
+
+
+class ReminderScheduler:
+    """
+    Планировщик напоминаний: один поток и куча (heapq) времен проверок, по одной записи на пользователя,
+    без таймера на каждого пользователя. Наступившие проверки передаются в fire пачками до batch штук,
+    fire возвращает [(chat_id, время следующей проверки или None)]. Времена проверок хранятся
+    в базе данных: при запуске куча строится из load, изменения записываются через save пачками
+    раз в flush сек. Устаревшие записи кучи (время проверки изменилось) пропускаются при извлечении
+    """
+
+    def __init__(self, load: Callable[[int, int], list], fire: Callable[[list, int], list],
+                 save: Callable[[list], None], batch: int = REMINDER_BATCH, flush: float = REMINDER_FLUSH):
+        self.load = load
+        self.fire = fire
+        self.save = save
+        self.batch = batch
+        self.flush_interval = flush
+        self.fired = 0
+        self.closed = False
+        # Куча (время проверки, chat_id); актуальное время каждого пользователя - в _due
+        self._heap = []
+        self._due = {}
+        # Измененные, но еще не записанные времена: chat_id -> время или None
+        self._dirty = {}
+        # Пользователи, которым обработчики назначили или отменили проверку, пока пачка передана в fire
+        ## (None - пачки в обработке нет): план fire для них устарел
+        self._touched = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, shard: int = 0, shards: int = 1):
+        """
+        Загружает назначенные проверки (пользователи с chat_id % shards == shard) и запускает поток.
+        Проверки, назначенные обработчиками до запуска, новее загруженных и не заменяются
+
+        :param shard: int
+        :param shards: int
+        :return:
+        """
+        loaded = self.load(shard, shards)
+        with self._cond:
+            for chat_id, remind_at in loaded:
+                if chat_id not in self._due:
+                    self._due[chat_id] = remind_at
+                    self._heap.append((remind_at, chat_id))
+            heapq.heapify(self._heap)
+            self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+            self._thread.start()
+        logger.info('Загружено напоминаний: %s', len(loaded))
+
+    def schedule(self, chat_id: int, remind_at: int = None):
+        """
+        Назначает следующую проверку пользователя (None - отменяет)
+
+        :param chat_id: int
+        :param remind_at: int
+        :return:
+        """
+        with self._cond:
+            self._set(chat_id, remind_at)
+            if self._touched is not None:
+                self._touched.add(chat_id)
+            self._cond.notify()
+
+    def close(self, timeout: float = 10):
+        """
+        Останавливает поток и записывает несохраненные времена проверок
+
+        :param timeout: float
+        :return:
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._flush()
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики планировщика
+
+        :return: dict
+        """
+        with self._cond:
+            return {'scheduled': len(self._due), 'heap': len(self._heap), 'fired': self.fired}
+
+    def _set(self, chat_id: int, remind_at: int = None):
+        if remind_at is None:
+            self._due.pop(chat_id, None)
+        elif self._due.get(chat_id) != remind_at:
+            self._due[chat_id] = remind_at
+            heapq.heappush(self._heap, (remind_at, chat_id))
+        self._dirty[chat_id] = remind_at
+
+    def _run(self):
+        flushed = time.monotonic()
+        while True:
+            with self._cond:
+                while True:
+                    due = self._take(time.time())
+                    if due or self.closed:
+                        break
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    if self._dirty:
+                        wait = flushed + self.flush_interval - time.monotonic()
+                        if wait <= 0:
+                            break
+                        timeout = wait if timeout is None else min(timeout, wait)
+                    self._cond.wait(timeout)
+                if self.closed:
+                    return
+            if due:
+                self._process(due)
+            if time.monotonic() - flushed >= self.flush_interval:
+                self._flush()
+                flushed = time.monotonic()
+
+    def _take(self, now: float) -> list:
+        # Извлекает до batch наступивших проверок, пропуская записи, время которых уже изменилось.
+        ## Извлеченные проверки удаляются из _due до возврата fire
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch:
+            remind_at, chat_id = heapq.heappop(self._heap)
+            if self._due.get(chat_id) == remind_at:
+                del self._due[chat_id]
+                due.append((chat_id, remind_at))
+        if due:
+            self._touched = set()
+        return due
+
+    def _process(self, due: list):
+        try:
+            planned = self.fire(due, int(time.time()))
+        except Exception:
+            logger.exception('Ошибка обработки напоминаний')
+            # Повторная проверка через минуту, чтобы ошибка не повторялась в цикле
+            planned = [(chat_id, int(time.time()) + 60) for chat_id, _ in due]
+        with self._cond:
+            self.fired += len(due)
+            for chat_id, next_at in planned:
+                # Пока шла проверка, обработчик мог назначить новое время или отменить проверку - это важнее
+                if chat_id not in self._touched:
+                    self._set(chat_id, next_at)
+            self._touched = None
+
+    def _flush(self):
+        with self._cond:
+            dirty, self._dirty = self._dirty, {}
+        if dirty:
+            try:
+                self.save(list(dirty.items()))
+            except Exception:
+                logger.exception('Не удалось записать время напоминаний')
+                with self._cond:
+                    for chat_id, remind_at in dirty.items():
+                        self._dirty.setdefault(chat_id, remind_at)
@@ -0,0 +1,158 @@
+import inspect
+from typing import Callable
+
+from telebot import util
+
+
+class Router:
+    """
+    Таблицы маршрутизации обновлений вместо фильтров telebot: команды и текст кнопок - словари,
+    данные inline-кнопок - словари префиксов (по одному на длину префикса, длинные проверяются первыми).
+    telebot проверяет фильтры всех обработчиков по очереди, пока какой-нибудь не подойдет, а здесь
+    обработчик находится поиском в словаре, и время выбора не зависит от числа обработчиков.
+    Порядок выбора как у прежних фильтров: команда, точный текст, обработчик по умолчанию для типа сообщения.
+    В боте регистрируется по одному обработчику на вид обновления, middleware telebot продолжают работать.
+    telebot с use_class_middlewares вычисляет inspect.signature обработчика для каждого обновления,
+    поэтому у зарегистрированных функций сигнатура вычислена заранее (__signature__)
+    """
+
+    def __init__(self, bot=None):
+        self.commands = {}
+        self.texts = {}
+        # длина префикса -> {префикс: обработчик}
+        self.prefixes = {}
+        # тип содержимого сообщения -> обработчик по умолчанию
+        self.defaults = {}
+        if bot is not None:
+            self.attach(bot)
+
+    def attach(self, bot):
+        """
+        Регистрирует в боте обработчики, передающие сообщения и нажатия inline-кнопок маршрутизатору
+
+        :param bot: telebot.TeleBot
+        :return:
+        """
+        # Тип содержимого проверяет сам маршрутизатор, поэтому фильтр telebot пропускает все сообщения
+        bot.register_message_handler(self.dispatcher(self.route_message), content_types=util.content_type_media)
+        bot.register_callback_query_handler(self.dispatcher(self.route_callback), func=None)
+
+    def dispatcher(self, route: Callable) -> Callable:
+        """
+        Возвращает функцию для регистрации в боте: выбирает обработчик через route и вызывает его
+
+        :param route: Callable
+        :return: Callable
+        """
+        def dispatch(update):
+            handler = route(update)
+            if handler is not None:
+                return handler(update)
+
+        dispatch.__signature__ = inspect.signature(dispatch)
+        # По этой ссылке instrument_bot отличает диспетчеры от обычных обработчиков
+        dispatch.router = self
+        return dispatch
+
+    def command(self, *names: str):
+        """
+        Декоратор обработчика команд (без '/')
+
+        :param names: str
+        :return: Callable
+        """
+        def decorator(function: Callable) -> Callable:
+            for name in names:
+                self.commands[name] = function
+            return function
+        return decorator
+
+    def text(self, *values: str):
+        """
+        Декоратор обработчика сообщений с точным текстом (кнопки клавиатуры)
+
+        :param values: str
+        :return: Callable
+        """
+        def decorator(function: Callable) -> Callable:
+            for value in values:
+                self.texts[value] = function
+            return function
+        return decorator
+
+    def callback(self, prefix: str):
+        """
+        Декоратор обработчика нажатий inline-кнопок, данные которых начинаются с prefix
+
+        :param prefix: str
+        :return: Callable
+        """
+        def decorator(function: Callable) -> Callable:
+            self.prefixes.setdefault(len(prefix), {})[prefix] = function
+            self.prefixes = dict(sorted(self.prefixes.items(), reverse=True))
+            return function
+        return decorator
+
+    def default(self, content_type: str = 'text'):
+        """
+        Декоратор обработчика остальных сообщений с типом содержимого content_type
+
+        :param content_type: str
+        :return: Callable
+        """
+        def decorator(function: Callable) -> Callable:
+            self.defaults[content_type] = function
+            return function
+        return decorator
+
+    def route_message(self, message):
+        """
+        Возвращает обработчик сообщения или None
+
+        :param message: telebot.types.Message
+        :return: Callable | None
+        """
+        if message.content_type == 'text':
+            text = message.text
+            if text.startswith('/'):
+                # Как util.extract_command: первое слово без '/' и без имени бота после '@'
+                handler = self.commands.get(text.split(maxsplit=1)[0][1:].split('@', 1)[0])
+                if handler is not None:
+                    return handler
+            handler = self.texts.get(text)
+            if handler is not None:
+                return handler
+        return self.defaults.get(message.content_type)
+
+    def route_callback(self, call):
+        """
+        Возвращает обработчик нажатия inline-кнопки или None
+
+        :param call: telebot.types.CallbackQuery
+        :return: Callable | None
+        """
+        data = call.data or ''
+        for length, handlers in self.prefixes.items():
+            handler = handlers.get(data[:length])
+            if handler is not None:
+                return handler
+        return None
+
+    def wrap(self, decorator: Callable):
+        """
+        Оборачивает все обработчики (например, измерением времени); обработчик,
+        зарегистрированный под несколькими ключами, оборачивается один раз
+
+        :param decorator: Callable
+        :return:
+        """
+        wrapped = {}
+
+        def replace(table: dict):
+            for key, function in table.items():
+                if id(function) not in wrapped:
+                    wrapped[id(function)] = decorator(function)
+                table[key] = wrapped[id(function)]
+
+        for table in (self.commands, self.texts, self.defaults, *self.prefixes.values()):
+            replace(table)
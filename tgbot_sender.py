@@ -0,0 +1,276 @@
+from collections import OrderedDict, deque
+import logging
+import os
+import queue
+import threading
+import time
+
+import telebot
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger('tgbot_sender')
+
+# Ограничения Telegram: около 30 сообщений в секунду всего и около 1 в секунду в один чат
+SENDER_WORKERS = int(os.getenv('SENDER_WORKERS', 4))
+SENDER_GLOBAL_RATE = float(os.getenv('SENDER_GLOBAL_RATE', 30))
+SENDER_CHAT_RATE = float(os.getenv('SENDER_CHAT_RATE', 1))
+SENDER_CHAT_BURST = int(os.getenv('SENDER_CHAT_BURST', 3))
+SENDER_LINGER = float(os.getenv('SENDER_LINGER', 0.005))
+SENDER_RETRIES = 5
+
+MAX_TEXT = 4096
+
+
+class TokenBucket:
+    """
+    Ведро токенов: не более rate отправок в секунду с запасом capacity
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """
+        Забирает токен. Возвращает время ожидания (сек.), после которого можно отправлять
+
+        :return: float
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def idle(self, now: float) -> bool:
+        """
+        Проверяет, что ведро снова полное и без паузы, то есть не отличается от нового
+
+        :param now: float
+        :return: bool
+        """
+        with self.lock:
+            return now >= max(self.paused_until, self.updated + (self.capacity - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Запрещает отправку на seconds секунд (ответ 429 от Telegram)
+
+        :param seconds: float
+        :return:
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class OutgoingMessage:
+    """
+    Запрос в очереди отправки: новое сообщение ('send'), изменение текста сообщения target ('edit')
+    или ответ на нажатие inline-кнопки с идентификатором target ('answer')
+    """
+    __slots__ = ('text', 'reply_markup', 'reply_to', 'kind', 'target', 'queued')
+
+    def __init__(self, text: str, reply_markup=None, reply_to: int = None, kind: str = 'send', target=None):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.reply_to = reply_to
+        self.kind = kind
+        self.target = target
+        self.queued = time.monotonic()
+
+
+class MessageSender:
+    """
+    Очередь исходящих сообщений. Обработчики ставят ответы в очередь и сразу завершаются,
+    а рабочие потоки отправляют их с учетом лимитов: общего и для каждого чата (ответы на нажатия
+    inline-кнопок - только общего). Запросы одного чата уходят по порядку; подряд идущие сообщения
+    без клавиатуры объединяются со следующим в один запрос
+    """
+
+    def __init__(self, bot: telebot.TeleBot, workers: int = SENDER_WORKERS):
+        self.bot = bot
+        self.global_bucket = TokenBucket(SENDER_GLOBAL_RATE, SENDER_GLOBAL_RATE)
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+        # chat_id -> очередь сообщений; чат находится в ready, пока его очередь не пуста
+        self._chats = {}
+        # chat_id -> ведро токенов чата в порядке последней отправки (LRU). Ведро переживает опустевшую
+        ## очередь и удаляется, только когда снова наполнилось, иначе лимит чата обнулялся бы
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = queue.Queue()
+        self._unfinished = 0
+        self._idle = threading.Condition(self._lock)
+        self._threads = [threading.Thread(target=self._work, name=f'sender-{i}', daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def send(self, chat_id: int, text: str, reply_markup=None, reply_to: int = None):
+        """
+        Ставит сообщение в очередь отправки
+
+        :param chat_id: int
+        :param text: str
+        :param reply_markup: клавиатура
+        :param reply_to: int
+        :return:
+        """
+        self._put(chat_id, OutgoingMessage(text, reply_markup, reply_to))
+
+    def edit(self, chat_id: int, message_id: int, text: str, reply_markup=None):
+        """
+        Ставит в очередь изменение текста и клавиатуры отправленного сообщения
+
+        :param chat_id: int
+        :param message_id: int
+        :param text: str
+        :param reply_markup: клавиатура
+        :return:
+        """
+        self._put(chat_id, OutgoingMessage(text, reply_markup, kind='edit', target=message_id))
+
+    def answer_callback(self, call: types.CallbackQuery, text: str = None):
+        """
+        Ставит в очередь ответ на нажатие inline-кнопки (убирает индикатор загрузки у кнопки)
+
+        :param call: telebot.types.CallbackQuery
+        :param text: str
+        :return:
+        """
+        self._put(call.message.chat.id, OutgoingMessage(text, kind='answer', target=call.id))
+
+    def _put(self, chat_id: int, message: OutgoingMessage):
+        with self._lock:
+            self._unfinished += 1
+            chat_queue = self._chats.get(chat_id)
+            if chat_queue is None:
+                chat_queue = self._chats[chat_id] = deque()
+                self._touch_bucket(chat_id)
+            chat_queue.append(message)
+            if len(chat_queue) == 1:
+                self._ready.put(chat_id)
+
+    def reply_to(self, message: types.Message, text: str, reply_markup=None):
+        """
+        Ставит в очередь ответ на сообщение
+
+        :param message: telebot.types.Message
+        :param text: str
+        :param reply_markup: клавиатура
+        :return:
+        """
+        self.send(message.chat.id, text, reply_markup, reply_to=message.message_id)
+
+    def join(self, timeout: float = None) -> bool:
+        """
+        Ожидает отправки всех сообщений в очереди
+
+        :param timeout: float
+        :return: bool
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def _work(self):
+        while True:
+            chat_id = self._ready.get()
+            with self._lock:
+                chat_queue, chat_bucket = self._chats[chat_id], self._buckets[chat_id]
+                first = chat_queue[0]
+            # Небольшая задержка, чтобы успели прийти остальные сообщения того же ответа
+            linger = first.queued + SENDER_LINGER - time.monotonic()
+            if linger > 0:
+                time.sleep(linger)
+
+            with self._lock:
+                message, count = merge(chat_queue)
+            self._deliver(chat_id, message, chat_bucket)
+
+            with self._idle:
+                for _ in range(count):
+                    chat_queue.popleft()
+                self._unfinished -= count
+                self.merged += count - 1
+                if chat_queue:
+                    self._ready.put(chat_id)
+                else:
+                    del self._chats[chat_id]
+                    self._idle.notify_all()
+
+    def _touch_bucket(self, chat_id: int):
+        # Вызывается под self._lock: возвращает ведро чата в конец LRU (или создает его) и удаляет
+        ## с начала наполнившиеся ведра чатов без сообщений в очереди
+        bucket = self._buckets.pop(chat_id, None)
+        self._buckets[chat_id] = bucket or TokenBucket(SENDER_CHAT_RATE, SENDER_CHAT_BURST)
+        now = time.monotonic()
+        while self._buckets:
+            oldest, oldest_bucket = next(iter(self._buckets.items()))
+            if oldest in self._chats or not oldest_bucket.idle(now):
+                break
+            del self._buckets[oldest]
+
+    def _deliver(self, chat_id: int, message: OutgoingMessage, chat_bucket: TokenBucket):
+        for attempt in range(SENDER_RETRIES):
+            # Ответы на нажатия кнопок не сообщения чата и не расходуют его лимит
+            wait = self.global_bucket.take()
+            if message.kind != 'answer':
+                wait = max(wait, chat_bucket.take())
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if message.kind == 'answer':
+                    self.bot.answer_callback_query(message.target, message.text)
+                elif message.kind == 'edit':
+                    self.bot.edit_message_text(message.text, chat_id, message.target, reply_markup=message.reply_markup)
+                else:
+                    reply_parameters = types.ReplyParameters(message.reply_to) if message.reply_to else None
+                    self.bot.send_message(chat_id, message.text, reply_markup=message.reply_markup,
+                                          reply_parameters=reply_parameters)
+                self.sent += 1
+                return
+            except ApiTelegramException as e:
+                if e.error_code != 429:
+                    logger.error('Сообщение в чат %s не отправлено: %s', chat_id, e)
+                    break
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                # Лимит сообщений чата (например, в минуту для групп) останавливает только этот чат;
+                ## ответ на нажатие кнопки не относится к чату, и его 429 - общий лимит бота
+                if message.kind == 'answer':
+                    self.global_bucket.pause(retry_after)
+                else:
+                    chat_bucket.pause(retry_after)
+            except Exception as e:
+                logger.warning('Ошибка отправки в чат %s (попытка %s): %s', chat_id, attempt + 1, e)
+                time.sleep(2 ** attempt * 0.1)
+        self.failed += 1
+
+
+def merge(chat_queue: deque) -> tuple:
+    """
+    Объединяет сообщения из начала очереди чата: текст без клавиатуры и без ответа на сообщение
+    присоединяется к следующему (изменения и ответы на нажатия кнопок не объединяются).
+    Возвращает итоговое сообщение и число объединенных сообщений
+
+    :param chat_queue: deque
+    :return: tuple
+    """
+    message = chat_queue[0]
+    count = 1
+    while (count < len(chat_queue) and message.kind == 'send' and chat_queue[count].kind == 'send'
+           and message.reply_markup is None
+           and chat_queue[count].reply_to == message.reply_to
+           and len(message.text) + len(chat_queue[count].text) + 1 <= MAX_TEXT):
+        following = chat_queue[count]
+        merged = OutgoingMessage(message.text + '\n' + following.text, following.reply_markup, message.reply_to)
+        merged.queued = message.queued
+        message = merged
+        count += 1
+    return message, count
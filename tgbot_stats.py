@@ -0,0 +1,297 @@
+from datetime import date, timedelta
+from functools import lru_cache
+from itertools import groupby
+import math
+from operator import itemgetter
+from sqlite3 import Connection
+
+from tgbot_archive import archived_records, merge
+
+# Накопительные суммы по периодам (sleep_rollups): за все время ('A'), за месяц ('M2026-10')
+## и за ISO-неделю ('W2026-42'). При сохранении цикла вклад старой версии записи вычитается,
+## а новой - прибавляется, поэтому сводка считается из нескольких строк без чтения истории.
+ROLLUP_COLUMNS = (
+    'n_duration', 'sum_duration', 'sum_duration_sq',
+    'n_quality', 'sum_quality', 'sum_quality_sq',
+    'n_pair', 'sum_bed', 'sum_bed_sq', 'sum_pair_quality', 'sum_pair_quality_sq', 'sum_bed_quality'
+)
+ZERO = (0,) * len(ROLLUP_COLUMNS)
+
+UPSERT_ROLLUP = '''
+    INSERT INTO sleep_rollups (user_id, period, {columns})
+    VALUES (?, ?, {placeholders})
+    ON CONFLICT (user_id, period) DO UPDATE SET {updates}
+'''.format(
+    columns=', '.join(ROLLUP_COLUMNS),
+    placeholders=', '.join('?' for _ in ROLLUP_COLUMNS),
+    updates=', '.join(f'{column} = {column} + excluded.{column}' for column in ROLLUP_COLUMNS)
+)
+
+
+def bedtime_hours(sleep_time: str):
+    """
+    Переводит время отхода ко сну 'HH:MM:SS' в часы относительно полуночи: 23:30 -> -0.5, 01:00 -> 1.0
+
+    :param sleep_time: str
+    :return: float | None
+    """
+    if not sleep_time:
+        return None
+    try:
+        hours, minutes = int(sleep_time[:2]), int(sleep_time[3:5])
+    except ValueError:
+        return None
+    value = hours + minutes / 60
+    return value - 24 if value >= 12 else value
+
+
+def contribution(sleep_time: str, duration: float, quality: int) -> tuple:
+    """
+    Возвращает вклад одной записи о сне в суммы ROLLUP_COLUMNS
+
+    :param sleep_time: str
+    :param duration: float
+    :param quality: int
+    :return: tuple
+    """
+    values = [0] * len(ROLLUP_COLUMNS)
+    if duration is not None:
+        values[0:3] = 1, duration, duration * duration
+    if quality:
+        values[3:6] = 1, quality, quality * quality
+        bed = bedtime_hours(sleep_time)
+        if bed is not None:
+            values[6:12] = 1, bed, bed * bed, quality, quality * quality, bed * quality
+    return tuple(values)
+
+
+@lru_cache(maxsize=4096)
+def periods(sleep_date: str) -> tuple:
+    """
+    Возвращает ключи периодов, в которые попадает дата (результат запоминается: даты повторяются у всех пользователей)
+
+    :param sleep_date: str
+    :return: tuple
+    """
+    year, week, _ = date.fromisoformat(sleep_date).isocalendar()
+    return 'A', f'M{sleep_date[:7]}', f'W{year:04d}-{week:02d}'
+
+
+def update_rollups(conn: Connection, chat_id: int, sleep_date: str, old: tuple, new: tuple):
+    """
+    Обновляет суммы и серию дней при сохранении записи. old и new - (sleep_time, duration, quality)
+    до и после сохранения; old равен None, если записи за дату еще не было
+
+    :param conn: sqlite3.Connection
+    :param chat_id: int
+    :param sleep_date: str
+    :param old: tuple
+    :param new: tuple
+    :return:
+    """
+    before = contribution(*old) if old else ZERO
+    delta = tuple(n - o for n, o in zip(contribution(*new), before))
+    if any(delta):
+        for period in periods(sleep_date):
+            conn.execute(UPSERT_ROLLUP, (chat_id, period) + delta)
+    if old is None:
+        update_streak(conn, chat_id, sleep_date)
+
+
+def update_streak(conn: Connection, chat_id: int, sleep_date: str):
+    """
+    Продлевает серию дней подряд с записями о сне при появлении записи за новую дату
+
+    :param conn: sqlite3.Connection
+    :param chat_id: int
+    :param sleep_date: str
+    :return:
+    """
+    row = conn.execute(
+        'SELECT streak_current, streak_best, streak_last FROM users WHERE id = ?',
+        (chat_id,)
+    ).fetchone()
+    streak = next_streak(row, sleep_date) if row else None
+    if streak:
+        conn.execute(
+            'UPDATE users SET streak_current = ?, streak_best = ?, streak_last = ? WHERE id = ?',
+            streak + (chat_id,)
+        )
+
+
+def next_streak(streak: tuple, sleep_date: str):
+    """
+    Возвращает новую серию (текущая, рекорд, последняя дата) после записи за sleep_date
+    или None, если дата не новее последней и серия не меняется
+
+    :param streak: tuple
+    :param sleep_date: str
+    :return: tuple | None
+    """
+    current, best, last = streak
+    if last is not None and sleep_date <= last:
+        return None
+    if last is not None and date.fromisoformat(sleep_date) - date.fromisoformat(last) == timedelta(days=1):
+        current = (current or 0) + 1
+    else:
+        current = 1
+    return current, max(best or 0, current), sleep_date
+
+
+def user_rollups(records: list) -> tuple:
+    """
+    Считает суммы по периодам и серию дней по всем записям пользователя (sleep_date, sleep_time, duration, quality),
+    упорядоченным по дате. Возвращает ({период: суммы}, (текущая серия, рекорд, последняя дата))
+
+    :param records: list
+    :return: tuple
+    """
+    # Вклады записей группируются по периодам и складываются по колонкам в конце
+    groups = {}
+    streak = (None, None, None)
+    for sleep_date, sleep_time, duration, quality in records:
+        values = contribution(sleep_time, duration, quality)
+        if any(values):
+            for period in periods(sleep_date):
+                groups.setdefault(period, []).append(values)
+        streak = next_streak(streak, sleep_date) or streak
+    return {period: [sum(column) for column in zip(*rows)] for period, rows in groups.items()}, streak
+
+
+def rebuild_rollups(conn: Connection, user_ids: list = None):
+    """
+    Пересчитывает суммы и серии дней по записям sleep_records и архива sleep_archive: всех пользователей
+    или только user_ids. Записи читаются потоком, суммы каждого пользователя считаются в памяти
+    и записываются пачками. Последняя запись пользователя не архивируется, поэтому пользователи
+    с архивом всегда есть в sleep_records
+
+    :param conn: sqlite3.Connection
+    :param user_ids: list
+    :return:
+    """
+    params = tuple(user_ids) if user_ids is not None else ()
+    where = f'IN ({", ".join("?" for _ in params)})' if user_ids is not None else 'IS NOT NULL'
+    conn.execute(f'DELETE FROM sleep_rollups WHERE user_id {where}', params)
+    conn.execute(f'UPDATE users SET streak_current = NULL, streak_best = NULL, streak_last = NULL WHERE id {where}',
+                 params)
+    # Порядок индекса (user_id, sleep_date DESC): записи пользователя идут подряд от новых к старым
+    rows = conn.execute(
+        f'''
+        SELECT user_id, sleep_date, sleep_time, duration, sleep_quality
+        FROM sleep_records
+        WHERE user_id {where}
+        ORDER BY user_id, sleep_date DESC
+        ''',
+        params
+    )
+    # Миграция sleep_rollups пересчитывает суммы раньше, чем появляется архив
+    archived = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sleep_archive'").fetchone()
+    rollups, streaks = [], []
+    for user_id, records in groupby(rows, key=itemgetter(0)):
+        records = [record[1:] for record in records][::-1]
+        if archived:
+            ## Запись за дату, загруженную заново после переноса в архив, важнее архивной
+            records = merge([(record[0], record[1], record[3], record[4])
+                             for record in archived_records(conn, user_id)], records)
+        sums, streak = user_rollups(records)
+        rollups += [(user_id, period) + tuple(total) for period, total in sums.items()]
+        streaks.append(streak + (user_id,))
+        if len(rollups) >= 10000:
+            write_rollups(conn, rollups, streaks)
+            rollups, streaks = [], []
+    write_rollups(conn, rollups, streaks)
+
+
+def write_rollups(conn: Connection, rollups: list, streaks: list):
+    """
+    Записывает пересчитанные суммы [(user_id, период, суммы...)] и серии [(текущая, рекорд, последняя дата, user_id)]
+
+    :param conn: sqlite3.Connection
+    :param rollups: list
+    :param streaks: list
+    :return:
+    """
+    conn.executemany(UPSERT_ROLLUP, rollups)
+    conn.executemany('UPDATE users SET streak_current = ?, streak_best = ?, streak_last = ? WHERE id = ?', streaks)
+
+
+def summarize(row: tuple) -> dict:
+    """
+    Считает средние, стандартные отклонения и корреляцию по строке sleep_rollups
+
+    :param row: tuple
+    :return: dict
+    """
+    sums = dict(zip(ROLLUP_COLUMNS, row))
+    summary = {'nights': sums['n_duration'], 'rated': sums['n_quality']}
+    for name, count, total, squares in (
+            ('duration', sums['n_duration'], sums['sum_duration'], sums['sum_duration_sq']),
+            ('quality', sums['n_quality'], sums['sum_quality'], sums['sum_quality_sq'])):
+        if count:
+            mean = total / count
+            summary[name] = round(mean, 2)
+            summary[name + '_std'] = round(math.sqrt(max(squares / count - mean * mean, 0)), 2)
+        else:
+            summary[name] = summary[name + '_std'] = None
+
+    n = sums['n_pair']
+    covariance = n * sums['sum_bed_quality'] - sums['sum_bed'] * sums['sum_pair_quality']
+    spread = ((n * sums['sum_bed_sq'] - sums['sum_bed'] ** 2)
+              * (n * sums['sum_pair_quality_sq'] - sums['sum_pair_quality'] ** 2))
+    summary['bedtime_quality_corr'] = round(covariance / math.sqrt(spread), 2) if n >= 3 and spread > 0 else None
+    return summary
+
+
+def build_summary(rollups: dict, streak: tuple, today: str) -> dict:
+    """
+    Собирает сводку сна за текущую неделю, текущий месяц и все время из накопительных сумм
+    {период: суммы} и серии (текущая, рекорд, последняя дата)
+
+    :param rollups: dict
+    :param streak: tuple
+    :param today: str
+    :return: dict
+    """
+    keys = dict(zip(('all', 'month', 'week'), periods(today)))
+    summary = {name: summarize(rollups.get(key, ZERO)) for name, key in keys.items()}
+
+    current, best, last = streak
+    # Серия прервана, если последняя запись старше вчерашнего дня
+    if last is None or date.fromisoformat(today) - date.fromisoformat(last) > timedelta(days=1):
+        current = 0
+    summary['streak'] = current or 0
+    summary['best_streak'] = best or 0
+    return summary
+
+
+def format_summary(summary: dict) -> str:
+    """
+    Формирует текст сводки для пользователя
+
+    :param summary: dict
+    :return: str
+    """
+    lines = []
+    for name, title in (('week', 'За неделю'), ('month', 'За месяц'), ('all', 'За все время')):
+        part = summary[name]
+        if not part['nights'] and not part['rated']:
+            continue
+        text = f'{title}: ночей {part["nights"]}'
+        if part['duration'] is not None:
+            text += f', сон {part["duration"]} ± {part["duration_std"]} ч'
+        if part['quality'] is not None:
+            text += f', качество {part["quality"]} ± {part["quality_std"]}'
+        lines.append(text)
+    lines.append(f'Серия дней с записями: {summary["streak"]} (рекорд: {summary["best_streak"]})')
+    correlation = summary['all']['bedtime_quality_corr']
+    if correlation is not None:
+        lines.append(f'Связь времени отхода ко сну с качеством: {correlation} '
+                     '(меньше нуля - чем раньше ложишься, тем лучше спишь)')
+    # Динамика от старых периодов к новым; один период повторял бы строку за неделю или месяц
+    for name, title in (('weeks', 'По неделям'), ('months', 'По месяцам')):
+        trend = summary.get(name) or []
+        if len(trend) > 1:
+            lines.append(f'{title} (сон, ч / качество): ' + ', '.join(
+                f'{part["period"]}: {"-" if part["duration"] is None else part["duration"]}'
+                f' / {"-" if part["quality"] is None else part["quality"]}' for part in reversed(trend)))
+    return '\n'.join(lines)
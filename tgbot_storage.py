@@ -0,0 +1,700 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+import os
+import threading
+
+from tgbot_archive import archived_date_before, archived_date_from, archived_dates, archived_record
+from tgbot_db import GroupCommitWriter, create_writer, get_connection, transaction
+from tgbot_migrations import migrate
+from tgbot_stats import ROLLUP_COLUMNS, ZERO, contribution, next_streak, periods, update_rollups
+from tgbot_user import Cycle
+
+# Хранилище данных бота выбирается переменной окружения STORAGE: sqlite (по умолчанию) или memory
+STORAGE = os.getenv('STORAGE', 'sqlite')
+## Не больше стольких chat_id в одном запросе состояний для напоминаний
+REMINDER_CHUNK = 500
+
+
+class Storage(ABC):
+    """
+    Интерфейс хранилища пользователей, циклов сна и статистики. Все функции tgbot_func работают
+    через него, поэтому обработчики не зависят от конкретной базы данных. Методы абстрактные:
+    хранилище, в котором реализованы не все, не создается
+    """
+
+    # Пользователи
+    @abstractmethod
+    def get_user(self, chat_id: int):
+        """
+        Возвращает (имя, статус сна, дата последнего цикла, последний цикл) или None для нового пользователя
+
+        :param chat_id: int
+        :return: tuple | None
+        """
+
+    @abstractmethod
+    def add_user(self, chat_id: int, name: str, now: int):
+        """
+        Добавляет пользователя
+
+        :param chat_id: int
+        :param name: str
+        :param now: int
+        :return:
+        """
+
+    @abstractmethod
+    def get_name(self, chat_id: int):
+        """
+        Возвращает сохраненное имя пользователя или None
+
+        :param chat_id: int
+        :return: str | None
+        """
+
+    @abstractmethod
+    def update_name(self, chat_id: int, name: str, now: int, stale_before: int):
+        """
+        Записывает имя, если оно изменилось или сверялось раньше stale_before. Запись может выполняться
+        в фоне: вызов не ждет ее фиксации
+
+        :param chat_id: int
+        :param name: str
+        :param now: int
+        :param stale_before: int
+        :return:
+        """
+
+    @abstractmethod
+    def get_sleep_status(self, chat_id: int):
+        """
+        Возвращает статус сна пользователя или None, если пользователя нет
+
+        :param chat_id: int
+        :return: int | None
+        """
+
+    # Циклы
+    @abstractmethod
+    def get_cycle(self, chat_id: int, cycle_date: str):
+        """
+        Возвращает цикл за дату или None
+
+        :param chat_id: int
+        :param cycle_date: str
+        :return: Cycle | None
+        """
+
+    @abstractmethod
+    def get_open_cycle(self, chat_id: int):
+        """
+        Возвращает (дата, время начала) последнего незавершенного цикла или None
+
+        :param chat_id: int
+        :return: tuple | None
+        """
+
+    @abstractmethod
+    def save(self, chat_id: int, cycles: list, status: int = None):
+        """
+        Атомарно сохраняет циклы [(дата, значения)], обновляет статистику и, если status не None, статус сна.
+        Значения: (sleep_time, wake_time, duration, quality, notes, sleep_ts, wake_ts)
+
+        :param chat_id: int
+        :param cycles: list
+        :param status: int
+        :return:
+        """
+
+    @abstractmethod
+    def get_dates(self, chat_id: int, start: str, end: str) -> list:
+        """
+        Возвращает даты циклов в интервале [start, end) по убыванию
+
+        :param chat_id: int
+        :param start: str
+        :param end: str
+        :return: list
+        """
+
+    @abstractmethod
+    def get_date_before(self, chat_id: int, cycle_date: str = None):
+        """
+        Возвращает ближайшую дату цикла раньше cycle_date (последнюю, если cycle_date None)
+
+        :param chat_id: int
+        :param cycle_date: str
+        :return: str | None
+        """
+
+    @abstractmethod
+    def get_date_from(self, chat_id: int, cycle_date: str):
+        """
+        Возвращает ближайшую дату цикла не раньше cycle_date
+
+        :param chat_id: int
+        :param cycle_date: str
+        :return: str | None
+        """
+
+    # Статистика
+    @abstractmethod
+    def get_rollups(self, chat_id: int, keys: tuple) -> dict:
+        """
+        Возвращает накопительные суммы по периодам: {период: кортеж ROLLUP_COLUMNS}
+
+        :param chat_id: int
+        :param keys: tuple
+        :return: dict
+        """
+
+    @abstractmethod
+    def get_trend(self, chat_id: int, kind: str, limit: int) -> list:
+        """
+        Возвращает [(период, суммы)] для последних limit периодов вида kind ('M' или 'W')
+
+        :param chat_id: int
+        :param kind: str
+        :param limit: int
+        :return: list
+        """
+
+    @abstractmethod
+    def get_streak(self, chat_id: int) -> tuple:
+        """
+        Возвращает (текущая серия, рекорд, дата последней записи)
+
+        :param chat_id: int
+        :return: tuple
+        """
+
+    # Напоминания
+    @abstractmethod
+    def get_reminders(self, shard: int = 0, shards: int = 1) -> list:
+        """
+        Возвращает [(chat_id, время проверки)] всех назначенных проверок напоминаний
+        для пользователей с chat_id % shards == shard
+
+        :param shard: int
+        :param shards: int
+        :return: list
+        """
+
+    @abstractmethod
+    def get_reminder_states(self, chat_ids: list) -> dict:
+        """
+        Возвращает {chat_id: (статус сна, время напоминания о сне, время начала незавершенного цикла)}
+
+        :param chat_ids: list
+        :return: dict
+        """
+
+    @abstractmethod
+    def set_reminders(self, reminders: list):
+        """
+        Записывает время следующей проверки [(chat_id, время или None)]
+
+        :param reminders: list
+        :return:
+        """
+
+    @abstractmethod
+    def set_bedtime(self, chat_id: int, bedtime: int = None):
+        """
+        Записывает время ежедневного напоминания о сне (минуты от полуночи) или отключает его (None)
+
+        :param chat_id: int
+        :param bedtime: int
+        :return:
+        """
+
+    def close(self):
+        """
+        Завершает работу хранилища: дописывает отложенные изменения
+
+        :return:
+        """
+
+
+class SQLiteStorage(Storage):
+    """
+    Хранилище в SQLite: соединение на поток (tgbot_db), WAL, короткие транзакции и индексы из tgbot_migrations.
+    Даты и циклы для выбора даты статистики ищутся и в архиве старых месяцев (tgbot_archive)
+    """
+
+    def __init__(self):
+        migrate(get_connection())
+        # Поток-писатель для режимов batched и async (DB_DURABILITY); в режиме sync запись идет в потоке вызова
+        self.writer = create_writer()
+        # Фоновые изменения (write_later) не ждут фиксации ни в каком режиме; в режиме sync для них свой писатель
+        self.background = self.writer or GroupCommitWriter(wait_commit=False)
+
+    def reader(self, chat_id: int):
+        """
+        Соединение для чтения; в режиме async сначала дожидается фиксации изменений пользователя
+
+        :param chat_id: int
+        :return: sqlite3.Connection
+        """
+        if self.writer:
+            self.writer.wait(chat_id)
+        return get_connection()
+
+    def write(self, chat_id: int, function, *args):
+        """
+        Выполняет изменение function(conn, *args) в транзакции: через поток-писатель или сразу
+
+        :param chat_id: int
+        :param function: Callable
+        :return:
+        """
+        if self.writer:
+            self.writer.submit(chat_id, function, *args)
+        else:
+            with transaction() as conn:
+                function(conn, *args)
+
+    def write_later(self, key, function, *args):
+        """
+        Ставит изменение function(conn, *args) в очередь потока-писателя и сразу возвращается.
+        Чтение по chat_id этого изменения не ждет, поэтому ключ должен отличаться от chat_id
+
+        :param key: ключ изменения
+        :param function: Callable
+        :return:
+        """
+        self.background.submit(key, function, *args, wait=False)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.background is not self.writer:
+            self.background.close()
+
+    def get_user(self, chat_id: int):
+        row = self.reader(chat_id).execute(
+            '''
+            SELECT u.name, u.sleep_status, r.sleep_date,
+                   r.sleep_time, r.wake_time, r.duration, r.sleep_quality, r.note, r.sleep_ts, r.wake_ts
+            FROM users AS u
+            LEFT JOIN sleep_records AS r
+                ON r.id = (SELECT id FROM sleep_records WHERE user_id = u.id ORDER BY sleep_date DESC LIMIT 1)
+            WHERE u.id = ?
+            ''',
+            (chat_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], Cycle(*row[3:]) if row[2] is not None else None
+
+    def add_user(self, chat_id: int, name: str, now: int):
+        self.write(chat_id, self.insert_user, chat_id, name, now)
+
+    @staticmethod
+    def insert_user(conn, chat_id: int, name: str, now: int):
+        conn.execute(
+            """
+            INSERT INTO users (id, name, sleep_status, name_updated) 
+            VALUES (?, ?, ?, ?);
+            """,
+            (chat_id, name, 0, now if name else None)
+        )
+
+    def get_name(self, chat_id: int):
+        result = self.reader(chat_id).execute('SELECT name FROM users WHERE id = ?', (chat_id,)).fetchone()
+        return result[0] if result else None
+
+    def update_name(self, chat_id: int, name: str, now: int, stale_before: int):
+        # Имя - необязательное обновление: обработчик не ждет его фиксации, а чтение его не ждет
+        self.write_later(('name', chat_id), self.set_name, chat_id, name, now, stale_before)
+
+    @staticmethod
+    def set_name(conn, chat_id: int, name: str, now: int, stale_before: int):
+        conn.execute(
+            '''
+            UPDATE users
+            SET name = ?, name_updated = ?
+            WHERE id = ? AND (name IS NOT ? OR name_updated IS NULL OR name_updated < ?)
+            ''',
+            (name, now, chat_id, name, stale_before)
+        )
+
+    def get_sleep_status(self, chat_id: int):
+        result = self.reader(chat_id).execute(
+            '''
+            SELECT sleep_status 
+            FROM users
+            WHERE id = ?
+            ''',
+            (chat_id,)
+        ).fetchone()
+        return result[0] if result else None
+
+    def get_cycle(self, chat_id: int, cycle_date: str):
+        row = self.reader(chat_id).execute(
+            '''
+            SELECT sleep_time, wake_time, duration, sleep_quality, note, sleep_ts, wake_ts
+            FROM sleep_records
+            WHERE user_id = ? AND sleep_date = ?
+            ''',
+            (chat_id, cycle_date)
+        ).fetchone()
+        if row:
+            return Cycle(*row)
+        # Старые месяцы перенесены в sleep_archive (tgbot_maintenance)
+        record = archived_record(self.reader(chat_id), chat_id, cycle_date)
+        return Cycle(*record[1:]) if record else None
+
+    def get_open_cycle(self, chat_id: int):
+        # Частичный индекс sleep_records_open: одна строка без чтения истории
+        return self.reader(chat_id).execute(
+            '''
+            SELECT sleep_date, sleep_ts
+            FROM sleep_records
+            WHERE user_id = ? AND wake_ts IS NULL AND sleep_ts IS NOT NULL
+            ORDER BY sleep_ts DESC
+            LIMIT 1
+            ''',
+            (chat_id,)
+        ).fetchone()
+
+    def save(self, chat_id: int, cycles: list, status: int = None):
+        self.write(chat_id, self.save_changes, chat_id, cycles, status)
+
+    @classmethod
+    def save_changes(cls, conn, chat_id: int, cycles: list, status: int = None):
+        for cycle_date, values in cycles:
+            cls.save_cycle(conn, chat_id, cycle_date, values)
+        if status is not None:
+            conn.execute(
+                '''
+                UPDATE users
+                SET sleep_status = ?
+                WHERE id = ?
+                ''',
+                (status, chat_id)
+            )
+
+    @staticmethod
+    def save_cycle(conn, chat_id: int, cycle_date: str, values: tuple):
+        """
+        Добавляет или обновляет запись за дату и обновляет суммы статистики на разницу
+        между старой и новой версией записи
+
+        :param conn: sqlite3.Connection
+        :param chat_id: int
+        :param cycle_date: str
+        :param values: tuple
+        :return:
+        """
+        old = conn.execute(
+            '''
+            SELECT sleep_time, duration, sleep_quality
+            FROM sleep_records
+            WHERE user_id = ? AND sleep_date = ?
+            ''',
+            (chat_id, cycle_date)
+        ).fetchone()
+        conn.execute(
+            '''
+            INSERT INTO sleep_records
+            (user_id, sleep_date, sleep_time, wake_time, duration, sleep_quality, note, sleep_ts, wake_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, sleep_date) DO UPDATE SET
+                sleep_time = excluded.sleep_time,
+                wake_time = excluded.wake_time,
+                duration = excluded.duration,
+                sleep_quality = excluded.sleep_quality,
+                note = excluded.note,
+                sleep_ts = excluded.sleep_ts,
+                wake_ts = excluded.wake_ts
+            ''',
+            (chat_id, cycle_date) + values
+        )
+        update_rollups(conn, chat_id, cycle_date, old, (values[0], values[2], values[3]))
+
+    def get_dates(self, chat_id: int, start: str, end: str) -> list:
+        conn = self.reader(chat_id)
+        dates = {row[0] for row in conn.execute(
+            '''
+            SELECT sleep_date
+            FROM sleep_records
+            WHERE user_id = ? AND sleep_date >= ? AND sleep_date < ?
+            ''',
+            (chat_id, start, end)
+        )}
+        dates.update(archived_dates(conn, chat_id, start, end))
+        return sorted(dates, reverse=True)
+
+    def get_date_before(self, chat_id: int, cycle_date: str = None):
+        conn = self.reader(chat_id)
+        dates = (
+            conn.execute('SELECT MAX(sleep_date) FROM sleep_records WHERE user_id = ? AND sleep_date < ?',
+                         (chat_id, cycle_date or '~')).fetchone()[0],
+            archived_date_before(conn, chat_id, cycle_date or '~')
+        )
+        return max((found for found in dates if found), default=None)
+
+    def get_date_from(self, chat_id: int, cycle_date: str):
+        conn = self.reader(chat_id)
+        dates = (
+            conn.execute('SELECT MIN(sleep_date) FROM sleep_records WHERE user_id = ? AND sleep_date >= ?',
+                         (chat_id, cycle_date)).fetchone()[0],
+            archived_date_from(conn, chat_id, cycle_date)
+        )
+        return min((found for found in dates if found), default=None)
+
+    def get_rollups(self, chat_id: int, keys: tuple) -> dict:
+        return {
+            row[0]: row[1:] for row in self.reader(chat_id).execute(
+                f'''
+                SELECT period, {', '.join(ROLLUP_COLUMNS)}
+                FROM sleep_rollups
+                WHERE user_id = ? AND period IN ({', '.join('?' for _ in keys)})
+                ''',
+                (chat_id, *keys)
+            )
+        }
+
+    def get_trend(self, chat_id: int, kind: str, limit: int) -> list:
+        return [(row[0], row[1:]) for row in self.reader(chat_id).execute(
+            f'''
+            SELECT period, {', '.join(ROLLUP_COLUMNS)}
+            FROM sleep_rollups
+            WHERE user_id = ? AND period > ? AND period < ?
+            ORDER BY period DESC
+            LIMIT ?
+            ''',
+            (chat_id, kind, kind + '~', limit)
+        )]
+
+    def get_streak(self, chat_id: int) -> tuple:
+        return self.reader(chat_id).execute(
+            'SELECT streak_current, streak_best, streak_last FROM users WHERE id = ?',
+            (chat_id,)
+        ).fetchone() or (None, None, None)
+
+    def get_reminders(self, shard: int = 0, shards: int = 1) -> list:
+        # Один проход по частичному индексу users_remind_at (в нем есть и id).
+        ## Остаток % в SQLite отрицательный для отрицательных id (группы), а Supervisor.route
+        ## распределяет чаты по остатку Python - приводим к нему
+        return get_connection().execute(
+            '''
+            SELECT id, remind_at
+            FROM users
+            WHERE remind_at IS NOT NULL AND (id % ? + ?) % ? = ?
+            ORDER BY remind_at
+            ''',
+            (shards, shards, shards, shard)
+        ).fetchall()
+
+    def get_reminder_states(self, chat_ids: list) -> dict:
+        if self.writer:
+            for chat_id in chat_ids:
+                self.writer.wait(chat_id)
+        conn = get_connection()
+        states = {}
+        # Не больше REMINDER_CHUNK параметров в одном запросе
+        for start in range(0, len(chat_ids), REMINDER_CHUNK):
+            chunk = chat_ids[start:start + REMINDER_CHUNK]
+            for row in conn.execute(
+                f'''
+                SELECT u.id, u.sleep_status, u.bedtime, (
+                    SELECT MAX(sleep_ts)
+                    FROM sleep_records
+                    WHERE user_id = u.id AND wake_ts IS NULL AND sleep_ts IS NOT NULL
+                )
+                FROM users AS u
+                WHERE u.id IN ({', '.join('?' for _ in chunk)})
+                ''',
+                chunk
+            ):
+                states[row[0]] = row[1:]
+        return states
+
+    def set_reminders(self, reminders: list):
+        # Проверки многих пользователей записываются одним изменением, поэтому ключ общий
+        self.write(None, self.update_reminders, reminders)
+
+    @staticmethod
+    def update_reminders(conn, reminders: list):
+        conn.executemany('UPDATE users SET remind_at = ? WHERE id = ?',
+                         [(remind_at, chat_id) for chat_id, remind_at in reminders])
+
+    def set_bedtime(self, chat_id: int, bedtime: int = None):
+        self.write(chat_id, self.update_bedtime, chat_id, bedtime)
+
+    @staticmethod
+    def update_bedtime(conn, chat_id: int, bedtime: int = None):
+        conn.execute('UPDATE users SET bedtime = ? WHERE id = ?', (bedtime, chat_id))
+
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в памяти процесса без дискового ввода-вывода: для нагрузочных тестов и бенчмарков.
+    Данные теряются при остановке
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # chat_id -> {'name', 'name_updated', 'sleep_status', 'streak': (текущая, рекорд, последняя дата),
+        ##            'bedtime', 'remind_at'}
+        self.users = {}
+        # chat_id -> {дата: значения цикла}, chat_id -> отсортированный список дат,
+        ## chat_id -> {дата: время начала} для незавершенных циклов
+        self.cycles = {}
+        self.dates = {}
+        self.open = {}
+        # (chat_id, период) -> список сумм ROLLUP_COLUMNS
+        self.rollups = {}
+
+    def get_user(self, chat_id: int):
+        with self.lock:
+            user = self.users.get(chat_id)
+            if user is None:
+                return None
+            dates = self.dates[chat_id]
+            latest = dates[-1] if dates else None
+            cycle = Cycle(*self.cycles[chat_id][latest]) if latest else None
+            return user['name'], user['sleep_status'], latest, cycle
+
+    def add_user(self, chat_id: int, name: str, now: int):
+        with self.lock:
+            if chat_id in self.users:
+                raise KeyError(f'Пользователь {chat_id} уже существует')
+            self.users[chat_id] = {'name': name, 'name_updated': now if name else None,
+                                   'sleep_status': 0, 'streak': (None, None, None),
+                                   'bedtime': None, 'remind_at': None}
+            self.cycles[chat_id] = {}
+            self.dates[chat_id] = []
+            self.open[chat_id] = {}
+
+    def get_name(self, chat_id: int):
+        with self.lock:
+            user = self.users.get(chat_id)
+            return user['name'] if user else None
+
+    def update_name(self, chat_id: int, name: str, now: int, stale_before: int):
+        with self.lock:
+            user = self.users.get(chat_id)
+            if user and (user['name'] != name or user['name_updated'] is None or user['name_updated'] < stale_before):
+                user['name'] = name
+                user['name_updated'] = now
+
+    def get_sleep_status(self, chat_id: int):
+        with self.lock:
+            user = self.users.get(chat_id)
+            return user['sleep_status'] if user else None
+
+    def get_cycle(self, chat_id: int, cycle_date: str):
+        with self.lock:
+            values = self.cycles.get(chat_id, {}).get(cycle_date)
+            return Cycle(*values) if values else None
+
+    def get_open_cycle(self, chat_id: int):
+        with self.lock:
+            open_cycles = self.open.get(chat_id)
+            if not open_cycles:
+                return None
+            cycle_date = max(open_cycles, key=open_cycles.get)
+            return cycle_date, open_cycles[cycle_date]
+
+    def save(self, chat_id: int, cycles: list, status: int = None):
+        with self.lock:
+            user = self.users[chat_id]
+            for cycle_date, values in cycles:
+                old = self.cycles[chat_id].get(cycle_date)
+                if old is None:
+                    insort(self.dates[chat_id], cycle_date)
+                    streak = next_streak(user['streak'], cycle_date)
+                    if streak:
+                        user['streak'] = streak
+                self.cycles[chat_id][cycle_date] = values
+                if values[5] is not None and values[6] is None:
+                    self.open[chat_id][cycle_date] = values[5]
+                else:
+                    self.open[chat_id].pop(cycle_date, None)
+                before = contribution(old[0], old[2], old[3]) if old else ZERO
+                delta = [n - o for n, o in zip(contribution(values[0], values[2], values[3]), before)]
+                if any(delta):
+                    for period in periods(cycle_date):
+                        sums = self.rollups.setdefault((chat_id, period), [0] * len(ROLLUP_COLUMNS))
+                        for index, value in enumerate(delta):
+                            sums[index] += value
+            if status is not None:
+                user['sleep_status'] = status
+
+    def get_dates(self, chat_id: int, start: str, end: str) -> list:
+        with self.lock:
+            dates = self.dates.get(chat_id, [])
+            return dates[bisect_left(dates, start):bisect_left(dates, end)][::-1]
+
+    def get_date_before(self, chat_id: int, cycle_date: str = None):
+        with self.lock:
+            dates = self.dates.get(chat_id, [])
+            index = bisect_left(dates, cycle_date) if cycle_date else len(dates)
+            return dates[index - 1] if index else None
+
+    def get_date_from(self, chat_id: int, cycle_date: str):
+        with self.lock:
+            dates = self.dates.get(chat_id, [])
+            index = bisect_left(dates, cycle_date)
+            return dates[index] if index < len(dates) else None
+
+    def get_rollups(self, chat_id: int, keys: tuple) -> dict:
+        with self.lock:
+            return {key: tuple(self.rollups[chat_id, key]) for key in keys if (chat_id, key) in self.rollups}
+
+    def get_trend(self, chat_id: int, kind: str, limit: int) -> list:
+        with self.lock:
+            found = sorted(((period, tuple(sums)) for (user_id, period), sums in self.rollups.items()
+                            if user_id == chat_id and period[0] == kind), reverse=True)
+            return found[:limit]
+
+    def get_streak(self, chat_id: int) -> tuple:
+        with self.lock:
+            user = self.users.get(chat_id)
+            return user['streak'] if user else (None, None, None)
+
+    def get_reminders(self, shard: int = 0, shards: int = 1) -> list:
+        with self.lock:
+            return sorted((chat_id, user['remind_at']) for chat_id, user in self.users.items()
+                          if user['remind_at'] is not None and chat_id % shards == shard)
+
+    def get_reminder_states(self, chat_ids: list) -> dict:
+        with self.lock:
+            return {chat_id: (self.users[chat_id]['sleep_status'], self.users[chat_id]['bedtime'],
+                              max(self.open[chat_id].values(), default=None))
+                    for chat_id in chat_ids if chat_id in self.users}
+
+    def set_reminders(self, reminders: list):
+        with self.lock:
+            for chat_id, remind_at in reminders:
+                if chat_id in self.users:
+                    self.users[chat_id]['remind_at'] = remind_at
+
+    def set_bedtime(self, chat_id: int, bedtime: int = None):
+        with self.lock:
+            if chat_id in self.users:
+                self.users[chat_id]['bedtime'] = bedtime
+
+
+STORAGES = {
+    'sqlite': SQLiteStorage,
+    'memory': MemoryStorage,
+}
+
+
+def create_storage(kind: str = STORAGE) -> Storage:
+    """
+    Создает хранилище указанного вида
+
+    :param kind: str
+    :return: Storage
+    """
+    try:
+        storage_class = STORAGES[kind]
+    except KeyError:
+        raise ValueError(f"Неизвестное хранилище '{kind}'. Доступны: {', '.join(STORAGES)}") from None
+    # KeyError из конструктора хранилища - его собственная ошибка, а не неизвестный вид
+    return storage_class()
@@ -0,0 +1,165 @@
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+
+from telebot import apihelper
+
+from tgbot_webhook import get_chat_id
+
+logger = logging.getLogger('tgbot_supervisor')
+
+# Число рабочих процессов и размер очереди обновлений каждого из них
+WORKERS = int(os.getenv('WORKERS', os.cpu_count() or 1))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 1000))
+
+
+def worker_main(index: int, workers: int, updates: multiprocessing.Queue, ready: multiprocessing.Queue,
+                setup: str = None):
+    """
+    Рабочий процесс: обрабатывает обновления своих чатов по очереди. У каждого процесса
+    свой бот, кэш пользователей, очередь отправки и соединения с базой данных
+
+    :param index: int
+    :param workers: int
+    :param updates: multiprocessing.Queue
+    :param ready: multiprocessing.Queue
+    :param setup: str
+    :return:
+    """
+    # Общий лимит отправки Telegram делится между процессами
+    global_rate = float(os.getenv('SENDER_GLOBAL_RATE', 30))
+    os.environ['SENDER_GLOBAL_RATE'] = str(global_rate / workers)
+    if setup:
+        module, _, name = setup.partition(':')
+        getattr(importlib.import_module(module), name)()
+
+    import telebot
+    import tgbot_final
+    import tgbot_func
+    from tgbot_metrics import METRICS_PORT, start_http_server
+
+    # У каждого процесса свои метрики: процесс index отдает их на порту METRICS_PORT + index
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT + index)
+
+    bot = tgbot_final.bootstrap()
+    bot.threaded = False
+    # Напоминания своих чатов: тех же, что распределяет Supervisor.route
+    tgbot_final.reminders.start(index, workers)
+    ready.put(index)
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(update)])
+        except Exception:
+            logger.exception('Ошибка обработки обновления %s', update.get('update_id'))
+    # atexit в дочерних процессах multiprocessing не вызывается
+    tgbot_final.sessions.flush()
+    tgbot_final.reminders.close()
+    tgbot_func.get_storage().close()
+    tgbot_final.sender.join(10)
+
+
+class Supervisor:
+    """
+    Запускает workers рабочих процессов и распределяет обновления по chat_id % workers,
+    поэтому обновления одного чата всегда обрабатываются одним процессом по порядку
+    """
+
+    def __init__(self, workers: int = WORKERS, setup: str = None):
+        self.workers = workers
+        self.setup = setup
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = []
+        self.processes = []
+
+    def start(self):
+        """
+        Запускает рабочие процессы и ждет их готовности
+
+        :return:
+        """
+        ready = self.context.Queue()
+        for index in range(self.workers):
+            updates = self.context.Queue(WORKER_QUEUE_SIZE)
+            process = self.context.Process(target=worker_main, name=f'worker-{index}',
+                                           args=(index, self.workers, updates, ready, self.setup))
+            process.start()
+            self.queues.append(updates)
+            self.processes.append(process)
+        started = 0
+        while started < self.workers:
+            try:
+                ready.get(timeout=1)
+                started += 1
+            except queue.Empty:
+                failed = [process.name for process in self.processes if process.exitcode is not None]
+                if failed:
+                    self.stop()
+                    raise RuntimeError(f'Рабочие процессы завершились при запуске: {", ".join(failed)}')
+
+    def route(self, update: dict):
+        """
+        Передает обновление процессу, отвечающему за его чат. Блокируется, если очередь процесса заполнена
+
+        :param update: dict
+        :return:
+        """
+        self.queues[get_chat_id(update) % self.workers].put(update)
+
+    def stop(self):
+        """
+        Дожидается обработки принятых обновлений и останавливает процессы
+
+        :return:
+        """
+        for updates, process in zip(self.queues, self.processes):
+            if process.is_alive():
+                updates.put(None)
+        for process in self.processes:
+            process.join()
+        self.queues.clear()
+        self.processes.clear()
+
+
+def run_polling(token: str, workers: int = WORKERS):
+    """
+    Получает обновления long polling в главном процессе и распределяет их по рабочим процессам
+
+    :param token: str
+    :param workers: int
+    :return:
+    """
+    supervisor = Supervisor(workers)
+    supervisor.start()
+    logger.info('Запущено рабочих процессов: %s', workers)
+    offset = None
+    try:
+        while True:
+            try:
+                updates = apihelper.get_updates(token, offset=offset, limit=100, timeout=20, long_polling_timeout=20)
+            except Exception as e:
+                logger.warning('Ошибка получения обновлений: %s', e)
+                continue
+            for update in updates:
+                try:
+                    supervisor.route(update)
+                except ValueError:
+                    logger.warning('Пропущено обновление неверной структуры %s', update.get('update_id'))
+                offset = update['update_id'] + 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    MY_TOKEN = os.getenv('TOKEN')
+    if not MY_TOKEN:
+        raise ValueError("Токен бота не найден. Задайте переменную 'TOKEN'")
+    logging.basicConfig(level=logging.INFO)
+    run_polling(MY_TOKEN)
@@ -0,0 +1,205 @@
+from bisect import insort
+import sys
+
+
+class Cycle:
+    """
+    Запись об одном цикле сна
+    """
+    __slots__ = ('sleep_relative_time', 'sleep_absolute_time', 'wake_relative_time', 'wake_absolute_time',
+                 'duration', 'quality', 'notes')
+
+    def __init__(self, sleep_relative_time: str = None, wake_relative_time: str = None, duration: float = None,
+                 quality: int = 0, notes: str = None, sleep_absolute_time: int = None,
+                 wake_absolute_time: int = None):
+        self.sleep_relative_time = sleep_relative_time
+        self.wake_relative_time = wake_relative_time
+        self.duration = duration
+        self.quality = quality
+        self.notes = notes
+        self.sleep_absolute_time = sleep_absolute_time
+        self.wake_absolute_time = wake_absolute_time
+
+    @property
+    def is_open(self) -> bool:
+        """
+        Цикл начат, но еще не завершен
+
+        :return: bool
+        """
+        return self.sleep_absolute_time is not None and self.wake_absolute_time is None
+
+    def memory_size(self) -> int:
+        """
+        Приблизительно оценивает объем памяти, занимаемый записью, в байтах
+
+        :return: int
+        """
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, name)) for name in self.__slots__)
+
+
+class CycleCollection:
+    """
+    Загруженные циклы пользователя: доступ по дате, отсортированный список дат
+    и указатели на последний и незавершенный циклы за O(1)
+    """
+    __slots__ = ('_cycles', '_dates', 'open_date')
+
+    def __init__(self):
+        self._cycles = {}
+        self._dates = []
+        self.open_date = None
+
+    def __contains__(self, cycle_date: str) -> bool:
+        return cycle_date in self._cycles
+
+    def __getitem__(self, cycle_date: str) -> Cycle:
+        return self._cycles[cycle_date]
+
+    def __len__(self) -> int:
+        return len(self._dates)
+
+    def __iter__(self):
+        return iter(self._dates)
+
+    def get(self, cycle_date: str):
+        """
+        Возвращает цикл за дату или None
+
+        :param cycle_date: str
+        :return: Cycle | None
+        """
+        return self._cycles.get(cycle_date)
+
+    def add(self, cycle_date: str, cycle: Cycle):
+        """
+        Добавляет или заменяет цикл за дату
+
+        :param cycle_date: str
+        :param cycle: Cycle
+        :return:
+        """
+        if cycle_date not in self._cycles:
+            if not self._dates or cycle_date > self._dates[-1]:
+                self._dates.append(cycle_date)
+            else:
+                insort(self._dates, cycle_date)
+        self._cycles[cycle_date] = cycle
+        if cycle.is_open:
+            self.open_date = cycle_date
+
+    @property
+    def latest_date(self):
+        """
+        Дата последнего цикла или None
+
+        :return: str | None
+        """
+        return self._dates[-1] if self._dates else None
+
+    def latest(self):
+        """
+        Возвращает последний цикл или None
+
+        :return: Cycle | None
+        """
+        return self._cycles[self._dates[-1]] if self._dates else None
+
+    def open(self):
+        """
+        Возвращает незавершенный цикл или None
+
+        :return: Cycle | None
+        """
+        cycle = self._cycles.get(self.open_date) if self.open_date else None
+        return cycle if cycle is not None and cycle.is_open else None
+
+    def memory_size(self) -> int:
+        """
+        Приблизительно оценивает объем памяти, занимаемый коллекцией, в байтах
+
+        :return: int
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self._cycles) + sys.getsizeof(self._dates)
+        for cycle_date, cycle in self._cycles.items():
+            size += sys.getsizeof(cycle_date) + cycle.memory_size()
+        return size
+
+
+class UserState:
+    """
+    Состояние пользователя для обработчиков команд: имя, статус сна и только загруженные циклы -
+    последний (или незавершенный) и те, к которым обращались. Остальная история читается
+    из базы данных по требованию, поэтому объем памяти не зависит от длины истории
+    """
+    __slots__ = ('name', 'is_sleeping', 'saved_status', 'cycles', 'changed')
+
+    def __init__(self, name: str = None, is_sleeping: int = 0):
+        self.name = name
+        self.is_sleeping = is_sleeping
+        self.saved_status = is_sleeping
+        self.cycles = CycleCollection()
+        self.changed = set()
+
+    @property
+    def latest_date(self):
+        """
+        Дата последнего цикла или None
+
+        :return: str | None
+        """
+        return self.cycles.latest_date
+
+    def latest(self):
+        """
+        Возвращает последний цикл или None
+
+        :return: Cycle | None
+        """
+        return self.cycles.latest()
+
+    def add_cycle(self, cycle_date: str, cycle: Cycle):
+        """
+        Добавляет загруженный из базы данных цикл
+
+        :param cycle_date: str
+        :param cycle: Cycle
+        :return:
+        """
+        self.cycles.add(cycle_date, cycle)
+
+    def set_cycle(self, cycle_date: str, cycle: Cycle):
+        """
+        Записывает новый цикл за дату и отмечает его для сохранения
+
+        :param cycle_date: str
+        :param cycle: Cycle
+        :return:
+        """
+        self.cycles.add(cycle_date, cycle)
+        self.changed.add(cycle_date)
+
+    def mark_changed(self, cycle_date: str):
+        """
+        Отмечает цикл за дату как измененный, чтобы save_user_data записал только его
+
+        :param cycle_date: str
+        :return:
+        """
+        self.changed.add(cycle_date)
+
+    def is_dirty(self) -> bool:
+        """
+        Проверяет, есть ли несохраненные изменения
+
+        :return: bool
+        """
+        return bool(self.changed) or self.is_sleeping != self.saved_status
+
+    def memory_size(self) -> int:
+        """
+        Приблизительно оценивает объем памяти, занимаемый состоянием, в байтах
+
+        :return: int
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self.changed) + self.cycles.memory_size()
@@ -0,0 +1,244 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+
+import telebot
+
+from tgbot_metrics import ENABLED as METRICS_ENABLED, METRICS_PATH, register_gauges, render
+
+logger = logging.getLogger('tgbot_webhook')
+
+# Параметры вебхука задаются переменными окружения
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 8))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', 1000))
+
+MAX_BODY = 1024 * 1024
+
+
+def get_chat_id(update: dict) -> int:
+    """
+    Возвращает идентификатор чата, к которому относится обновление (0, если чата нет).
+    Для обновления неверной структуры (не объект, нет chat.id или from.id) - ValueError
+
+    :param update: dict
+    :return: int
+    """
+    try:
+        chat_id = find_chat_id(update)
+    except (AttributeError, KeyError, TypeError):
+        raise ValueError('Неверная структура обновления') from None
+    if not isinstance(chat_id, int):
+        raise ValueError('Неверная структура обновления')
+    return chat_id
+
+
+def find_chat_id(update: dict) -> int:
+    """
+    Ищет идентификатор чата в обновлении
+
+    :param update: dict
+    :return: int
+    """
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+    if 'callback_query' in update:
+        query = update['callback_query']
+        if 'message' in query:
+            return query['message']['chat']['id']
+        return query['from']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+class UpdateDispatcher:
+    """
+    Передает обновления обработчикам бота: обновления одного чата обрабатываются строго по очереди,
+    разных чатов - параллельно в пуле потоков. Число ожидающих обновлений ограничено max_pending,
+    сверх него новые пакеты отклоняются
+    """
+
+    def __init__(self, bot: telebot.TeleBot, workers: int = WEBHOOK_WORKERS, max_pending: int = WEBHOOK_MAX_PENDING):
+        self.bot = bot
+        self.max_pending = max_pending
+        self.pending = 0
+        self.processed = 0
+        self.shed = 0
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='update')
+        # chat_id -> очередь обновлений чата; чат присутствует, пока его очередь обрабатывается
+        self._chats = {}
+
+    def submit(self, updates: list) -> bool:
+        """
+        Ставит пакет обновлений в очередь. Возвращает False, если очередь переполнена.
+        Пакет с обновлением неверной структуры отклоняется целиком (ValueError) до постановки в очередь
+
+        :param updates: list
+        :return: bool
+        """
+        chat_ids = [get_chat_id(update) for update in updates]
+        if self.pending + len(updates) > self.max_pending:
+            self.shed += len(updates)
+            return False
+        for update, chat_id in zip(updates, chat_ids):
+            self.pending += 1
+            queue = self._chats.get(chat_id)
+            if queue is None:
+                self._chats[chat_id] = deque([update])
+                asyncio.get_running_loop().create_task(self._drain(chat_id))
+            else:
+                queue.append(update)
+        return True
+
+    async def _drain(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        queue = self._chats[chat_id]
+        while queue:
+            update = queue.popleft()
+            try:
+                await loop.run_in_executor(self.executor, self._process, update)
+            except Exception:
+                logger.exception('Ошибка обработки обновления %s', update.get('update_id'))
+            self.pending -= 1
+            self.processed += 1
+        del self._chats[chat_id]
+
+    def _process(self, update: dict):
+        self.bot.process_new_updates([telebot.types.Update.de_json(update)])
+
+    async def join(self):
+        """
+        Ожидает обработки всех принятых обновлений
+
+        :return:
+        """
+        while self.pending:
+            await asyncio.sleep(0.01)
+
+
+async def handle_connection(dispatcher: UpdateDispatcher, reader: asyncio.StreamReader,
+                            writer: asyncio.StreamWriter):
+    """
+    Обрабатывает HTTP-соединение: принимает POST с одним обновлением или списком обновлений
+
+    :param dispatcher: UpdateDispatcher
+    :param reader: asyncio.StreamReader
+    :param writer: asyncio.StreamWriter
+    :return:
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length > MAX_BODY:
+                await respond(writer, 413, 'Payload Too Large')
+                break
+            body = await reader.readexactly(length) if length else b''
+
+            if method == 'GET' and path == METRICS_PATH and METRICS_ENABLED:
+                await respond(writer, 200, 'OK', {'Content-Type': 'text/plain; version=0.0.4'}, render())
+            elif method != 'POST' or path != WEBHOOK_PATH:
+                await respond(writer, 404, 'Not Found')
+            elif WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+                await respond(writer, 403, 'Forbidden')
+            else:
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    await respond(writer, 400, 'Bad Request')
+                    continue
+                updates = payload if isinstance(payload, list) else [payload]
+                try:
+                    accepted = dispatcher.submit(updates)
+                except ValueError:
+                    await respond(writer, 400, 'Bad Request')
+                    continue
+                if accepted:
+                    await respond(writer, 200, 'OK')
+                else:
+                    # Telegram повторит доставку позже
+                    await respond(writer, 503, 'Service Unavailable', {'Retry-After': '1'})
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def respond(writer: asyncio.StreamWriter, status: int, reason: str, headers: dict = None, text: str = None):
+    """
+    Отправляет HTTP-ответ: переданный текст или текст статуса
+
+    :param writer: asyncio.StreamWriter
+    :param status: int
+    :param reason: str
+    :param headers: dict
+    :param text: str
+    :return:
+    """
+    body = (reason if text is None else text).encode()
+    headers = {'Content-Type': 'text/plain', **(headers or {})}
+    lines = [f'HTTP/1.1 {status} {reason}', f'Content-Length: {len(body)}']
+    lines += [f'{key}: {value}' for key, value in headers.items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+    await writer.drain()
+
+
+async def serve(bot: telebot.TeleBot, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    """
+    Запускает HTTP-сервер вебхука и обрабатывает обновления до остановки
+
+    :param bot: telebot.TeleBot
+    :param host: str
+    :param port: int
+    :return:
+    """
+    # Порядок внутри чата обеспечивает диспетчер, поэтому обработчики вызываются синхронно
+    bot.threaded = False
+    dispatcher = UpdateDispatcher(bot)
+    register_gauges('webhook', lambda: {'pending': dispatcher.pending, 'processed': dispatcher.processed,
+                                        'shed': dispatcher.shed})
+    server = await asyncio.start_server(lambda r, w: handle_connection(dispatcher, r, w), host, port)
+    logger.info('Вебхук слушает %s:%s%s', host, port, WEBHOOK_PATH)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await dispatcher.join()
+        dispatcher.executor.shutdown()
+
+
+def run_webhook(bot: telebot.TeleBot, url: str = None):
+    """
+    Регистрирует вебхук в Telegram (если задан url) и запускает сервер.
+    Без url сервер можно проверить локально, отправляя POST с JSON обновлений
+
+    :param bot: telebot.TeleBot
+    :param url: str
+    :return:
+    """
+    if url:
+        bot.remove_webhook()
+        bot.set_webhook(url=url + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        max_connections=min(WEBHOOK_WORKERS * 5, 100))
+    asyncio.run(serve(bot))